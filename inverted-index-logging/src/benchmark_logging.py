@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""
+Query throughput with debug logging on and off.
+
+Every query of InvertedIndex.query logs a debug record. The benchmark
+runs the same queries with debug logging off, written synchronously to
+a file, queued and written in batches, and queued with sampling.
+"""
+
+from argparse import ArgumentDefaultsHelpFormatter
+from argparse import ArgumentParser
+import logging
+import os
+from tempfile import TemporaryDirectory
+import time
+
+from inverted_index import APPLICATION_NAME
+from inverted_index import DEFAULT_DATASET_PATH
+from inverted_index import build_inverted_index
+from inverted_index import load_documents
+from logging_pipeline import DEFAULT_BATCH_SIZE
+from logging_pipeline import setup_queued_logging
+from logging_pipeline import stop_queued_logging
+
+DEFAULT_SAMPLE_RATE = 0.01
+
+
+def benchmark_queries(inverted_index, queries: list, repeat: int) -> float:
+    """Run the queries repeat times and return queries per second"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            inverted_index.query(query)
+    return repeat * len(queries) / (time.perf_counter() - start)
+
+
+def benchmark_logging(inverted_index, queries: list, repeat: int,
+                      sample_rate: float = DEFAULT_SAMPLE_RATE,
+                      batch_size: int = DEFAULT_BATCH_SIZE) -> dict:
+    """Return query throughput with debug logging off, synchronous, queued and sampled"""
+    results = {}
+    with TemporaryDirectory() as tmp_dirpath:
+        log_filepath = os.path.join(tmp_dirpath, "benchmark.log")
+        file_config = {
+            "version": 1,
+            "formatters": {"simple": {"format": "%(asctime)s %(name)s %(levelname)s %(message)s"}},
+            "handlers": {"file_handler": {
+                "class": "logging.FileHandler", "filename": log_filepath, "formatter": "simple",
+            }},
+        }
+        setups = {
+            "off": ("INFO", None),
+            "sync": ("DEBUG", None),
+            "queued": ("DEBUG", {"batch_size": batch_size}),
+            "queued+sampled": ("DEBUG", {"batch_size": batch_size,
+                                         "debug_sample_rate": sample_rate}),
+        }
+        for name, (level, queue_config) in setups.items():
+            config = dict(file_config, loggers={APPLICATION_NAME: {
+                "level": level, "handlers": ["file_handler"], "propagate": False,
+            }})
+            if queue_config is not None:
+                config["queue"] = dict(queue_config, loggers=[APPLICATION_NAME])
+            listeners = setup_queued_logging(config)
+            results[name] = benchmark_queries(inverted_index, queries, repeat)
+            stop_queued_logging(listeners)
+        logging.getLogger(APPLICATION_NAME).handlers.clear()
+    return results
+
+
+def main():
+    """Print query throughput with different debug logging setups"""
+    parser = ArgumentParser(
+        prog="benchmark_logging",
+        description="Query throughput with debug logging on and off",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-d", "--dataset", default=DEFAULT_DATASET_PATH,
+                        dest="dataset_filepath", help="path to dataset to index")
+    parser.add_argument("-n", "--queries", type=int, default=1000,
+                        help="number of distinct queries")
+    parser.add_argument("-r", "--repeat", type=int, default=20,
+                        help="number of times every query is run")
+    parser.add_argument("--sample-rate", type=float, default=DEFAULT_SAMPLE_RATE,
+                        help="share of debug records kept in the sampled setup")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="number of records written together")
+    arguments = parser.parse_args()
+    inverted_index = build_inverted_index(load_documents(arguments.dataset_filepath))
+    terms = sorted(inverted_index.inverted_index)
+    step = max(1, len(terms) // arguments.queries)
+    queries = [[term] for term in terms[::step][:arguments.queries]]
+    results = benchmark_logging(inverted_index, queries, arguments.repeat,
+                                arguments.sample_rate, arguments.batch_size)
+    for name, queries_per_second in results.items():
+        print(f"{name}: {queries_per_second:,.0f} queries/s, "
+              f"{queries_per_second / results['off']:.0%} of logging off")
+
+
+if __name__ == "__main__":
+    main()
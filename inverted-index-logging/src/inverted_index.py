@@ -16,11 +16,17 @@ from collections import defaultdict
 from io import TextIOWrapper
 # import re
 import logging
-import logging.config
 import struct
 import sys
+import time
 
-import yaml
+from logging_pipeline import debug_sampler
+from logging_pipeline import load_logging_config
+from logging_pipeline import setup_queued_logging
+from metrics import DEFAULT_EXPORT_FORMAT
+from metrics import EXPORT_FORMATS
+from metrics import install_export
+from metrics import stage_metrics
 
 APPLICATION_NAME = "inverted_index"
 DEFAULT_DATASET_PATH = "../resources/wikipedia_sample"
@@ -69,11 +75,15 @@ class InvertedIndex:
             "Query should be provided with a list of words, but user provided: "
             f"{repr(words)}."
         )
-        logger.debug("Query inverted index with request: %s", repr(words))
-        result = self.inverted_index[words[0]]
-        for word in words:
-            result &= self.inverted_index[word]
-        return list(result)
+        if logger.isEnabledFor(logging.DEBUG) and debug_sampler.sample():
+            logger.debug("Query inverted index with request: %r", words)
+        start = time.perf_counter_ns()
+        postings_sets = [self.inverted_index.get(word, set()) for word in words]
+        looked_up = time.perf_counter_ns()
+        stage_metrics.record("term_lookup", looked_up - start)
+        result = list(set.intersection(*postings_sets)) if postings_sets else []
+        stage_metrics.record("intersection", time.perf_counter_ns() - looked_up)
+        return result
 
     def dump(self, filepath: str):
         """Write inverted index to disk"""
@@ -90,7 +100,7 @@ class InvertedIndex:
     def load(cls, filepath: str):
         """Load inverted index from disk"""
         logger.info("Load inverted index from filepath: %s", filepath)
-        with open(filepath, "rb") as fin:
+        with stage_metrics.time("load"), open(filepath, "rb") as fin:
             encoding = 'utf-8'
 
             index_len = struct.unpack(">I", fin.read(4))[0]
@@ -133,13 +143,14 @@ def build_inverted_index(documents: dict) -> InvertedIndex:
     logger.info("Building inverted index for provided documents...")
     inverted_index = defaultdict(set)
     # stop_words = load_stop_words(DEFAULT_STOPWORDS_PATH)
-    for i, document in documents.items():
-        # document = re.sub(r"\W+", " ", document)
-        # for term in document.lower().split():
-        for term in document.split():
-            # if (re.search(term, stop_words) is None) and (i not in inverted_index[term]):
-            # if i not in inverted_index[term]:
-            inverted_index[term].add(i)
+    with stage_metrics.time("build"):
+        for i, document in documents.items():
+            # document = re.sub(r"\W+", " ", document)
+            # for term in document.lower().split():
+            for term in document.split():
+                # if (re.search(term, stop_words) is None) and (i not in inverted_index[term]):
+                # if i not in inverted_index[term]:
+                inverted_index[term].add(i)
     inverted_index = InvertedIndex(inverted_index)
     return inverted_index
 
@@ -171,14 +182,32 @@ def process_queries(inverted_index_filepath, query_file):
     if isinstance(query_file, str):
         query_file = [query_file]
     for query in query_file:
+        start = time.perf_counter_ns()
         query = query.strip().split()
-        logger.debug("Use the following query to run against InvertedIndex: %s", query)
+        if logger.isEnabledFor(logging.DEBUG) and debug_sampler.sample():
+            logger.debug("Use the following query to run against InvertedIndex: %s", query)
         result = inverted_index.query(query)
+        evaluated = time.perf_counter_ns()
         print(",".join([str(x) for x in result]))
+        finished = time.perf_counter_ns()
+        stage_metrics.record("output", finished - evaluated)
+        stage_metrics.record("query", finished - start)
 
 
 def setup_parser(parser):
     """The function to setup parser arguments"""
+    parser.add_argument(
+        "--metrics-file",
+        dest="metrics_filepath",
+        metavar="PATH",
+        help="write per-stage latency metrics to PATH at exit and on SIGUSR1",
+    )
+    parser.add_argument(
+        "--metrics-format",
+        default=DEFAULT_EXPORT_FORMAT,
+        choices=EXPORT_FORMATS,
+        help="format of the metrics file",
+    )
     subparsers = parser.add_subparsers(help="choose command")
 
     build_parser = subparsers.add_parser(
@@ -237,14 +266,13 @@ def setup_parser(parser):
     query_parser.set_defaults(callback=callback_query)
 
 
-def setup_logging():
-    with open(DEFAULT_LOGGING_CONFIG_FILEPATH) as config_fin:
-    	logging.config.dictConfig(yaml.safe_load(config_fin))
+def setup_logging(config_filepath: str = DEFAULT_LOGGING_CONFIG_FILEPATH) -> list:
+    """Configure logging, return listeners writing queued records"""
+    return setup_queued_logging(load_logging_config(config_filepath))
 
 
 def main():
     """Main module function"""
-    setup_logging()
     parser = ArgumentParser(
         prog="inverted-index",
         description="A tool to build, dump, load, and query inverted index.",
@@ -252,6 +280,9 @@ def main():
     )
     setup_parser(parser)
     arguments = parser.parse_args()
+    setup_logging()
+    if arguments.metrics_filepath is not None:
+        install_export(arguments.metrics_filepath, arguments.metrics_format)
     arguments.callback(arguments)
 
 
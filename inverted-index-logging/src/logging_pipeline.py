@@ -0,0 +1,172 @@
+"""
+Non-blocking logging pipeline.
+
+Loggers listed in the "queue" section of the logging config hand their
+records to a QueueHandler, so the query path only puts records on an
+in-memory queue, formatting included. A BatchingQueueListener thread
+drains the queue and writes records to the configured handlers in
+batches, one write and one flush per batch. Per-query debug records are
+sampled with debug_sampler before they are even created, so a high query
+rate does not turn into the same rate of log lines.
+
+Config section (all keys optional, without it logging is synchronous):
+    queue:
+        loggers: [inverted_index]
+        batch_size: 256
+        debug_sample_rate: 0.01
+"""
+
+import atexit
+import logging
+import logging.config
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+from queue import SimpleQueue
+
+import yaml
+
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_DEBUG_SAMPLE_RATE = 1.0
+DEFAULT_QUEUED_LOGGERS = ("inverted_index",)
+
+
+class DebugSampler:
+    """Decide which of the frequent debug records are logged
+
+    Sampling is deterministic: with sample rate 0.25 every fourth call
+    of sample returns True, the first one included. Check it before the
+    record is created, so dropped records cost next to nothing:
+        if logger.isEnabledFor(logging.DEBUG) and debug_sampler.sample():
+            logger.debug(...)
+    """
+    def __init__(self, sample_rate: float = DEFAULT_DEBUG_SAMPLE_RATE):
+        self.set_rate(sample_rate)
+
+    def set_rate(self, sample_rate: float):
+        """Start sampling with the rate"""
+        self.sample_rate = sample_rate
+        self._credit = 1.0
+        self.dropped_count = 0
+
+    def sample(self) -> bool:
+        """Whether the next debug record is kept"""
+        if self._credit >= 1.0:
+            self._credit += self.sample_rate - 1.0
+            return True
+        self._credit += self.sample_rate
+        self.dropped_count += 1
+        return False
+
+
+debug_sampler = DebugSampler()
+
+
+class LazyQueueHandler(QueueHandler):
+    """Queue handler leaving formatting of records to the listener thread
+
+    The queue never leaves the process, so records are queued as they are
+    instead of being formatted and copied on the logging thread. Arguments
+    of queued records must not be modified afterwards.
+    """
+    def prepare(self, record):
+        return record
+
+
+def emit_batch(handler: logging.Handler, records: list):
+    """Write records with the handler, stream handlers write and flush them at once"""
+    records = [
+        record for record in records
+        if record.levelno >= handler.level and handler.filter(record)
+    ]
+    if not records:
+        return
+    if not isinstance(handler, logging.StreamHandler) or handler.stream is None:
+        for record in records:
+            handler.handle(record)
+        return
+    with handler.lock:
+        try:
+            handler.stream.write(
+                "".join(handler.format(record) + handler.terminator for record in records)
+            )
+            handler.flush()
+        except Exception:
+            handler.handleError(records[0])
+
+
+class BatchingQueueListener(QueueListener):
+    """Queue listener passing records to its handlers in batches
+
+    A batch is written as soon as it holds batch_size records or the queue
+    runs empty, so records are delayed only while more of them are waiting.
+    """
+    def __init__(self, queue, *handlers, batch_size: int = DEFAULT_BATCH_SIZE):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+        self._batch = []
+
+    def handle(self, record):
+        """Add the record to the current batch, write the batch when it is due"""
+        self._batch.append(self.prepare(record))
+        if len(self._batch) >= self.batch_size or self.queue.empty():
+            self.flush()
+
+    def flush(self):
+        """Write the current batch"""
+        batch, self._batch = self._batch, []
+        for handler in self.handlers:
+            emit_batch(handler, batch)
+
+    def stop(self):
+        """Write every queued record and stop the listener thread"""
+        super().stop()
+        self.flush()
+
+
+def setup_queued_logging(config: dict) -> list:
+    """Configure logging from the dict config, return the started queue listeners
+
+    Handlers of the loggers named in the "queue" section are moved behind
+    a queue served by a BatchingQueueListener, without the section
+    records are written synchronously.
+    """
+    config = dict(config)
+    queue_config = config.pop("queue", None)
+    logging.config.dictConfig(config)
+    debug_sampler.set_rate((queue_config or {}).get("debug_sample_rate",
+                                                    DEFAULT_DEBUG_SAMPLE_RATE))
+    if queue_config is None:
+        return []
+    listeners = []
+    for name in queue_config.get("loggers", DEFAULT_QUEUED_LOGGERS):
+        logger = logging.getLogger(None if name == "root" else name)
+        handlers = [
+            handler for handler in logger.handlers if not isinstance(handler, QueueHandler)
+        ]
+        if not handlers:
+            continue
+        queue = SimpleQueue()
+        queue_handler = LazyQueueHandler(queue)
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+        listener = BatchingQueueListener(
+            queue, *handlers, batch_size=queue_config.get("batch_size", DEFAULT_BATCH_SIZE),
+        )
+        listener.start()
+        atexit.register(listener.stop)
+        listeners.append(listener)
+    return listeners
+
+
+def stop_queued_logging(listeners: list):
+    """Stop the listeners, writing all queued records"""
+    for listener in listeners:
+        listener.stop()
+        atexit.unregister(listener.stop)
+
+
+def load_logging_config(filepath: str) -> dict:
+    """Read YAML logging config"""
+    with open(filepath) as config_fin:
+        return yaml.safe_load(config_fin)
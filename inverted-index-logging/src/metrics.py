@@ -0,0 +1,211 @@
+"""
+Per-stage latency metrics.
+
+Stages of index build, load and query processing record their durations
+in nanoseconds into HDR-style histograms: values are bucketed by powers
+of two, each power of two split into linear sub-buckets, so every
+recorded value is kept with a bounded relative error (below 1%) at a
+fixed memory cost, whatever the range of latencies.
+
+Metrics are exported as JSON or in Prometheus text format, at exit and
+whenever the process gets SIGUSR1 when install_export is called.
+"""
+
+import atexit
+import json
+import os
+import signal
+import threading
+import time
+
+SUB_BUCKET_BITS = 8
+EXPORT_FORMATS = ("json", "prometheus")
+DEFAULT_EXPORT_FORMAT = "json"
+EXPORT_SIGNAL = getattr(signal, "SIGUSR1", None)
+REPORTED_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+PROMETHEUS_METRIC_NAME = "inverted_index_stage_seconds"
+
+
+class LatencyHistogram:
+    """Histogram of non-negative integer values with bounded relative error
+
+    Values below 2 ** SUB_BUCKET_BITS are counted exactly, larger ones in
+    buckets of width 2 ** shift, where shift grows with the magnitude.
+    Recording is a few integer operations and takes no lock, so under
+    concurrent threads an increment may rarely be lost, which does not
+    matter for latency statistics.
+    """
+    BUCKETS_COUNT = ((64 - SUB_BUCKET_BITS) << (SUB_BUCKET_BITS - 1)) + (1 << SUB_BUCKET_BITS)
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS_COUNT
+        self.total = 0
+
+    @staticmethod
+    def bucket_index(value: int) -> int:
+        """Return index of the bucket holding the value"""
+        shift = value.bit_length() - SUB_BUCKET_BITS
+        if shift <= 0:
+            return value
+        return (shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+    @staticmethod
+    def bucket_range(index: int) -> tuple:
+        """Return the smallest and the largest value of the bucket"""
+        if index < 1 << SUB_BUCKET_BITS:
+            return index, index
+        shift = (index >> (SUB_BUCKET_BITS - 1)) - 1
+        mantissa = index - (shift << (SUB_BUCKET_BITS - 1))
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def record(self, value: int):
+        """Count the value, values of 2 ** 64 and above are not supported"""
+        shift = value.bit_length() - SUB_BUCKET_BITS
+        self.counts[value if shift <= 0 else (shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)] += 1
+        self.total += value
+
+    @property
+    def count(self) -> int:
+        """Number of recorded values"""
+        return sum(self.counts)
+
+    @property
+    def min(self) -> int:
+        """Smallest recorded value, up to the bucket precision"""
+        for index, count in enumerate(self.counts):
+            if count:
+                return self.bucket_range(index)[0]
+        return 0
+
+    @property
+    def max(self) -> int:
+        """Largest recorded value, up to the bucket precision"""
+        for index in range(len(self.counts) - 1, -1, -1):
+            if self.counts[index]:
+                return self.bucket_range(index)[1]
+        return 0
+
+    def quantile(self, quantile: float) -> int:
+        """Return the value below or at which the given share of values lies"""
+        count = self.count
+        if not count:
+            return 0
+        rank = max(1, round(quantile * count))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                low, high = self.bucket_range(index)
+                return (low + high) // 2
+        return self.max
+
+    def summary(self) -> dict:
+        """Return count, sum, extremes and quantiles of the values"""
+        count = self.count
+        return {
+            "count": count,
+            "sum": self.total,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total / count if count else 0.0,
+            "quantiles": {str(q): self.quantile(q) for q in REPORTED_QUANTILES},
+        }
+
+
+class Timer:
+    """Context manager recording time spent in a stage"""
+    def __init__(self, metrics, stage: str):
+        self._metrics = metrics
+        self._stage = stage
+        self._start = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._metrics.record(self._stage, time.perf_counter_ns() - self._start)
+
+
+class StageMetrics:
+    """Latency histograms by stage name"""
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, stage: str) -> LatencyHistogram:
+        """Return histogram of the stage, creating it on first use"""
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(stage, LatencyHistogram())
+        return histogram
+
+    def record(self, stage: str, nanoseconds: int):
+        """Record duration of one pass through the stage"""
+        self.histogram(stage).record(nanoseconds)
+
+    def time(self, stage: str) -> Timer:
+        """Return context manager recording time spent in its body"""
+        return Timer(self, stage)
+
+    def reset(self):
+        """Forget all recorded values"""
+        with self._lock:
+            self.histograms = {}
+
+    def to_json(self) -> str:
+        """Return stage summaries in seconds as JSON"""
+        stages = {}
+        for stage, histogram in sorted(self.histograms.items()):
+            summary = histogram.summary()
+            stages[stage] = {
+                "count": summary["count"],
+                "sum_seconds": summary["sum"] / 1e9,
+                "min_seconds": summary["min"] / 1e9,
+                "max_seconds": summary["max"] / 1e9,
+                "mean_seconds": summary["mean"] / 1e9,
+                "quantiles_seconds": {
+                    quantile: value / 1e9 for quantile, value in summary["quantiles"].items()
+                },
+            }
+        return json.dumps({"stages": stages}, indent=2)
+
+    def to_prometheus(self) -> str:
+        """Return stage summaries in Prometheus text exposition format"""
+        name = PROMETHEUS_METRIC_NAME
+        lines = [
+            f"# HELP {name} Time spent in a stage of index build, load or query processing.",
+            f"# TYPE {name} summary",
+        ]
+        for stage, histogram in sorted(self.histograms.items()):
+            summary = histogram.summary()
+            for quantile, value in summary["quantiles"].items():
+                lines.append(f'{name}{{stage="{stage}",quantile="{quantile}"}} {value / 1e9!r}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {summary["sum"] / 1e9!r}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {summary["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, filepath: str, export_format: str = DEFAULT_EXPORT_FORMAT):
+        """Write metrics to the file, replacing it at once"""
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown metrics format {export_format!r}.")
+        text = self.to_json() if export_format == "json" else self.to_prometheus()
+        tmp_filepath = f"{filepath}.tmp"
+        with open(tmp_filepath, "w") as fout:
+            fout.write(text)
+        os.replace(tmp_filepath, filepath)
+
+
+stage_metrics = StageMetrics()
+
+
+def install_export(filepath: str, export_format: str = DEFAULT_EXPORT_FORMAT,
+                   metrics: StageMetrics = stage_metrics):
+    """Export metrics to the file at exit and on SIGUSR1"""
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown metrics format {export_format!r}.")
+    atexit.register(metrics.export, filepath, export_format)
+    if EXPORT_SIGNAL is not None and threading.current_thread() is threading.main_thread():
+        signal.signal(EXPORT_SIGNAL, lambda signum, frame: metrics.export(filepath,
+                                                                          export_format))
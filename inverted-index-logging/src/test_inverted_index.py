@@ -1,5 +1,6 @@
 from argparse import Namespace
 import logging
+import sys
 from textwrap import dedent
 
 import pytest
@@ -10,6 +11,10 @@ from inverted_index import DEFAULT_INVERTED_INDEX_SAVE_PATH
 from inverted_index import callback_query, process_queries
 from inverted_index import callback_build, process_build
 from inverted_index import load_documents
+import inverted_index
+from logging_pipeline import DebugSampler, debug_sampler
+from logging_pipeline import setup_queued_logging, stop_queued_logging
+from metrics import stage_metrics
 from storage_policy import ArrayStoragePolicy
 
 DATASET_BIG_FPATH = "../resources/wikipedia_sample"
@@ -86,6 +91,7 @@ def test_can_load_documents(tiny_dataset_fio):
         pytest.param(["B_word"], [2, 37], id="B_word"),
         pytest.param(["A_word", "B_word"], [37], id="both_words"),
         pytest.param(["word_does_not_exist"], [], id="word does not exist"),
+        pytest.param([], [], id="empty query"),
     ],
 )
 def test_query_inverted_index_intersect_results(tiny_dataset_fio, query, etalon_answer):
@@ -185,8 +191,8 @@ def test_can_dump_and_load_inverted_index(tmpdir, wikipedia_inverted_index):
         # pytest.param(DATASET_BIG_FPATH, marks=[pytest.mark.slow]),
     ],
 )
-def test_process_build_can_load_documents(dataset_filepath):
-    process_build(dataset_filepath, "inverted.index")
+def test_process_build_can_load_documents(tmpdir, dataset_filepath):
+    process_build(dataset_filepath, tmpdir.join("inverted.index"))
 
 
 @pytest.mark.parametrize(
@@ -197,19 +203,103 @@ def test_process_build_can_load_documents(dataset_filepath):
         # pytest.param(DATASET_BIG_FPATH, marks=[pytest.mark.slow]),
     ],
 )
-def test_callback_build_can_build_inverted_index_from_provided_file(dataset_filepath):
+def test_callback_build_can_build_inverted_index_from_provided_file(tmpdir, dataset_filepath):
     build_arguments = Namespace(
         dataset_filepath=dataset_filepath,
-        inverted_index_filepath=DEFAULT_INVERTED_INDEX_SAVE_PATH,
+        inverted_index_filepath=tmpdir.join(DEFAULT_INVERTED_INDEX_SAVE_PATH),
     )
     callback_build(build_arguments)
 
 
-def test_process_queries_can_process_queries_from_provided_file(capsys, caplog):
+def test_debug_sampler_keeps_share_of_records():
+    sampler = DebugSampler(0.25)
+    assert [sampler.sample() for _ in range(8)] == [True, False, False, False] * 2
+    assert sampler.dropped_count == 6
+    sampler.set_rate(1.0)
+    assert all(sampler.sample() for _ in range(10))
+
+
+@pytest.fixture()
+def queued_log_fio(tmpdir):
+    log_fio = tmpdir.join("queued.log")
+    yield log_fio
+    logging.getLogger("inverted_index").handlers.clear()
+    debug_sampler.set_rate(1.0)
+
+
+@pytest.mark.parametrize("sample_rate, etalon_records_count", [(1.0, 40), (0.5, 20)])
+def test_queued_logging_writes_sampled_records_in_batches(queued_log_fio, tiny_dataset_fio,
+                                                          sample_rate, etalon_records_count):
+    tiny_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio))
+    listeners = setup_queued_logging({
+        "version": 1,
+        "formatters": {"simple": {"format": "%(levelname)s %(message)s"}},
+        "handlers": {"file_handler": {
+            "class": "logging.FileHandler", "filename": str(queued_log_fio),
+            "formatter": "simple",
+        }},
+        "loggers": {"inverted_index": {"level": "DEBUG", "handlers": ["file_handler"]}},
+        "queue": {"loggers": ["inverted_index"], "batch_size": 8,
+                  "debug_sample_rate": sample_rate},
+    })
+    assert len(listeners) == 1
+    for i in range(40):
+        tiny_inverted_index.query([f"A_word{i}"])
+    logging.getLogger("inverted_index").info("done")
+    stop_queued_logging(listeners)
+    lines = queued_log_fio.read().splitlines()
+    assert len(lines) == etalon_records_count + 1
+    assert lines[0] == "DEBUG Query inverted index with request: ['A_word0']"
+    assert lines[-1] == "INFO done"
+
+
+def test_process_queries_records_stage_metrics(tmpdir, tiny_dataset_fio, capsys):
+    index_fio = tmpdir.join("index.dump")
+    tiny_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio))
+    tiny_inverted_index.dump(index_fio)
+    stage_metrics.reset()
+    process_queries(index_fio, ["A_word B_word", "A_word"])
+    process_queries(index_fio, ["A_word"])
+    assert capsys.readouterr().out == "37\n123,37\n123,37\n"
+    for stage, etalon_count in [("load", 2), ("term_lookup", 3), ("intersection", 3),
+                                ("output", 3), ("query", 3)]:
+        assert stage_metrics.histogram(stage).count == etalon_count
+    metrics_fio = tmpdir.join("metrics.prom")
+    stage_metrics.export(metrics_fio, "prometheus")
+    assert 'inverted_index_stage_seconds_count{stage="intersection"} 3' in metrics_fio.read()
+
+
+def test_process_queries_answers_blank_queries_with_empty_line(tmpdir, tiny_dataset_fio,
+                                                               capsys):
+    index_fio = tmpdir.join("index.dump")
+    build_inverted_index(load_documents(tiny_dataset_fio)).dump(index_fio)
+    process_queries(index_fio, ["", "  \t", "A_word B_word"])
+    assert capsys.readouterr().out == "\n\n37\n"
+
+
+def test_main_parses_arguments_before_setting_up_logging(monkeypatch, capsys):
+    setup_calls = []
+    monkeypatch.setattr(inverted_index, "setup_logging", lambda: setup_calls.append(True))
+    monkeypatch.setattr(sys, "argv", ["inverted-index", "no_such_command"])
+    with pytest.raises(SystemExit):
+        inverted_index.main()
+    assert setup_calls == []
+    assert "invalid choice" in capsys.readouterr().err
+
+
+@pytest.fixture()
+def default_index_fio(tmpdir):
+    index_fio = tmpdir.join(DEFAULT_INVERTED_INDEX_SAVE_PATH)
+    process_build(DATASET_SMALL_FPATH, index_fio)
+    return index_fio
+
+
+def test_process_queries_can_process_queries_from_provided_file(default_index_fio, capsys,
+                                                                caplog):
     with caplog.at_level("DEBUG"):
         with open("queries-utf8.txt") as queries_fin:
             process_queries(
-                inverted_index_filepath=DEFAULT_INVERTED_INDEX_SAVE_PATH,
+                inverted_index_filepath=default_index_fio,
                 query_file=queries_fin,
             )
             captured = capsys.readouterr()
@@ -228,10 +318,10 @@ def test_process_queries_can_process_queries_from_provided_file(capsys, caplog):
             )
 
 
-def test_callback_query_can_process_queries_from_provided_file():
+def test_callback_query_can_process_queries_from_provided_file(default_index_fio):
     with open("queries-utf8.txt") as queries_fin:
         query_arguments = Namespace(
-            inverted_index_filepath=DEFAULT_INVERTED_INDEX_SAVE_PATH,
+            inverted_index_filepath=default_index_fio,
             query_file=queries_fin,
         )
         callback_query(query_arguments)
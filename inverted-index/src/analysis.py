@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+"""
+Text analysis shared by index build and query.
+
+An analyzer turns text into index terms: a tokenizer splits it, then
+tokens are lowercased, stop words are dropped and an optional stemmer
+reduces them. Queries have to be analyzed the same way as documents,
+so the analyzer name is stored next to the index file and loaded with it.
+
+Available analyzers:
+    whitespace: split on whitespace and keep tokens as is (the default).
+    standard: runs of word characters, lowercased, English stop words dropped.
+    english: standard followed by a plural stemmer.
+
+Use analyze_documents to analyze (doc id, text) pairs in batches and
+run this module to measure tokenization throughput on a dataset.
+"""
+
+from argparse import ArgumentDefaultsHelpFormatter
+from argparse import ArgumentParser
+from functools import lru_cache
+from itertools import islice
+import os
+import re
+import time
+
+ANALYZER_FILE_SUFFIX = ".analyzer"
+ANALYZER_NAMES = ("english", "standard", "whitespace")
+DEFAULT_ANALYZER_NAME = "whitespace"
+DEFAULT_ANALYSIS_BATCH_SIZE = 256
+DEFAULT_STOPWORDS_PATH = "../resources/stop_words_en.txt"
+STEMMER_CACHE_SIZE = 2 ** 16
+WORD_PATTERN = re.compile(r"\w+")
+WHITESPACE_TOKEN_PATTERN = re.compile(r"\S+")
+
+
+def load_stop_words(filepath: str = DEFAULT_STOPWORDS_PATH) -> frozenset:
+    """Load stop words from file, one per line"""
+    if not os.path.isabs(filepath) and not os.path.exists(filepath):
+        filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), filepath)
+    with open(filepath, "r", encoding="utf-8") as fin:
+        return frozenset(line.strip().lower() for line in fin if line.strip())
+
+
+@lru_cache(maxsize=STEMMER_CACHE_SIZE)
+def stem_plural(term: str) -> str:
+    """Return term without English plural ending, Harman's S-stemmer
+
+    Stemming a stemmed term changes nothing.
+    """
+    if term.endswith("ies") and len(term) > 3 and not term.endswith(("eies", "aies")):
+        return term[:-3] + "y"
+    if term.endswith("es") and len(term) > 2 and not term.endswith(("aes", "ees", "oes")):
+        return term[:-1]
+    if term.endswith("s") and len(term) > 1 and not term.endswith(("us", "ss")):
+        return term[:-1]
+    return term
+
+
+class Analyzer:
+    """Chain of a tokenizer and token filters turning text into terms
+
+    token_pattern selects tokens with a precompiled regular expression,
+    without it text is split on whitespace.
+    """
+    def __init__(self, name: str, token_pattern=None, lowercase: bool = False,
+                 stop_words: frozenset = frozenset(), stemmer=None):
+        self.name = name
+        self.token_pattern = token_pattern
+        self.lowercase = lowercase
+        self.stop_words = frozenset(stop_words)
+        self.stemmer = stemmer
+        self._tokenize = token_pattern.findall if token_pattern is not None else str.split
+
+    @property
+    def keeps_terms(self) -> bool:
+        """Whether a single whitespace-free term is analyzed into itself"""
+        return (self.token_pattern is None and not self.lowercase
+                and not self.stop_words and self.stemmer is None)
+
+    def analyze_batch(self, texts) -> list:
+        """Return lists of terms of the texts, in the same order"""
+        tokenize, lowercase = self._tokenize, self.lowercase
+        stop_words, stemmer = self.stop_words, self.stemmer
+        result = []
+        for text in texts:
+            tokens = tokenize(text.lower() if lowercase else text)
+            if stop_words:
+                tokens = [token for token in tokens if token not in stop_words]
+            if stemmer is not None:
+                tokens = list(map(stemmer, tokens))
+            result.append(tokens)
+        return result
+
+    def analyze(self, text: str) -> list:
+        """Return terms of the text"""
+        return self.analyze_batch((text,))[0]
+
+    def analyze_spans(self, text: str):
+        """Yield (start, end, term) for the tokens of the text kept as terms"""
+        for match in (self.token_pattern or WHITESPACE_TOKEN_PATTERN).finditer(text):
+            token = match.group().lower() if self.lowercase else match.group()
+            if token in self.stop_words:
+                continue
+            yield match.start(), match.end(), self.stemmer(token) if self.stemmer else token
+
+    def normalize(self, term: str) -> str:
+        """Return term fragment (a prefix or a range bound) as stored in the index"""
+        return term.lower() if self.lowercase else term
+
+    def __repr__(self):
+        return f"Analyzer({self.name!r})"
+
+
+def _make_analyzer(name: str) -> Analyzer:
+    if name == "whitespace":
+        return Analyzer(name)
+    if name == "standard":
+        return Analyzer(name, WORD_PATTERN, lowercase=True, stop_words=load_stop_words())
+    if name == "english":
+        return Analyzer(name, WORD_PATTERN, lowercase=True, stop_words=load_stop_words(),
+                        stemmer=stem_plural)
+    raise ValueError(f"Unknown analyzer {name!r}.")
+
+
+@lru_cache(maxsize=None)
+def get_analyzer(name: str = DEFAULT_ANALYZER_NAME) -> Analyzer:
+    """Return the shared analyzer with the given name"""
+    return _make_analyzer(name)
+
+
+def analyze_documents(analyzer: Analyzer, documents,
+                      batch_size: int = DEFAULT_ANALYSIS_BATCH_SIZE):
+    """Yield (doc id, terms) for (doc id, text) pairs, batch_size documents at a time"""
+    documents = iter(documents)
+    while True:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            break
+        doc_ids, texts = zip(*batch)
+        yield from zip(doc_ids, analyzer.analyze_batch(texts))
+
+
+def dump_analyzer(analyzer: Analyzer, inverted_index_filepath: str, explicit: bool = False):
+    """Store analyzer name next to the index
+
+    Nothing is stored for the default one, unless explicit is set.
+    """
+    filepath = f"{inverted_index_filepath}{ANALYZER_FILE_SUFFIX}"
+    if analyzer is None and explicit:
+        analyzer = get_analyzer(DEFAULT_ANALYZER_NAME)
+    if analyzer is None or (analyzer.name == DEFAULT_ANALYZER_NAME and not explicit):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        return
+    with open(f"{filepath}.tmp", "w") as fout:
+        fout.write(f"{analyzer.name}\n")
+    os.replace(f"{filepath}.tmp", filepath)
+
+
+def load_analyzer(inverted_index_filepath: str) -> Analyzer:
+    """Return analyzer the index was built with"""
+    filepath = f"{inverted_index_filepath}{ANALYZER_FILE_SUFFIX}"
+    if not os.path.exists(filepath):
+        return get_analyzer(DEFAULT_ANALYZER_NAME)
+    with open(filepath, "r") as fin:
+        return get_analyzer(fin.read().strip())
+
+
+def benchmark_analyzer(analyzer: Analyzer, texts: list,
+                       batch_size: int = DEFAULT_ANALYSIS_BATCH_SIZE) -> dict:
+    """Analyze texts and return throughput statistics"""
+    start = time.perf_counter()
+    tokens_count = sum(
+        len(terms) for _, terms in analyze_documents(analyzer, enumerate(texts), batch_size)
+    )
+    seconds = time.perf_counter() - start
+    return {
+        "analyzer": analyzer.name,
+        "documents": len(texts),
+        "tokens": tokens_count,
+        "megabytes": sum(map(len, texts)) / 2 ** 20,
+        "seconds": seconds,
+        "tokens_per_second": tokens_count / seconds if seconds else float("inf"),
+    }
+
+
+def main():
+    """Print tokenization throughput of the analyzers on a dataset"""
+    from inverted_index import DEFAULT_DATASET_PATH
+    from inverted_index import iter_documents
+
+    parser = ArgumentParser(
+        prog="analysis",
+        description="Tokenization throughput benchmark",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-d", "--dataset", default=DEFAULT_DATASET_PATH,
+                        dest="dataset_filepath", help="path to dataset to analyze")
+    parser.add_argument("-a", "--analyzer", action="append", choices=ANALYZER_NAMES,
+                        help="analyzer to measure, all of them by default")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_ANALYSIS_BATCH_SIZE,
+                        help="number of documents analyzed together")
+    arguments = parser.parse_args()
+    texts = [text for _, text in iter_documents(arguments.dataset_filepath)]
+    for name in arguments.analyzer or ANALYZER_NAMES:
+        statistics = benchmark_analyzer(get_analyzer(name), texts, arguments.batch_size)
+        print(f"{statistics['analyzer']}: {statistics['tokens']} tokens in "
+              f"{statistics['seconds']:.3f} s, "
+              f"{statistics['tokens_per_second'] / 1e6:.2f}M tokens/s, "
+              f"{statistics['megabytes'] / statistics['seconds']:.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Batch query engine for replaying large query logs.
+
+Queries are read in batches. Within a batch identical queries are
+evaluated once, and intersections of term pairs shared by several
+conjunctive queries are computed once and kept in an LRU cache. Batches
+may be spread over worker processes, each of them maps the same index
+file, so index pages are shared through the OS page cache. Results are
+written in input order through a single buffered writer.
+"""
+
+from collections import Counter
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+from itertools import islice
+from itertools import repeat
+
+from query_engine import intersect_all
+from query_language import QuerySyntaxError
+from query_language import conjunctive_terms
+from query_language import fuzzy_query
+from query_language import parse_query
+
+DEFAULT_BATCH_SIZE = 1024
+DEFAULT_PAIR_CACHE_SIZE = 4096
+MIN_PAIR_FREQUENCY = 2
+
+_worker_index = None
+_worker_pair_cache = None
+
+
+class PairIntersectionCache:
+    """LRU cache of sorted doc ids matching both terms of a pair"""
+    def __init__(self, max_size: int = DEFAULT_PAIR_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, inverted_index, pair: tuple) -> list:
+        """Return intersection of the pair, computing it on a miss"""
+        if pair in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(pair)
+            return self._entries[pair]
+        self.misses += 1
+        result = inverted_index._query_terms(list(pair))
+        self._entries[pair] = result
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return result
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def evaluate_batch(inverted_index, queries: list, pair_cache: PairIntersectionCache,
+                   top_k: int = None, max_edits: int = 0) -> list:
+    """Return results for the queries, in the same order
+
+    Results are lists of doc ids, sorted for boolean queries and
+    best first for ranked ones. With max_edits set terms of boolean
+    queries match fuzzily. Malformed boolean queries have no results.
+    """
+    unique_queries = list(dict.fromkeys(query.strip() for query in queries))
+    results = {}
+    if top_k is not None:
+        for query in unique_queries:
+            results[query] = [doc_id for doc_id, _ in inverted_index.rank(query.split(), top_k)]
+        return [results[query.strip()] for query in queries]
+
+    parsed_queries = {}
+    for query in unique_queries:
+        if not query:
+            continue
+        try:
+            parsed_queries[query] = parse_query(query, inverted_index.analyzer)
+        except QuerySyntaxError:
+            continue
+    if max_edits:
+        parsed_queries = {
+            query: fuzzy_query(tree, max_edits) for query, tree in parsed_queries.items()
+        }
+    terms_by_query = {query: conjunctive_terms(tree) for query, tree in parsed_queries.items()}
+    pair_frequencies = Counter(
+        pair
+        for terms in terms_by_query.values() if terms
+        for pair in combinations(terms, 2)
+    )
+    for query, tree in parsed_queries.items():
+        terms = terms_by_query[query]
+        if terms is None:
+            try:
+                results[query] = inverted_index.evaluate(tree)
+            except QuerySyntaxError:
+                pass
+            continue
+        postings_lists = []
+        for term in terms:
+            postings = inverted_index.get_postings(term)
+            if postings is None:
+                postings_lists = []
+                break
+            postings_lists.append(postings)
+        if not postings_lists:
+            results[query] = []
+            continue
+        frequent_pairs = [
+            pair for pair in combinations(terms, 2)
+            if pair_frequencies[pair] >= MIN_PAIR_FREQUENCY
+        ]
+        if frequent_pairs:
+            pair = max(frequent_pairs, key=lambda pair: pair_frequencies[pair])
+            rest = [
+                postings for term, postings in zip(terms, postings_lists) if term not in pair
+            ]
+            postings_lists = [pair_cache.get(inverted_index, pair)] + rest
+        results[query] = intersect_all(postings_lists)
+    return [results.get(query.strip(), []) for query in queries]
+
+
+def format_results(results: list) -> str:
+    """Return output lines for a batch of results"""
+    return "".join(",".join(map(str, result)) + "\n" for result in results)
+
+
+def _init_worker(inverted_index_filepath: str, storage_policy):
+    """Load the index once per worker process"""
+    from inverted_index import load_index
+
+    global _worker_index, _worker_pair_cache
+    _worker_index = load_index(inverted_index_filepath, storage_policy=storage_policy)
+    _worker_pair_cache = PairIntersectionCache()
+
+
+def _evaluate_batch_in_worker(queries: list, top_k: int = None, max_edits: int = 0) -> str:
+    """Evaluate a batch against the worker index and format the output"""
+    return format_results(
+        evaluate_batch(_worker_index, queries, _worker_pair_cache, top_k, max_edits)
+    )
+
+
+def iter_batches(query_file, batch_size: int):
+    """Yield lists of up to batch_size query lines, blank ones included to keep output aligned"""
+    queries = iter(query_file)
+    while True:
+        batch = list(islice(queries, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def run_batch_queries(inverted_index_filepath: str, query_file, output,
+                      storage_policy=None, workers: int = 1,
+                      batch_size: int = DEFAULT_BATCH_SIZE, top_k: int = None,
+                      max_edits: int = 0):
+    """Evaluate all queries of the file and write results to output in order"""
+    batches = iter_batches(query_file, batch_size)
+    if workers > 1:
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker,
+                initargs=(inverted_index_filepath, storage_policy)) as executor:
+            for lines in executor.map(_evaluate_batch_in_worker, batches,
+                                      repeat(top_k), repeat(max_edits)):
+                output.write(lines)
+    else:
+        _init_worker(inverted_index_filepath, storage_policy)
+        for batch in batches:
+            output.write(_evaluate_batch_in_worker(batch, top_k, max_edits))
+    output.flush()
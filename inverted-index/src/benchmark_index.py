@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks of inverted index build, dump, load and query.
+
+Synthetic corpora are generated from a seeded random generator: term
+ranks follow a Zipf distribution whose exponent sets the vocabulary skew,
+so runs with the same parameters index exactly the same documents.
+
+The index is built and dumped in every storage format in one process,
+then each format is loaded and queried in a fresh process, so load times
+and memory are not affected by what was done before. Every measurement
+holds the elapsed time, throughput and peak RSS of its stage. Results
+are saved as JSON, two result files can be compared and throughput drops
+or memory growth beyond a threshold are reported as regressions.
+"""
+
+from argparse import ArgumentDefaultsHelpFormatter
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import string
+import sys
+from tempfile import TemporaryDirectory
+import time
+
+from inverted_index import InvertedIndex
+from inverted_index import build_inverted_index
+from inverted_index import load_documents
+from storage_policy import STORAGE_POLICIES
+
+BENCHMARK_FORMAT_VERSION = 1
+DEFAULT_DOCUMENTS_COUNT = 10_000
+DEFAULT_VOCABULARY_SIZE = 50_000
+DEFAULT_ZIPF_EXPONENT = 1.0
+DEFAULT_DOCUMENT_LENGTH = 100
+DEFAULT_QUERIES_COUNT = 1000
+DEFAULT_MAX_QUERY_TERMS = 3
+DEFAULT_REPEAT = 3
+DEFAULT_SEED = 42
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+PROC_STATUS_FILEPATH = "/proc/self/status"
+PROC_CLEAR_REFS_FILEPATH = "/proc/self/clear_refs"
+RESET_PEAK_RSS = "5"
+
+
+def make_vocabulary(size: int) -> list:
+    """Return size distinct lowercase words, shorter words first"""
+    letters = string.ascii_lowercase
+    words = []
+    for rank in range(size):
+        word = ""
+        rank += 1
+        while rank:
+            rank, letter = divmod(rank - 1, len(letters))
+            word = letters[letter] + word
+        words.append(word)
+    return words
+
+
+def zipf_cumulative_weights(size: int, exponent: float) -> list:
+    """Return cumulative weights of ranks 1 to size, weight of rank r is 1 / r ** exponent"""
+    return list(accumulate(1 / rank ** exponent for rank in range(1, size + 1)))
+
+
+def generate_corpus(documents_count: int = DEFAULT_DOCUMENTS_COUNT,
+                    vocabulary_size: int = DEFAULT_VOCABULARY_SIZE,
+                    zipf_exponent: float = DEFAULT_ZIPF_EXPONENT,
+                    document_length: int = DEFAULT_DOCUMENT_LENGTH,
+                    seed: int = DEFAULT_SEED) -> dict:
+    """Return doc id to document mapping of Zipf distributed words
+
+    Document lengths are uniform between half and one and a half of
+    document_length.
+    """
+    generator = random.Random(seed)
+    vocabulary = make_vocabulary(vocabulary_size)
+    cumulative_weights = zipf_cumulative_weights(vocabulary_size, zipf_exponent)
+    documents = {}
+    for doc_id in range(1, documents_count + 1):
+        length = generator.randint(max(1, document_length // 2), document_length * 3 // 2)
+        documents[doc_id] = " ".join(
+            generator.choices(vocabulary, cum_weights=cumulative_weights, k=length)
+        )
+    return documents
+
+
+def generate_queries(queries_count: int = DEFAULT_QUERIES_COUNT,
+                     vocabulary_size: int = DEFAULT_VOCABULARY_SIZE,
+                     zipf_exponent: float = DEFAULT_ZIPF_EXPONENT,
+                     max_query_terms: int = DEFAULT_MAX_QUERY_TERMS,
+                     seed: int = DEFAULT_SEED) -> list:
+    """Return queries of 1 to max_query_terms words drawn from the corpus distribution"""
+    generator = random.Random(seed + 1)
+    vocabulary = make_vocabulary(vocabulary_size)
+    cumulative_weights = zipf_cumulative_weights(vocabulary_size, zipf_exponent)
+    return [
+        generator.choices(vocabulary, cum_weights=cumulative_weights,
+                          k=generator.randint(1, max_query_terms))
+        for _ in range(queries_count)
+    ]
+
+
+def write_corpus(documents: dict, filepath: str):
+    """Write documents in the dataset format, one doc id, tab and text per line"""
+    with open(filepath, "w", encoding="utf-8") as fout:
+        for doc_id, document in documents.items():
+            fout.write(f"{doc_id}\t{document}\n")
+
+
+def current_rss() -> int:
+    """Return resident set size of the process in bytes, 0 where it is not known"""
+    return _read_status_field("VmRSS:")
+
+
+def peak_rss() -> int:
+    """Return peak resident set size of the process in bytes since the last reset"""
+    peak = _read_status_field("VmHWM:")
+    if peak:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss() -> bool:
+    """Start tracking peak RSS from the current RSS, return whether it is supported
+
+    Without support the peak covers the whole life of the process.
+    """
+    try:
+        with open(PROC_CLEAR_REFS_FILEPATH, "w") as fout:
+            fout.write(RESET_PEAK_RSS)
+    except OSError:
+        return False
+    return True
+
+
+def _read_status_field(name: str) -> int:
+    """Return memory size field of the process status in bytes, 0 if it is absent"""
+    try:
+        with open(PROC_STATUS_FILEPATH) as fin:
+            for line in fin:
+                if line.startswith(name):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def measure(stage: str, storage_format, function, items, unit: str) -> tuple:
+    """Run the function and return its result and the measurement of the stage
+
+    Items is the number of items processed by the stage, or a function
+    counting them in the result.
+    """
+    reset_peak_rss()
+    rss_before = current_rss()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    peak = peak_rss()
+    if callable(items):
+        items = items(result)
+    measurement = {
+        "stage": stage,
+        "format": storage_format,
+        "seconds": seconds,
+        "items": items,
+        "unit": unit,
+        "items_per_second": items / seconds if seconds else 0.0,
+        "peak_rss_bytes": peak,
+        "rss_growth_bytes": max(0, peak - rss_before) if rss_before else 0,
+    }
+    return result, measurement
+
+
+def benchmark_build_and_dump(dataset_filepath: str, index_dirpath: str,
+                             storage_formats: list) -> list:
+    """Build the index of the dataset and dump it in every format, return measurements"""
+    documents = load_documents(dataset_filepath)
+    inverted_index, build_measurement = measure(
+        "build", None, lambda: build_inverted_index(documents),
+        len(documents), "documents",
+    )
+    postings_count = sum(len(docs) for docs in inverted_index.inverted_index.values())
+    measurements = [build_measurement]
+    for storage_format in storage_formats:
+        index_filepath = os.path.join(index_dirpath, f"{storage_format}.index")
+        _, measurement = measure(
+            "dump", storage_format,
+            lambda: inverted_index.dump(index_filepath, STORAGE_POLICIES[storage_format]),
+            postings_count, "postings",
+        )
+        measurement["file_bytes"] = os.path.getsize(index_filepath)
+        measurements.append(measurement)
+    documents.close()
+    return measurements
+
+
+def benchmark_load_and_query(index_filepath: str, storage_format: str, queries: list,
+                             repeat: int = DEFAULT_REPEAT) -> list:
+    """Load the index and run the queries, return measurements of the best of repeat passes"""
+    inverted_index, load_measurement = measure(
+        "load", storage_format,
+        lambda: InvertedIndex.load(index_filepath, STORAGE_POLICIES[storage_format]),
+        lambda inverted_index: len(inverted_index.inverted_index), "terms",
+    )
+    best = None
+    for _ in range(repeat):
+        _, measurement = measure(
+            "query", storage_format,
+            lambda: [inverted_index.query(words) for words in queries],
+            len(queries), "queries",
+        )
+        if best is None or measurement["seconds"] < best["seconds"]:
+            best = measurement
+    return [load_measurement, best]
+
+
+def run_benchmark(documents_count: int = DEFAULT_DOCUMENTS_COUNT,
+                  vocabulary_size: int = DEFAULT_VOCABULARY_SIZE,
+                  zipf_exponent: float = DEFAULT_ZIPF_EXPONENT,
+                  document_length: int = DEFAULT_DOCUMENT_LENGTH,
+                  queries_count: int = DEFAULT_QUERIES_COUNT,
+                  storage_formats: list = None, repeat: int = DEFAULT_REPEAT,
+                  seed: int = DEFAULT_SEED) -> dict:
+    """Run all stages on a synthetic corpus and return the benchmark results"""
+    storage_formats = sorted(storage_formats or STORAGE_POLICIES)
+    config = {
+        "documents_count": documents_count,
+        "vocabulary_size": vocabulary_size,
+        "zipf_exponent": zipf_exponent,
+        "document_length": document_length,
+        "queries_count": queries_count,
+        "storage_formats": storage_formats,
+        "repeat": repeat,
+        "seed": seed,
+    }
+    queries = generate_queries(queries_count, vocabulary_size, zipf_exponent, seed=seed)
+    spawn_context = multiprocessing.get_context("spawn")
+    with TemporaryDirectory() as tmp_dirpath:
+        dataset_filepath = os.path.join(tmp_dirpath, "dataset")
+        write_corpus(generate_corpus(documents_count, vocabulary_size, zipf_exponent,
+                                     document_length, seed), dataset_filepath)
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn_context) as executor:
+            measurements = executor.submit(benchmark_build_and_dump, dataset_filepath,
+                                           tmp_dirpath, storage_formats).result()
+        for storage_format in storage_formats:
+            index_filepath = os.path.join(tmp_dirpath, f"{storage_format}.index")
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn_context) as executor:
+                measurements += executor.submit(benchmark_load_and_query, index_filepath,
+                                                storage_format, queries, repeat).result()
+    return {
+        "version": BENCHMARK_FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": config,
+        "measurements": measurements,
+    }
+
+
+def dump_results(results: dict, filepath: str):
+    """Write benchmark results as JSON"""
+    with open(filepath, "w") as fout:
+        json.dump(results, fout, indent=2)
+        fout.write("\n")
+
+
+def load_results(filepath: str) -> dict:
+    """Read benchmark results written by dump_results"""
+    with open(filepath) as fin:
+        results = json.load(fin)
+    if results.get("version") != BENCHMARK_FORMAT_VERSION:
+        raise ValueError(f"{filepath} holds unsupported benchmark results version "
+                         f"{results.get('version')!r}.")
+    return results
+
+
+def compare_results(baseline: dict, current: dict,
+                    threshold: float = DEFAULT_REGRESSION_THRESHOLD) -> list:
+    """Return comparison rows of measurements present in both results
+
+    A row is (stage, format, metric, baseline value, current value, relative
+    change, whether it is a regression). Throughput dropping or peak RSS
+    growing by more than threshold is a regression.
+    """
+    baseline_measurements = {
+        (measurement["stage"], measurement["format"]): measurement
+        for measurement in baseline["measurements"]
+    }
+    rows = []
+    for measurement in current["measurements"]:
+        key = (measurement["stage"], measurement["format"])
+        if key not in baseline_measurements:
+            continue
+        for metric, higher_is_better in (("items_per_second", True),
+                                         ("peak_rss_bytes", False)):
+            old, new = baseline_measurements[key][metric], measurement[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            regression = -change > threshold if higher_is_better else change > threshold
+            rows.append((*key, metric, old, new, change, regression))
+    return rows
+
+
+def format_comparison(rows: list) -> str:
+    """Return comparison rows as a text table"""
+    lines = []
+    for stage, storage_format, metric, old, new, change, regression in rows:
+        lines.append(
+            f"{stage:<6} {storage_format or '-':<11} {metric:<17} "
+            f"{old:>16,.1f} {new:>16,.1f} {change:>+8.1%}"
+            + ("  REGRESSION" if regression else "")
+        )
+    return "\n".join(lines)
+
+
+def format_results(results: dict) -> str:
+    """Return measurements as a text table"""
+    lines = []
+    for measurement in results["measurements"]:
+        lines.append(
+            f"{measurement['stage']:<6} {measurement['format'] or '-':<11} "
+            f"{measurement['seconds']:>9.4f}s "
+            f"{measurement['items_per_second']:>14,.0f} {measurement['unit']}/s "
+            f"peak RSS {measurement['peak_rss_bytes'] / 2 ** 20:,.1f} MiB"
+        )
+    return "\n".join(lines)
+
+
+def callback_run(arguments):
+    """Run benchmark from CLI arguments"""
+    results = run_benchmark(arguments.documents, arguments.vocabulary, arguments.zipf_exponent,
+                            arguments.document_length, arguments.queries,
+                            arguments.storage_formats, arguments.repeat, arguments.seed)
+    print(format_results(results))
+    if arguments.output is not None:
+        dump_results(results, arguments.output)
+    if arguments.baseline is not None:
+        return report_comparison(load_results(arguments.baseline), results, arguments.threshold)
+    return 0
+
+
+def callback_compare(arguments):
+    """Compare benchmark result files from CLI arguments"""
+    return report_comparison(load_results(arguments.baseline), load_results(arguments.current),
+                             arguments.threshold)
+
+
+def report_comparison(baseline: dict, current: dict, threshold: float) -> int:
+    """Print comparison of the results, return 1 if there are regressions and 0 otherwise"""
+    if baseline["config"] != current["config"]:
+        print("Warning: benchmark configs differ, results may not be comparable.",
+              file=sys.stderr)
+    rows = compare_results(baseline, current, threshold)
+    print(format_comparison(rows))
+    regressions = sum(row[-1] for row in rows)
+    if regressions:
+        print(f"{regressions} regression(s) beyond {threshold:.0%}.", file=sys.stderr)
+        return 1
+    return 0
+
+
+def setup_parser(parser):
+    """Setup CLI arguments parser"""
+    subparsers = parser.add_subparsers(help="choose command")
+
+    run_parser = subparsers.add_parser(
+        "run",
+        help="run benchmark on a synthetic corpus",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    run_parser.add_argument("-n", "--documents", type=int, default=DEFAULT_DOCUMENTS_COUNT,
+                            help="number of documents in the corpus")
+    run_parser.add_argument("-v", "--vocabulary", type=int, default=DEFAULT_VOCABULARY_SIZE,
+                            help="number of distinct words in the corpus")
+    run_parser.add_argument("-s", "--zipf-exponent", type=float, default=DEFAULT_ZIPF_EXPONENT,
+                            help="vocabulary skew, weight of the word of rank r is 1 / r ** s")
+    run_parser.add_argument("-l", "--document-length", type=int,
+                            default=DEFAULT_DOCUMENT_LENGTH,
+                            help="average number of words in a document")
+    run_parser.add_argument("-q", "--queries", type=int, default=DEFAULT_QUERIES_COUNT,
+                            help="number of queries")
+    run_parser.add_argument("-f", "--format", action="append", dest="storage_formats",
+                            choices=sorted(STORAGE_POLICIES),
+                            help="storage format to benchmark, may be repeated, all by default")
+    run_parser.add_argument("-r", "--repeat", type=int, default=DEFAULT_REPEAT,
+                            help="number of query passes, the best one is reported")
+    run_parser.add_argument("--seed", type=int, default=DEFAULT_SEED,
+                            help="seed of the corpus and query generator")
+    run_parser.add_argument("-o", "--output", metavar="PATH",
+                            help="path to save results as JSON")
+    run_parser.add_argument("-b", "--baseline", metavar="PATH",
+                            help="results JSON to compare with")
+    run_parser.add_argument("-t", "--threshold", type=float,
+                            default=DEFAULT_REGRESSION_THRESHOLD,
+                            help="relative change reported as a regression")
+    run_parser.set_defaults(callback=callback_run)
+
+    compare_parser = subparsers.add_parser(
+        "compare",
+        help="compare two results JSON files",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    compare_parser.add_argument("baseline", help="path to baseline results JSON")
+    compare_parser.add_argument("current", help="path to current results JSON")
+    compare_parser.add_argument("-t", "--threshold", type=float,
+                                default=DEFAULT_REGRESSION_THRESHOLD,
+                                help="relative change reported as a regression")
+    compare_parser.set_defaults(callback=callback_compare)
+
+
+def main():
+    """Main module function"""
+    parser = ArgumentParser(
+        prog="benchmark_index",
+        description="Benchmarks of inverted index build, dump, load and query.",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    setup_parser(parser)
+    arguments = parser.parse_args()
+    sys.exit(arguments.callback(arguments))
+
+
+if __name__ == "__main__":
+    main()
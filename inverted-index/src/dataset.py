@@ -0,0 +1,101 @@
+"""
+Memory-mapped dataset reader.
+
+A dataset holds one document per line: a doc id, a tab and the text.
+MappedDataset maps the file into memory and keeps only an offset index,
+doc id to the byte range of the document text. Documents are handed out
+as memoryview slices of the mapping, or decoded one at a time on access,
+so the corpus is never held in memory as Python strings all at once.
+"""
+
+from array import array
+from collections.abc import Mapping
+import mmap
+import os
+
+TRAILING_WHITESPACE = b" \t\n\r\x0b\x0c"
+
+
+class MappedDataset(Mapping):
+    """Read-only mapping of doc id to document text backed by the mapped dataset file
+
+    Only lines starting in the byte range [start, end) are indexed, so
+    worker processes can each read their own part of the file. Memoryview
+    slices are valid until the dataset is closed, and have to be released
+    before that.
+    """
+    def __init__(self, filepath: str, start: int = 0, end: int = None):
+        with open(filepath, "rb") as fin:
+            size = os.fstat(fin.fileno()).st_size
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._buffer = memoryview(self._mmap if self._mmap is not None else b"")
+        self._rows = {}
+        self._starts = array("Q")
+        self._ends = array("Q")
+        self._build_offsets(start, size if end is None else min(end, size))
+
+    def _build_offsets(self, position: int, end: int):
+        """Index document text ranges of the lines starting before end"""
+        data = self._mmap
+        size = len(self._buffer)
+        while position < end:
+            line_end = data.find(b"\n", position)
+            if line_end < 0:
+                line_end = size
+            tab = data.find(b"\t", position, line_end)
+            if tab >= 0:
+                text_end = line_end
+                while text_end > tab + 1 and data[text_end - 1] in TRAILING_WHITESPACE:
+                    text_end -= 1
+                doc_id = int(data[position:tab])
+                row = self._rows.get(doc_id)
+                if row is None:
+                    self._rows[doc_id] = len(self._starts)
+                    self._starts.append(tab + 1)
+                    self._ends.append(text_end)
+                else:
+                    self._starts[row], self._ends[row] = tab + 1, text_end
+            elif data[position:line_end].strip():
+                raise ValueError(f"Malformed dataset line at byte {position}.")
+            position = line_end + 1
+
+    def byte_range(self, doc_id: int) -> tuple:
+        """Return (start, end) offsets of the document text in the file"""
+        row = self._rows[doc_id]
+        return self._starts[row], self._ends[row]
+
+    def view(self, doc_id: int) -> memoryview:
+        """Return UTF-8 document text as a slice of the mapping, without copying"""
+        start, end = self.byte_range(doc_id)
+        return self._buffer[start:end]
+
+    def iter_views(self):
+        """Yield (doc id, memoryview) pairs in file order"""
+        buffer, starts, ends = self._buffer, self._starts, self._ends
+        for doc_id, row in self._rows.items():
+            yield doc_id, buffer[starts[row]:ends[row]]
+
+    def __getitem__(self, doc_id) -> str:
+        start, end = self.byte_range(doc_id)
+        return str(self._buffer[start:end], "utf-8")
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._rows
+
+    def close(self):
+        """Unmap the file"""
+        self._buffer.release()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
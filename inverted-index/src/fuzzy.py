@@ -0,0 +1,124 @@
+"""
+Fuzzy term matching over sorted term dictionaries.
+
+A Levenshtein automaton for the query term is run over the sorted terms
+of the dictionary. States of the prefix shared with the previous term
+are reused, and as soon as a prefix can not match any more, the walk
+seeks past every term the automaton would reject for the same reason.
+Only a small neighbourhood of the query term is ever decoded, regardless
+of the dictionary size.
+"""
+
+from bisect import bisect_right
+
+from term_dictionary import prefix_successor
+
+DEFAULT_MAX_EDITS = 1
+MAX_EDITS_LIMIT = 2
+
+
+class LevenshteinAutomaton:
+    """Edit distance automaton accepting strings within max_edits of the term
+
+    The nondeterministic automaton is simulated bit-parallel: a state holds
+    one bitmask per number of edits d, bit i of the d-th mask is set when
+    the consumed string is within d edits of the first i characters of the
+    term. Consuming a character takes a few integer operations per mask.
+    """
+    def __init__(self, term: str, max_edits: int):
+        self.term = term
+        self.max_edits = max_edits
+        self.term_chars = sorted(set(term))
+        self._char_masks = {}
+        for position, char in enumerate(term):
+            self._char_masks[char] = self._char_masks.get(char, 0) | (2 << position)
+        self._all_bits = (2 << len(term)) - 1
+        self._accept_bit = 1 << len(term)
+
+    def start(self) -> tuple:
+        """Return the state before any character was consumed"""
+        return tuple((2 << edits) - 1 & self._all_bits for edits in range(self.max_edits + 1))
+
+    def step(self, state: tuple, char: str) -> tuple:
+        """Return the state after consuming char"""
+        char_mask = self._char_masks.get(char, 0)
+        previous = state[0]
+        current = (previous << 1) & char_mask
+        next_state = [current]
+        for masks in state[1:]:
+            current = (
+                (masks << 1) & char_mask | previous << 1 | previous | current << 1
+            ) & self._all_bits
+            next_state.append(current)
+            previous = masks
+        return tuple(next_state)
+
+    def is_match(self, state: tuple) -> bool:
+        """Whether the consumed string is within max_edits of the term"""
+        return bool(state[-1] & self._accept_bit)
+
+    def can_match(self, state: tuple) -> bool:
+        """Whether some continuation of the consumed string may match"""
+        return bool(state[-1])
+
+    def next_candidate(self, dead_prefix: str):
+        """Return the smallest UTF-8 string after dead_prefix worth visiting, None if there is none
+
+        Characters absent from the term all lead to the same state, which
+        is never better than the state after any character of the term.
+        So once dead_prefix can not match, neither can any string with its
+        last character replaced by a greater one absent from the term.
+        """
+        prefix, char = dead_prefix[:-1], dead_prefix[-1]
+        index = bisect_right(self.term_chars, char)
+        if index < len(self.term_chars):
+            return (prefix + self.term_chars[index]).encode("utf-8")
+        return prefix_successor(prefix.encode("utf-8")) if prefix else None
+
+
+def _common_prefix_length(term: str, other: str) -> int:
+    length = 0
+    limit = min(len(term), len(other))
+    while length < limit and term[length] == other[length]:
+        length += 1
+    return length
+
+
+def fuzzy_terms(term_dictionary, term: str, max_edits: int = DEFAULT_MAX_EDITS,
+                prefix_length: int = 0) -> list:
+    """Return sorted dictionary terms within max_edits of term
+
+    term_dictionary is a TermDictionary over UTF-8 bytes. With prefix_length
+    set, matches have to share that many leading characters with the term,
+    which narrows the walk to a single prefix range.
+    """
+    if not 0 <= max_edits <= MAX_EDITS_LIMIT:
+        raise ValueError(f"Fuzzy matching supports up to {MAX_EDITS_LIMIT} edits.")
+    automaton = LevenshteinAutomaton(term, max_edits)
+    required_prefix = term[:prefix_length]
+    positions = term_dictionary.prefix_range(required_prefix.encode("utf-8"))
+    position, end = positions.start, positions.stop
+    states = [automaton.start()]
+    previous = ""
+    result = []
+    while position < end:
+        candidate = term_dictionary.term_at(position).decode("utf-8")
+        shared = min(_common_prefix_length(previous, candidate), len(states) - 1)
+        del states[shared + 1:]
+        dead_prefix_length = None
+        for char in candidate[shared:]:
+            states.append(automaton.step(states[-1], char))
+            if not automaton.can_match(states[-1]):
+                dead_prefix_length = len(states) - 1
+                break
+        previous = candidate
+        if dead_prefix_length is None:
+            if automaton.is_match(states[-1]):
+                result.append(candidate)
+            position += 1
+            continue
+        successor = automaton.next_candidate(candidate[:dead_prefix_length])
+        if successor is None:
+            break
+        position = term_dictionary.seek(successor, position + 1, end)
+    return result
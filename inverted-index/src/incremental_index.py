@@ -0,0 +1,270 @@
+"""
+Updatable inverted index.
+
+The on-disk index is the main segment and is never modified in place.
+Added documents go to an in-memory delta segment, deleted ones are marked
+in the tombstone set of every older segment. Adding a document which is
+already indexed replaces it. A merge seals the delta, folds it into a new
+main index file in a background thread and swaps the result in, while
+updates and queries continue against the sealed segments.
+
+Every live document is stored in exactly one segment, so a query is
+evaluated on each segment independently, tombstoned documents are removed
+and the per-segment results are merged. Updates and queries hold a lock,
+so a query never sees half of an update.
+"""
+
+import os
+import threading
+
+from inverted_index import INDEX_SECTIONS
+from inverted_index import InvertedIndex
+from inverted_index import build_inverted_index
+from inverted_index import dump_postings_stream
+from inverted_index import merge_sorted_postings
+from inverted_index import write_index_files
+from query_engine import to_sorted_list
+from query_engine import union_all
+from query_language import And
+from query_language import Fuzzy
+from query_language import Term
+from query_language import parse_query
+from storage_policy import detect_storage_policy
+from storage_policy import read_header
+
+
+class TombstoneSet:
+    """Set of deleted doc ids
+
+    It is sparse, so that memory grows with the number of deletions and
+    not with the largest deleted doc id.
+    """
+    def __init__(self, doc_ids=()):
+        self._doc_ids = set(doc_ids)
+
+    def add(self, doc_id: int):
+        """Mark the document as deleted"""
+        self._doc_ids.add(doc_id)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._doc_ids
+
+    def __iter__(self):
+        return iter(sorted(self._doc_ids))
+
+    def __len__(self) -> int:
+        return len(self._doc_ids)
+
+    def copy(self):
+        """Return an independent copy"""
+        return TombstoneSet(self._doc_ids)
+
+    def union(self, other):
+        """Return documents deleted in either set"""
+        return TombstoneSet(self._doc_ids | other._doc_ids)
+
+    def difference(self, other):
+        """Return documents deleted here but not in the other set"""
+        return TombstoneSet(self._doc_ids - other._doc_ids)
+
+
+class DeltaSegment:
+    """In-memory segment for recently added documents
+
+    It keeps positions, term frequencies and document lengths, so it can
+    be merged into a main index holding any of these sections.
+    """
+    def __init__(self, analyzer=None):
+        self.index = InvertedIndex({}, positions={}, frequencies={}, document_lengths={},
+                                   analyzer=analyzer)
+        self.terms_by_document = {}
+
+    def add(self, doc_id: int, document: str):
+        """Index the document"""
+        document_index = build_inverted_index({doc_id: document}, positional=True, ranked=True,
+                                              analyzer=self.index.analyzer)
+        for term, docs in document_index.inverted_index.items():
+            self.index.inverted_index.setdefault(term, set()).update(docs)
+            self.index.positions.setdefault(term, {}).update(document_index.positions[term])
+            self.index.frequencies.setdefault(term, {}).update(document_index.frequencies[term])
+        self.index.document_lengths.update(document_index.document_lengths)
+        self.terms_by_document[doc_id] = set(document_index.inverted_index)
+        self.index.mark_updated()
+
+    def remove(self, doc_id: int):
+        """Drop the document if it is stored in the segment"""
+        for term in self.terms_by_document.pop(doc_id, ()):
+            for section in (self.index.inverted_index, self.index.positions,
+                            self.index.frequencies):
+                postings = section[term]
+                if isinstance(postings, set):
+                    postings.discard(doc_id)
+                else:
+                    del postings[doc_id]
+                if not postings:
+                    del section[term]
+        self.index.document_lengths.pop(doc_id, None)
+        self.index.mark_updated()
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self.terms_by_document
+
+    def __len__(self) -> int:
+        return len(self.terms_by_document)
+
+
+class UpdatableIndex:
+    """Inverted index file with in-memory updates and background merges"""
+    def __init__(self, inverted_index_filepath: str, storage_policy=None):
+        self.inverted_index_filepath = inverted_index_filepath
+        self.storage_policy = storage_policy or detect_storage_policy(inverted_index_filepath)
+        main = InvertedIndex.load(inverted_index_filepath, storage_policy=self.storage_policy)
+        self.analyzer = main.analyzer
+        self.delta = DeltaSegment(self.analyzer)
+        self.segments = [(main, TombstoneSet())]
+        self._lock = threading.RLock()
+        self._merge_lock = threading.Lock()
+
+    @property
+    def main(self) -> InvertedIndex:
+        """The on-disk segment"""
+        return self.segments[0][0]
+
+    def add_document(self, doc_id: int, document: str):
+        """Index a new document or replace an indexed one"""
+        with self._lock:
+            self._delete(doc_id)
+            self.delta.add(doc_id, document)
+
+    def delete_document(self, doc_id: int):
+        """Remove the document from query results"""
+        with self._lock:
+            self._delete(doc_id)
+
+    def _delete(self, doc_id: int):
+        self.delta.remove(doc_id)
+        for _, tombstones in self.segments:
+            tombstones.add(doc_id)
+
+    def evaluate(self, query) -> list:
+        """Return sorted list of documents matching the parsed query tree"""
+        with self._lock:
+            results = [
+                [doc_id for doc_id in query.evaluate(segment) if doc_id not in tombstones]
+                for segment, tombstones in self.segments
+            ]
+            results.append(query.evaluate(self.delta.index))
+        return union_all(results)
+
+    def search(self, query: str) -> list:
+        """Return sorted list of documents matching the boolean query string"""
+        return self.evaluate(parse_query(query, self.analyzer))
+
+    def query(self, words: list, max_edits: int = 0) -> list:
+        """Return sorted list of documents containing all the words, fuzzily with max_edits"""
+        if not self.analyzer.keeps_terms:
+            words = self.analyzer.analyze(" ".join(words))
+        terms = [
+            Fuzzy(word, max_edits) if max_edits else Term(word) for word in sorted(set(words))
+        ]
+        if not terms:
+            return []
+        return self.evaluate(terms[0] if len(terms) == 1 else And(terms))
+
+    def merge(self) -> bool:
+        """Fold pending updates into a new main index file, return whether there were any
+
+        Runs in the calling thread, updates and queries are served
+        meanwhile against the sealed segments.
+        """
+        with self._merge_lock:
+            with self._lock:
+                if not len(self.delta) and not any(len(t) for _, t in self.segments):
+                    return False
+                sealed = self.segments + [(self.delta.index, TombstoneSet())]
+                self.segments = sealed[:]
+                self.delta = DeltaSegment(self.analyzer)
+                snapshots = [tombstones.copy() for _, tombstones in sealed]
+            self._write_merged(sealed, snapshots)
+            merged = InvertedIndex.load(self.inverted_index_filepath,
+                                        storage_policy=self.storage_policy)
+            with self._lock:
+                tombstones = TombstoneSet()
+                for (_, current), snapshot in zip(sealed, snapshots):
+                    tombstones = tombstones.union(current.difference(snapshot))
+                self.segments = [(merged, tombstones)] + self.segments[len(sealed):]
+            return True
+
+    def merge_in_background(self) -> threading.Thread:
+        """Start a merge in a daemon thread and return it"""
+        thread = threading.Thread(target=self.merge, daemon=True)
+        thread.start()
+        return thread
+
+    def _write_merged(self, segments: list, tombstones: list):
+        """Write live documents of the segments to the index file and its sections"""
+        with open(self.inverted_index_filepath, "rb") as fin:
+            max_doc_id = (1 << 32) if read_header(fin).doc_id_width == 8 else 0
+        for segment, _ in segments[1:]:
+            max_doc_id = max(max_doc_id, max(segment.document_lengths, default=0))
+        main = segments[0][0]
+        write_merged_index([segment for segment, _ in segments], tombstones,
+                           self.inverted_index_filepath, self.storage_policy,
+                           [name for name in INDEX_SECTIONS if name in main.section_filepaths],
+                           max_doc_id)
+
+
+def write_merged_index(segments: list, tombstones: list, filepath: str, storage_policy,
+                       section_names: list, max_doc_id: int):
+    """Write live documents of the segments to the index file and the named sections
+
+    A live index at the path is replaced safely for its readers, see
+    write_index_files.
+    """
+    streams = [
+        live_postings(segment, deleted) for segment, deleted in zip(segments, tombstones)
+    ]
+    section_dumps = {
+        name: lambda section_filepath, name=name: INDEX_SECTIONS[name][1].dump(
+            live_section(name, segments, tombstones), section_filepath,
+        )
+        for name in section_names
+    }
+    write_index_files(filepath, lambda postings_filepath: dump_postings_stream(
+        merge_sorted_postings(streams), max_doc_id, postings_filepath, storage_policy,
+    ), section_dumps, segments[0].analyzer)
+
+
+def live_postings(segment: InvertedIndex, deleted: TombstoneSet):
+    """Yield (term, sorted doc ids) of the segment ordered by term, without deleted ones"""
+    for term in sorted(segment.inverted_index):
+        doc_ids = [
+            doc_id for doc_id in to_sorted_list(segment.inverted_index[term])
+            if doc_id not in deleted
+        ]
+        if doc_ids:
+            yield term, doc_ids
+
+
+def live_section(name: str, segments: list, tombstones: list) -> dict:
+    """Return merged section contents in the form accepted by its storage policy"""
+    merged = {}
+    for segment, deleted in zip(segments, tombstones):
+        if name == "document_lengths":
+            lengths = segment.get_section(name)
+            merged.update(
+                (doc_id, lengths[doc_id]) for doc_id in lengths if doc_id not in deleted
+            )
+            continue
+        for term in segment.inverted_index:
+            if name == "positions":
+                values = segment.get_positions(term)
+                values = {doc_id: values[doc_id] for doc_id in values}
+            else:
+                values = dict(zip(*segment.get_frequencies(term)[:2]))
+            values = {
+                doc_id: value for doc_id, value in values.items() if doc_id not in deleted
+            }
+            if values:
+                merged.setdefault(term, {}).update(values)
+    return merged
@@ -4,8 +4,9 @@
 InvertedIndex class provides functionality
 to build and query inverted index.
 
-Use load_documents to load a file into memory.
+Use load_documents to map a dataset file into memory.
 Use build_inverted_index to construct an InvertedIndex object.
+Use build_inverted_index_parallel to build it from a file in several processes.
 """
 
 from argparse import ArgumentDefaultsHelpFormatter
@@ -13,14 +14,175 @@ from argparse import ArgumentParser
 from argparse import ArgumentTypeError
 from argparse import FileType
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import heapq
 from io import TextIOWrapper
-# import re
+from itertools import count
+from itertools import groupby
+from operator import itemgetter
+import os
 import struct
+from tempfile import TemporaryDirectory
 import sys
+import time
+
+from analysis import ANALYZER_FILE_SUFFIX
+from analysis import ANALYZER_NAMES
+from analysis import DEFAULT_ANALYZER_NAME
+from analysis import DEFAULT_STOPWORDS_PATH
+from analysis import analyze_documents
+from analysis import dump_analyzer
+from analysis import get_analyzer
+from analysis import load_analyzer
+from batch_query import DEFAULT_BATCH_SIZE
+from batch_query import run_batch_queries
+from dataset import MappedDataset
+from fuzzy import MAX_EDITS_LIMIT
+from fuzzy import fuzzy_terms
+from metrics import DEFAULT_EXPORT_FORMAT
+from metrics import EXPORT_FORMATS
+from metrics import install_export
+from metrics import stage_metrics
+from posting_list import CompressedPostingList
+from ranking import BM25
+from roaring import RoaringBitmap
+from ranking import DEFAULT_TOP_K
+from ranking import TermCursor
+from ranking import exhaustive_top_k
+from ranking import wand_top_k
+from query_engine import intersect_all
+from query_cache import DEFAULT_QUERY_CACHE_SIZE
+from query_cache import QueryCache
+from query_engine import to_sorted_list
+from query_language import Fuzzy
+from query_language import QuerySyntaxError
+from query_language import conjunctive_terms
+from query_language import fuzzy_query
+from query_language import parse_query
+from query_language import query_terms
+from query_server import DEFAULT_RELOAD_INTERVAL
+from query_server import DEFAULT_SERVER_HOST
+from query_server import DEFAULT_SERVER_PORT
+from query_server import IndexHolder
+from query_server import QueryServer
+from snippets import make_snippets
+from storage_policy import DEFAULT_STORAGE_POLICY
+from storage_policy import DocumentLengthsMapping
+from storage_policy import DocumentLengthsStoragePolicy
+from storage_policy import DocumentStoreStoragePolicy
+from storage_policy import FrequenciesStoragePolicy
+from storage_policy import PositionsStoragePolicy
+from storage_policy import STORAGE_POLICIES
+from storage_policy import TermFrequencies
+from storage_policy import detect_storage_policy
+from storage_policy import read_header
+from storage_policy import verify_checksum
+from storage_policy import width_for
+from term_dictionary import SortedTermDictionary
 
 DEFAULT_DATASET_PATH = "../resources/wikipedia_sample"
 DEFAULT_INVERTED_INDEX_SAVE_PATH = "inverted.index"
-DEFAULT_STOPWORDS_PATH = "../resources/stop_words_en.txt"
+DEFAULT_STORAGE_POLICY_NAME = "array"
+POSITIONS_FILE_SUFFIX = ".positions"
+FREQUENCIES_FILE_SUFFIX = ".frequencies"
+DOCUMENT_LENGTHS_FILE_SUFFIX = ".lengths"
+DOCUMENT_STORE_FILE_SUFFIX = ".docs"
+INDEX_SECTIONS = {
+    "positions": (POSITIONS_FILE_SUFFIX, PositionsStoragePolicy),
+    "frequencies": (FREQUENCIES_FILE_SUFFIX, FrequenciesStoragePolicy),
+    "document_lengths": (DOCUMENT_LENGTHS_FILE_SUFFIX, DocumentLengthsStoragePolicy),
+}
+SIDECAR_SUFFIXES = [ANALYZER_FILE_SUFFIX] + [suffix for suffix, _ in INDEX_SECTIONS.values()]
+ESTIMATED_TERM_SIZE = 200
+ESTIMATED_POSTING_SIZE = 40
+MAX_MERGE_FAN_IN = 64
+REPLACING_FILE_SUFFIX = ".replacing"
+RUN_RECORD_HEADER = struct.Struct("<II")
+
+_index_generations = count(1)
+
+
+def index_version(inverted_index_filepath: str) -> int:
+    """Return the payload checksum of the index file, which versions its sidecar files"""
+    with open(inverted_index_filepath, "rb") as fin:
+        return read_header(fin).checksum
+
+
+def versioned_prefix(inverted_index_filepath: str, version: int) -> str:
+    """Return path prefix of sidecar files belonging only to the index file of that version"""
+    return f"{inverted_index_filepath}.{version:08x}"
+
+
+def sidecar_prefix(inverted_index_filepath: str, version: int) -> str:
+    """Return path prefix of the analyzer and section files of the index file version
+
+    Versioned sidecar files are written when a live index is replaced,
+    the analyzer file always among them, so that readers of the replaced
+    file never open sidecars of the new one.
+    """
+    prefix = versioned_prefix(inverted_index_filepath, version)
+    if os.path.exists(f"{prefix}{ANALYZER_FILE_SUFFIX}"):
+        return prefix
+    return inverted_index_filepath
+
+
+def find_sections(prefix: str) -> dict:
+    """Return section name to file path of the sections existing with the path prefix"""
+    return {
+        name: f"{prefix}{suffix}"
+        for name, (suffix, _) in INDEX_SECTIONS.items()
+        if os.path.exists(f"{prefix}{suffix}")
+    }
+
+
+def remove_stale_sections(inverted_index_filepath: str, kept_filepaths=()):
+    """Remove analyzer and section files of previous indexes at the path, but the kept ones"""
+    escaped_filepath = glob.escape(inverted_index_filepath)
+    for suffix in SIDECAR_SUFFIXES:
+        filepaths = glob.glob(f"{escaped_filepath}.{'[0-9a-f]' * 8}{suffix}")
+        filepaths.append(f"{inverted_index_filepath}{suffix}")
+        for filepath in filepaths:
+            if filepath not in kept_filepaths and os.path.exists(filepath):
+                os.remove(filepath)
+
+
+def write_index_files(inverted_index_filepath: str, dump_postings, section_dumps: dict,
+                      analyzer=None):
+    """Write the index file, its analyzer and sections, replacing a live index safely
+
+    dump_postings writes the index file to the path it is given,
+    section_dumps maps section names to functions writing the section
+    to the path they are given. Over a live index the new file is written
+    under a temporary name, its sidecars are versioned by its payload
+    checksum and it is renamed over the live file last, so a reader
+    loads either index with its own sidecars. Sidecars of the replaced
+    index are kept for its readers until the next replacement.
+    """
+    filepath = str(inverted_index_filepath)
+    if not os.path.exists(filepath):
+        dump_postings(filepath)
+        dump_analyzer(analyzer, filepath)
+        kept_filepaths = [f"{filepath}{ANALYZER_FILE_SUFFIX}"]
+        for name, dump_section in section_dumps.items():
+            kept_filepaths.append(f"{filepath}{INDEX_SECTIONS[name][0]}")
+            dump_section(kept_filepaths[-1])
+        remove_stale_sections(filepath, kept_filepaths)
+        return
+    replaced_prefix = sidecar_prefix(filepath, index_version(filepath))
+    replacing_filepath = f"{filepath}{REPLACING_FILE_SUFFIX}"
+    if os.path.exists(replacing_filepath):
+        os.remove(replacing_filepath)
+    dump_postings(replacing_filepath)
+    prefix = versioned_prefix(filepath, index_version(replacing_filepath))
+    for name, dump_section in section_dumps.items():
+        dump_section(f"{prefix}{INDEX_SECTIONS[name][0]}")
+    dump_analyzer(analyzer, prefix, explicit=True)
+    os.replace(replacing_filepath, filepath)
+    remove_stale_sections(filepath, [
+        f"{kept_prefix}{suffix}" for kept_prefix in [prefix, replaced_prefix]
+        for suffix in SIDECAR_SUFFIXES
+    ])
 
 
 class EncodedFileType(FileType):
@@ -46,127 +208,864 @@ class EncodedFileType(FileType):
             raise ArgumentTypeError(f"Can't open '{string}': {error}.")
 
 
+def positive_int(string: str) -> int:
+    """Argument type for counts which have to be at least 1"""
+    try:
+        value = int(string)
+    except ValueError:
+        raise ArgumentTypeError(f"'{string}' is not an integer.")
+    if value < 1:
+        raise ArgumentTypeError(f"{value} is not a positive integer.")
+    return value
+
+
+def non_negative_int(string: str) -> int:
+    """Argument type for counts where 0 disables the feature"""
+    try:
+        value = int(string)
+    except ValueError:
+        raise ArgumentTypeError(f"'{string}' is not an integer.")
+    if value < 0:
+        raise ArgumentTypeError(f"{value} is not a non-negative integer.")
+    return value
+
+
 class InvertedIndex:
-    """Inverted index class implementation"""
-    def __init__(self, documents: dict):
+    """Inverted index class implementation
+
+    Besides posting lists an index may hold optional sections: term
+    positions for phrase queries, term frequencies and document lengths
+    for ranked retrieval. Sections are stored in separate files next to
+    the index and are loaded on first use.
+
+    Documents were turned into terms by analyzer, queries are analyzed
+    the same way. Boolean query results are memoized in query_cache when
+    one is given.
+    Every index instance has its own generation, so a cache shared with a
+    reloaded index never serves stale results.
+    """
+    def __init__(self, documents: dict, positions: dict = None, frequencies: dict = None,
+                 document_lengths: dict = None, section_filepaths: dict = None,
+                 query_cache: QueryCache = None, analyzer=None):
         self.inverted_index = documents
+        self.positions = positions
+        self.frequencies = frequencies
+        self.document_lengths = document_lengths
+        self.section_filepaths = section_filepaths or {}
+        self.query_cache = query_cache
+        self.analyzer = analyzer or get_analyzer()
+        self.generation = next(_index_generations)
+        self._bm25 = None
+        self._min_length = None
+        self._total_length = None
+        self._term_dictionary = None
+
+    def mark_updated(self):
+        """Start a new generation, invalidating cached query results"""
+        self.generation = next(_index_generations)
+        self._bm25 = None
+        self._term_dictionary = None
 
     def __eq__(self, other):
-        return self.inverted_index == other.inverted_index
+        if self.inverted_index.keys() != other.inverted_index.keys():
+            return False
+        return all(
+            set(docs) == set(other.inverted_index[term])
+            for term, docs in self.inverted_index.items()
+        )
+
+    def query(self, words: list, max_edits: int = 0) -> list:
+        """Return the list of relevant documents for the given query
 
-    def query(self, words: list) -> list:
-        """Return the list of relevant documents for the given query"""
+        With max_edits set every word also matches dictionary terms
+        within that many edits of it.
+        """
         assert isinstance(words, list), (
             "Query should be provided with a list of words, but user provided: "
             f"{repr(words)}."
         )
-        result = self.inverted_index[words[0]]
-        for word in words:
-            result &= self.inverted_index[word]
-        return list(result)
-
-    def dump(self, filepath: str):
-        """Write inverted index to disk"""
-        with open(filepath, "wb") as fout:
-            fout.write(struct.pack(">I", len(self.inverted_index)))
-            for key, vals in self.inverted_index.items():
-                key = bytes(key, 'utf-8')
-                fout.write(struct.pack(f">H{len(key)}s", len(key), key))
-                fout.write(struct.pack(">H", len(vals)))
-                for val in vals:
-                    fout.write(struct.pack(">H", val))
+        if not self.analyzer.keeps_terms:
+            words = self.analyzer.analyze(" ".join(words))
+        if max_edits:
+            return intersect_all([Fuzzy(word, max_edits).evaluate(self) for word in set(words)])
+        return self._query_terms(words)
+
+    def _query_terms(self, terms: list) -> list:
+        """Return documents containing all the already analyzed terms"""
+        key = frozenset(terms)
+        result = self._get_cached(key)
+        if result is not None:
+            return result
+        start = time.perf_counter_ns()
+        postings_lists = []
+        for word in key:
+            postings = self.inverted_index.get(word)
+            if postings is None:
+                stage_metrics.record("term_lookup", time.perf_counter_ns() - start)
+                return []
+            postings_lists.append(postings)
+        looked_up = time.perf_counter_ns()
+        stage_metrics.record("term_lookup", looked_up - start)
+        result = intersect_all(postings_lists)
+        stage_metrics.record("intersection", time.perf_counter_ns() - looked_up)
+        self._put_cached(key, result, sum(len(postings) for postings in postings_lists))
+        return result
+
+    def _get_cached(self, key):
+        """Return cached result of a query or None"""
+        if self.query_cache is None:
+            return None
+        return self.query_cache.get(key, self.generation)
+
+    def _put_cached(self, key, result: list, cost: int):
+        """Offer a query result to the cache"""
+        if self.query_cache is not None:
+            self.query_cache.put(key, result, cost, self.generation)
+
+    def compact(self):
+        """Replace in-memory posting sets with roaring bitmaps to save memory"""
+        self.inverted_index = {
+            term: RoaringBitmap.from_sorted(to_sorted_list(docs))
+            for term, docs in self.inverted_index.items()
+        }
+
+    def get_postings(self, term: str):
+        """Return stored posting list of the term or None if it is absent"""
+        return self.inverted_index.get(term)
+
+    def terms_with_prefix(self, prefix: str) -> list:
+        """Return sorted terms of the dictionary starting with prefix"""
+        if hasattr(self.inverted_index, "keys_with_prefix"):
+            return list(self.inverted_index.keys_with_prefix(prefix))
+        return sorted(term for term in self.inverted_index if term.startswith(prefix))
+
+    def terms_in_range(self, low: str = None, high: str = None) -> list:
+        """Return sorted terms of the dictionary between low and high, both inclusive"""
+        if hasattr(self.inverted_index, "keys_in_range"):
+            return list(self.inverted_index.keys_in_range(low, high))
+        return sorted(
+            term for term in self.inverted_index
+            if (low is None or term >= low) and (high is None or term <= high)
+        )
+
+    def terms_within_distance(self, term: str, max_edits: int) -> list:
+        """Return sorted terms of the dictionary within max_edits edits of the term"""
+        if hasattr(self.inverted_index, "keys_within_distance"):
+            return self.inverted_index.keys_within_distance(term, max_edits)
+        if self._term_dictionary is None:
+            index, blob = SortedTermDictionary.encode(
+                sorted(term.encode("utf-8") for term in self.inverted_index)
+            )
+            self._term_dictionary = SortedTermDictionary(index, blob, len(self.inverted_index))
+        return fuzzy_terms(self._term_dictionary, term, max_edits)
+
+    def get_section(self, name: str):
+        """Return optional index section, loading it from disk on first access"""
+        if getattr(self, name) is None and name in self.section_filepaths:
+            _, storage_policy = INDEX_SECTIONS[name]
+            setattr(self, name, storage_policy.load(self.section_filepaths[name]))
+        return getattr(self, name)
+
+    def get_positions(self, term: str) -> dict:
+        """Return mapping of doc id to sorted positions of the term"""
+        positions = self.get_section("positions")
+        if positions is None:
+            raise ValueError("Positional queries need an index built with positions.")
+        return positions.get(term, {})
+
+    def get_frequencies(self, term: str):
+        """Return sorted doc ids, aligned term frequencies and the largest of them"""
+        frequencies = self.get_section("frequencies")
+        if frequencies is None:
+            raise ValueError("Ranked queries need an index built with term frequencies.")
+        term_frequencies = frequencies.get(term)
+        if term_frequencies is None:
+            return [], [], 0
+        if isinstance(term_frequencies, TermFrequencies):
+            doc_ids = to_sorted_list(self.inverted_index[term])
+            return doc_ids, term_frequencies.frequencies, term_frequencies.max_frequency
+        doc_ids = sorted(term_frequencies)
+        frequencies = [term_frequencies[doc_id] for doc_id in doc_ids]
+        return doc_ids, frequencies, max(frequencies)
+
+    def get_scorer(self) -> BM25:
+        """Return BM25 scorer for the collection statistics of the index"""
+        if self._bm25 is None:
+            document_lengths = self.get_section("document_lengths")
+            if document_lengths is None:
+                raise ValueError("Ranked queries need an index built with document lengths.")
+            if isinstance(document_lengths, DocumentLengthsMapping):
+                total_length = document_lengths.total_length
+                self._min_length = document_lengths.min_length
+            else:
+                total_length = sum(document_lengths.values())
+                self._min_length = min(document_lengths.values(), default=0)
+            average_length = total_length / len(document_lengths) if document_lengths else 0
+            self._bm25 = BM25(len(document_lengths), average_length)
+            self._total_length = total_length
+        return self._bm25
+
+    def collection_statistics(self, words: list) -> tuple:
+        """Return documents count, total document length and term to document frequency
+
+        Shards of a document-partitioned collection add these up, so that
+        every shard ranks with the statistics of the whole collection.
+        """
+        bm25 = self.get_scorer()
+        if not self.analyzer.keeps_terms:
+            words = self.analyzer.analyze(" ".join(words))
+        document_frequencies = {
+            word: len(self.get_postings(word) or ()) for word in set(words)
+        }
+        return bm25.documents_count, self._total_length, document_frequencies
+
+    def rank(self, words: list, top_k: int = DEFAULT_TOP_K, pruning: bool = True,
+             statistics: tuple = None) -> list:
+        """Return up to top_k (doc id, score) pairs ranked by BM25, the best first
+
+        Documents matching any of the words are candidates. With pruning
+        WAND skips documents which can not enter the top-k. statistics is
+        (documents count, average length, term to document frequency) of
+        the whole collection when the index holds only a part of it.
+        """
+        if top_k < 1:
+            raise ValueError("Ranked queries need top_k of at least 1.")
+        bm25 = self.get_scorer()
+        document_frequencies = None
+        if statistics is not None:
+            documents_count, average_length, document_frequencies = statistics
+            bm25 = BM25(documents_count, average_length)
+        if not self.analyzer.keeps_terms:
+            words = self.analyzer.analyze(" ".join(words))
+        cursors = []
+        for word in set(words):
+            doc_ids, frequencies, max_frequency = self.get_frequencies(word)
+            if not doc_ids:
+                continue
+            idf = bm25.idf(
+                len(doc_ids) if document_frequencies is None else document_frequencies[word]
+            )
+            upper_bound = bm25.upper_bound(idf, max_frequency, self._min_length)
+            cursors.append(TermCursor(doc_ids, frequencies, idf, upper_bound))
+        select_top_k = wand_top_k if pruning else exhaustive_top_k
+        return select_top_k(cursors, bm25, self.document_lengths, top_k)
+
+    def search(self, query: str) -> list:
+        """Return sorted list of documents matching the boolean query string"""
+        return self.evaluate(parse_query(query, self.analyzer))
+
+    def evaluate(self, query) -> list:
+        """Return sorted list of documents matching the parsed query tree
+
+        Terms of the tree are looked up as they are, parse the query with
+        the analyzer of the index.
+
+        Conjunctions of terms are cached by their term set, so "a b",
+        "b AND a" and query(["a", "b"]) share an entry.
+        """
+        if self.query_cache is None:
+            return query.evaluate(self)
+        terms = conjunctive_terms(query)
+        if terms is not None:
+            return self._query_terms(terms)
+        key = repr(query)
+        result = self._get_cached(key)
+        if result is None:
+            result = query.evaluate(self)
+            cost = sum(len(self.get_postings(term) or ()) for term in query_terms(query))
+            self._put_cached(key, result, cost)
+        return result
+
+    def _dumpable_section(self, name: str):
+        """Return section contents in the form accepted by its storage policy"""
+        if name == "positions":
+            return {term: self.get_positions(term) for term in self.inverted_index}
+        if name == "frequencies":
+            return {
+                term: dict(zip(*self.get_frequencies(term)[:2]))
+                for term in self.inverted_index
+            }
+        return self.get_section(name)
+
+    def dump(self, filepath: str, storage_policy=DEFAULT_STORAGE_POLICY):
+        """Write inverted index to disk
+
+        Optional sections go to separate files next to it, so that loading
+        postings never touches them. A live index at the path is replaced
+        safely for its readers, see write_index_files.
+        """
+        section_dumps = {
+            name: lambda section_filepath, name=name: INDEX_SECTIONS[name][1].dump(
+                self._dumpable_section(name), section_filepath,
+            )
+            for name in INDEX_SECTIONS if self.get_section(name) is not None
+        }
+        write_index_files(
+            filepath,
+            lambda postings_filepath: storage_policy.dump(self.inverted_index, postings_filepath),
+            section_dumps, self.analyzer,
+        )
 
     @classmethod
-    def load(cls, filepath: str):
-        """Load inverted index from disk"""
+    def load(cls, filepath: str, storage_policy=None, verify: bool = False,
+             query_cache: QueryCache = None, lazy: bool = False):
+        """Load inverted index from disk
+
+        The file header is validated before anything else is read, the
+        storage policy is detected from it unless given explicitly.
+        Set verify to check the payload checksum as well.
+        Set lazy to read only the term dictionary up front and decode
+        posting lists on first access, for policies decoding the whole
+        file otherwise; memory-mapped policies are always lazy.
+        The analyzer and sections are those written for the loaded file,
+        loading starts over when the file is replaced meanwhile.
+        """
         print(f"Load inverted index from filepath {filepath}.",
               file=sys.stderr)
-        with open(filepath, "rb") as fin:
-            encoding = 'utf-8'
-
-            index_len = struct.unpack(">I", fin.read(4))[0]
-            inverted_index = defaultdict(set)
-
-            for _ in range(index_len):
-                key_len = struct.unpack(">H", fin.read(2))[0]
-                key = struct.unpack(f">{key_len}s", fin.read(key_len))[0].decode(encoding)
-                vals_num = struct.unpack(">H", fin.read(2))[0]
-                for _ in range(vals_num):
-                    val = struct.unpack(">H", fin.read(2))[0]
-                    inverted_index[key].add(val)
-
-            inverted_index = InvertedIndex(inverted_index)
-            return inverted_index
-
-
-def load_documents(filepath: str) -> dict:
-    """Load documents to build inverted index"""
-    result = {}
-    # try:
-    with open(filepath, "r") as fin:
-        for article in fin:
-            article = article.strip().split(sep='\t', maxsplit=1)
-            result[int(article[0])] = article[1]
-    # except FileNotFoundError:
-        # print(f"Wrong file or filepath: {filepath}")
-        # return None
-    return result
-
-
-# def load_stop_words(filepath: str) -> str:
-    # """Load stop words from file"""
-    # with open(filepath, "r") as fin:
-        # return fin.read().strip()
-
-
-def build_inverted_index(documents: dict) -> InvertedIndex:
-    """Build inverted index for provided documents"""
+        if storage_policy is None:
+            storage_policy = detect_storage_policy(filepath)
+        if verify:
+            verify_checksum(filepath)
+        with stage_metrics.time("load"):
+            load = storage_policy.load
+            if lazy:
+                load = getattr(storage_policy, "load_lazy", load)
+            while True:
+                version = index_version(filepath)
+                prefix = sidecar_prefix(filepath, version)
+                inverted_index = InvertedIndex(load(filepath),
+                                               section_filepaths=find_sections(prefix),
+                                               query_cache=query_cache,
+                                               analyzer=load_analyzer(prefix))
+                if index_version(filepath) == version:
+                    break
+        return inverted_index
+
+
+def iter_documents(filepath: str):
+    """Yield (doc id, document) pairs decoding one document at a time"""
+    with MappedDataset(filepath) as dataset:
+        yield from dataset.items()
+
+
+def load_documents(filepath: str) -> MappedDataset:
+    """Load documents to build inverted index
+
+    The dataset file is memory-mapped, documents are decoded on access.
+    """
+    return MappedDataset(filepath)
+
+
+def dump_document_store(dataset_filepath: str, inverted_index_filepath: str):
+    """Write documents of the dataset to a compressed store next to the index"""
+    with MappedDataset(dataset_filepath) as dataset:
+        DocumentStoreStoragePolicy.dump(
+            dataset, f"{inverted_index_filepath}{DOCUMENT_STORE_FILE_SUFFIX}",
+        )
+
+
+def load_document_store(inverted_index_filepath: str):
+    """Return store of the indexed documents, None if the index was built without it"""
+    filepath = f"{inverted_index_filepath}{DOCUMENT_STORE_FILE_SUFFIX}"
+    if not os.path.exists(filepath):
+        return None
+    return DocumentStoreStoragePolicy.load(filepath)
+
+
+def load_index(filepath: str, storage_policy=None, query_cache: QueryCache = None,
+               lazy: bool = False):
+    """Load inverted index file, sharded or segmented index directory"""
+    from sharded_index import is_sharded_index
+
+    if is_sharded_index(filepath):
+        from sharded_index import ShardedIndex
+
+        return ShardedIndex(filepath, storage_policy=storage_policy, query_cache=query_cache,
+                            lazy=lazy)
+    if os.path.isdir(filepath):
+        from segmented_index import SegmentedIndex
+
+        return SegmentedIndex(filepath, storage_policy=storage_policy, query_cache=query_cache,
+                              lazy=lazy)
+    return InvertedIndex.load(filepath, storage_policy=storage_policy, query_cache=query_cache,
+                              lazy=lazy)
+
+
+def build_inverted_index(documents: dict, positional: bool = False,
+                         ranked: bool = False, analyzer=None) -> InvertedIndex:
+    """Build inverted index for provided documents
+
+    With positional set, term positions are kept for phrase queries.
+    With ranked set, term frequencies and document lengths are kept for BM25.
+    Documents are split into terms by analyzer, whitespace by default.
+    """
+    analyzer = analyzer or get_analyzer()
     inverted_index = defaultdict(set)
-    # stop_words = load_stop_words(DEFAULT_STOPWORDS_PATH)
-    for i, document in documents.items():
-        # document = re.sub(r"\W+", " ", document)
-        # for term in document.lower().split():
-        for term in document.split():
-            # if (re.search(term, stop_words) is None) and (i not in inverted_index[term]):
-            # if i not in inverted_index[term]:
-            inverted_index[term].add(i)
-    inverted_index = InvertedIndex(inverted_index)
+    positions = defaultdict(dict) if positional else None
+    frequencies = defaultdict(dict) if ranked else None
+    document_lengths = {} if ranked else None
+    with stage_metrics.time("build"):
+        for i, terms in analyze_documents(analyzer, documents.items()):
+            for position, term in enumerate(terms):
+                inverted_index[term].add(i)
+                if positional:
+                    positions[term].setdefault(i, []).append(position)
+                if ranked:
+                    frequencies[term][i] = frequencies[term].get(i, 0) + 1
+            if ranked:
+                document_lengths[i] = len(terms)
+    inverted_index = InvertedIndex(inverted_index, positions, frequencies, document_lengths,
+                                   analyzer=analyzer)
     return inverted_index
 
 
+def split_dataset(dataset_filepath: str, parts: int) -> list:
+    """Split dataset file into byte ranges aligned to line boundaries"""
+    with open(dataset_filepath, "rb") as fin:
+        fin.seek(0, os.SEEK_END)
+        size = fin.tell()
+        boundaries = [0]
+        for part in range(1, parts):
+            fin.seek(size * part // parts)
+            fin.readline()
+            boundaries.append(max(fin.tell(), boundaries[-1]))
+        boundaries.append(size)
+    return [
+        (start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end
+    ]
+
+
+def iter_documents_range(dataset_filepath: str, start: int, end: int):
+    """Yield (doc id, document) pairs of the lines starting in the byte range"""
+    with MappedDataset(dataset_filepath, start, end) as dataset:
+        yield from dataset.items()
+
+
+def build_partial_index(dataset_filepath: str, start: int, end: int,
+                        analyzer_name: str = DEFAULT_ANALYZER_NAME):
+    """Build term to sorted doc ids list for documents in the byte range
+
+    Return the largest doc id seen and the list sorted by term.
+    """
+    partial_index = defaultdict(set)
+    max_doc_id = 0
+    documents = iter_documents_range(dataset_filepath, start, end)
+    for doc_id, terms in analyze_documents(get_analyzer(analyzer_name), documents):
+        max_doc_id = max(max_doc_id, doc_id)
+        for term in terms:
+            partial_index[term].add(doc_id)
+    return max_doc_id, sorted((term, sorted(docs)) for term, docs in partial_index.items())
+
+
+def _drain(partial_index: list):
+    """Yield items of the list from the first one, releasing each yielded item"""
+    partial_index.reverse()
+    while partial_index:
+        yield partial_index.pop()
+
+
+def merge_partial_indexes(partial_indexes: list):
+    """K-way merge of partial indexes sorted by term into (term, doc ids) pairs
+
+    Partial indexes are consumed while merging, so postings are never
+    held both in partial and in merged form.
+    """
+    return merge_sorted_postings([_drain(partial_index) for partial_index in partial_indexes])
+
+
+def merge_sorted_postings(streams: list):
+    """K-way merge of (term, sorted doc ids) streams ordered by term"""
+    merged = heapq.merge(*streams, key=itemgetter(0))
+    for term, group in groupby(merged, key=itemgetter(0)):
+        doc_ids = []
+        for doc_id in heapq.merge(*(docs for _, docs in group)):
+            if not doc_ids or doc_ids[-1] != doc_id:
+                doc_ids.append(doc_id)
+        yield term, doc_ids
+
+
+def build_partial_indexes(dataset_filepath: str, workers: int,
+                          analyzer_name: str = DEFAULT_ANALYZER_NAME) -> list:
+    """Tokenize byte ranges of the dataset in a pool of worker processes"""
+    ranges = split_dataset(dataset_filepath, workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(build_partial_index, dataset_filepath, start, end, analyzer_name)
+            for start, end in ranges
+        ]
+        return [future.result() for future in futures]
+
+
+def build_inverted_index_parallel(dataset_filepath: str, workers: int,
+                                  analyzer_name: str = DEFAULT_ANALYZER_NAME) -> InvertedIndex:
+    """Build inverted index for the dataset file using several processes"""
+    partial_indexes = [
+        items for _, items in build_partial_indexes(dataset_filepath, workers, analyzer_name)
+    ]
+    inverted_index = InvertedIndex(dict(merge_partial_indexes(partial_indexes)),
+                                   analyzer=get_analyzer(analyzer_name))
+    return inverted_index
+
+
+def write_run(items, run_filepath: str):
+    """Write (term, sorted doc ids) pairs ordered by term to a temporary run file"""
+    with open(run_filepath, "wb") as fout:
+        for term, doc_ids in items:
+            term = term.encode("utf-8")
+            postings = CompressedPostingList.encode(doc_ids)
+            fout.write(RUN_RECORD_HEADER.pack(len(term), len(postings)))
+            fout.write(term)
+            fout.write(postings)
+
+
+def read_run(run_filepath: str):
+    """Yield (term, sorted doc ids) pairs stored in a run file"""
+    with open(run_filepath, "rb") as fin:
+        while True:
+            record_header = fin.read(RUN_RECORD_HEADER.size)
+            if not record_header:
+                break
+            term_len, postings_len = RUN_RECORD_HEADER.unpack(record_header)
+            term = fin.read(term_len).decode("utf-8")
+            yield term, list(CompressedPostingList(fin.read(postings_len)))
+
+
+def merge_runs(run_filepaths: list, tmp_dirpath: str):
+    """Merge run files into one stream, in several passes if there are many runs"""
+    run_filepaths = list(run_filepaths)
+    merge_pass = 0
+    while len(run_filepaths) > MAX_MERGE_FAN_IN:
+        merge_pass += 1
+        merged_filepaths = []
+        for start in range(0, len(run_filepaths), MAX_MERGE_FAN_IN):
+            group = run_filepaths[start:start + MAX_MERGE_FAN_IN]
+            merged_filepath = os.path.join(
+                tmp_dirpath, f"pass-{merge_pass}-{len(merged_filepaths)}.run",
+            )
+            write_run(merge_sorted_postings([read_run(path) for path in group]), merged_filepath)
+            for path in group:
+                os.remove(path)
+            merged_filepaths.append(merged_filepath)
+        run_filepaths = merged_filepaths
+    return merge_sorted_postings([read_run(path) for path in run_filepaths])
+
+
+def build_runs(dataset_filepath: str, memory_budget: int, tmp_dirpath: str,
+               analyzer=None):
+    """Index dataset line by line, flushing sorted runs when over memory budget
+
+    Memory usage is estimated from the number of distinct terms and postings.
+    Return run file paths and the largest doc id seen.
+    """
+    run_filepaths = []
+    partial_index = defaultdict(set)
+    used_memory = 0
+    max_doc_id = 0
+
+    def flush():
+        run_filepath = os.path.join(tmp_dirpath, f"{len(run_filepaths)}.run")
+        write_run(((term, sorted(partial_index[term])) for term in sorted(partial_index)),
+                  run_filepath)
+        run_filepaths.append(run_filepath)
+        partial_index.clear()
+
+    documents = iter_documents(dataset_filepath)
+    for doc_id, terms in analyze_documents(analyzer or get_analyzer(), documents):
+        max_doc_id = max(max_doc_id, doc_id)
+        for term in terms:
+            postings = partial_index[term]
+            if not postings:
+                used_memory += ESTIMATED_TERM_SIZE
+            if doc_id not in postings:
+                postings.add(doc_id)
+                used_memory += ESTIMATED_POSTING_SIZE
+        if used_memory >= memory_budget:
+            flush()
+            used_memory = 0
+    if partial_index or not run_filepaths:
+        flush()
+    return run_filepaths, max_doc_id
+
+
+def build_inverted_index_streaming(dataset_filepath: str, memory_budget: int,
+                                   inverted_index_filepath: str,
+                                   storage_policy=DEFAULT_STORAGE_POLICY, analyzer=None):
+    """Build inverted index SPIMI-style within memory budget given in bytes
+
+    Partial indexes are flushed to sorted runs in a temporary directory next
+    to the output and merged directly into the index file.
+    """
+    tmp_dirpath = os.path.dirname(os.path.abspath(inverted_index_filepath))
+    with TemporaryDirectory(prefix="spimi-", dir=tmp_dirpath) as tmp_dirpath:
+        run_filepaths, max_doc_id = build_runs(dataset_filepath, memory_budget, tmp_dirpath,
+                                               analyzer)
+        dump_postings_stream(merge_runs(run_filepaths, tmp_dirpath), max_doc_id,
+                             inverted_index_filepath, storage_policy, analyzer)
+
+
+def dump_postings_stream(merged, max_doc_id: int, inverted_index_filepath: str,
+                         storage_policy=DEFAULT_STORAGE_POLICY, analyzer=None):
+    """Write (term, sorted doc ids) stream ordered by term with the storage policy"""
+    if hasattr(storage_policy, "dump_sorted"):
+        write_index_files(inverted_index_filepath, lambda filepath: storage_policy.dump_sorted(
+            ((term.encode("utf-8"), docs) for term, docs in merged),
+            filepath, doc_id_width=width_for(max_doc_id),
+        ), {}, analyzer)
+    else:
+        InvertedIndex(dict(merged), analyzer=analyzer).dump(inverted_index_filepath,
+                                                            storage_policy=storage_policy)
+
+
+def get_storage_policy(arguments, default=None):
+    """Return storage policy class chosen in command-line arguments"""
+    name = getattr(arguments, "storage_policy", None)
+    return STORAGE_POLICIES[name] if name else default
+
+
+def check_build_options(workers: int = 1, memory_budget: int = None,
+                        positional: bool = False, ranked: bool = False,
+                        segment_size: int = None, shards: int = None):
+    """Raise ValueError for build options which can't be combined"""
+    if shards is not None and (segment_size is not None or memory_budget is not None):
+        raise ValueError("Shards are built in memory, one shard per process.")
+    if segment_size is not None and (memory_budget is not None or workers > 1):
+        raise ValueError("Segmented indexes are built one segment at a time.")
+    if (shards is None and segment_size is None and (positional or ranked)
+            and (memory_budget is not None or workers > 1)):
+        raise ValueError("Positional and ranked indexes are only supported by the in-memory build.")
+
+
+def check_build_arguments(arguments):
+    """Check "build" arguments before anything is written"""
+    check_build_options(workers=getattr(arguments, "workers", 1),
+                        memory_budget=getattr(arguments, "memory_budget", None),
+                        positional=getattr(arguments, "positional", False),
+                        ranked=getattr(arguments, "ranked", False),
+                        segment_size=getattr(arguments, "segment_size", None),
+                        shards=getattr(arguments, "shards", None))
+
+
 def callback_build(arguments):
     """Callback function for "build" argument"""
-    return process_build(arguments.dataset_filepath, arguments.inverted_index_filepath)
+    return process_build(arguments.dataset_filepath, arguments.inverted_index_filepath,
+                         storage_policy=get_storage_policy(arguments, DEFAULT_STORAGE_POLICY),
+                         workers=getattr(arguments, "workers", 1),
+                         memory_budget=getattr(arguments, "memory_budget", None),
+                         positional=getattr(arguments, "positional", False),
+                         ranked=getattr(arguments, "ranked", False),
+                         segment_size=getattr(arguments, "segment_size", None),
+                         analyzer=getattr(arguments, "analyzer", DEFAULT_ANALYZER_NAME),
+                         store_documents=getattr(arguments, "store_documents", False),
+                         shards=getattr(arguments, "shards", None))
+
+
+def process_build(dataset_filepath, inverted_index_filepath,
+                  storage_policy=DEFAULT_STORAGE_POLICY, workers: int = 1,
+                  memory_budget: int = None, positional: bool = False,
+                  ranked: bool = False, segment_size: int = None,
+                  analyzer: str = DEFAULT_ANALYZER_NAME, store_documents: bool = False,
+                  shards: int = None):
+    """The function that builds the inverted index
+
+    memory_budget is given in megabytes and enables the streaming build.
+    segment_size builds a segmented index directory, segment_size
+    documents per segment. analyzer names the text analysis chain,
+    queries against the index are analyzed with it as well.
+    With store_documents set, document texts are stored next to the
+    index for snippets of query results.
+    shards builds a directory of that many document-partitioned shard
+    files, workers of them at a time.
+    """
+    check_build_options(workers=workers, memory_budget=memory_budget,
+                        positional=positional, ranked=ranked,
+                        segment_size=segment_size, shards=shards)
+    document_store_filepath = f"{inverted_index_filepath}{DOCUMENT_STORE_FILE_SUFFIX}"
+    if store_documents:
+        dump_document_store(dataset_filepath, inverted_index_filepath)
+    elif os.path.exists(document_store_filepath):
+        os.remove(document_store_filepath)
+    if shards is not None:
+        from sharded_index import build_sharded_index
 
+        build_sharded_index(dataset_filepath, inverted_index_filepath, shards,
+                            storage_policy=storage_policy, positional=positional,
+                            ranked=ranked, analyzer_name=analyzer, workers=workers)
+        return
+    if segment_size is not None:
+        from segmented_index import build_segmented_index
 
-def process_build(dataset_filepath, inverted_index_filepath):
-    """The function that builds the inverted index"""
+        build_segmented_index(iter_documents(dataset_filepath), inverted_index_filepath,
+                              segment_size, storage_policy=storage_policy,
+                              positional=positional, ranked=ranked,
+                              analyzer=get_analyzer(analyzer))
+        return
+    if memory_budget is not None:
+        build_inverted_index_streaming(dataset_filepath, memory_budget * 2 ** 20,
+                                       inverted_index_filepath, storage_policy,
+                                       get_analyzer(analyzer))
+        return
+    if workers > 1:
+        partial_indexes = build_partial_indexes(dataset_filepath, workers, analyzer)
+        max_doc_id = max((max_doc_id for max_doc_id, _ in partial_indexes), default=0)
+        merged = merge_partial_indexes([items for _, items in partial_indexes])
+        del partial_indexes
+        dump_postings_stream(merged, max_doc_id, inverted_index_filepath, storage_policy,
+                             get_analyzer(analyzer))
+        return
     documents = load_documents(dataset_filepath)
     # if documents is not None:
-    inverted_index = build_inverted_index(documents)
-    inverted_index.dump(inverted_index_filepath)
+    inverted_index = build_inverted_index(documents, positional=positional, ranked=ranked,
+                                          analyzer=get_analyzer(analyzer))
+    inverted_index.dump(inverted_index_filepath, storage_policy=storage_policy)
 
 
 def callback_query(arguments):
     """Callback function for "query" argument"""
-    return process_queries(arguments.inverted_index_filepath, arguments.query_file)
+    return process_queries(arguments.inverted_index_filepath, arguments.query_file,
+                           storage_policy=get_storage_policy(arguments),
+                           top_k=getattr(arguments, "top_k", None),
+                           batch=getattr(arguments, "batch", False),
+                           workers=getattr(arguments, "workers", 1),
+                           batch_size=getattr(arguments, "batch_size", DEFAULT_BATCH_SIZE),
+                           cache_size=getattr(arguments, "cache_size", DEFAULT_QUERY_CACHE_SIZE),
+                           max_edits=getattr(arguments, "fuzzy", 0),
+                           snippets=getattr(arguments, "snippets", 0),
+                           lazy=getattr(arguments, "lazy", False))
 
 
-def process_queries(inverted_index_filepath, query_file):
-    """The function that performs querying against the inverted index"""
-    inverted_index = InvertedIndex.load(inverted_index_filepath)
+def process_queries(inverted_index_filepath, query_file, storage_policy=None,
+                    top_k: int = None, batch: bool = False, workers: int = 1,
+                    batch_size: int = DEFAULT_BATCH_SIZE,
+                    cache_size: int = DEFAULT_QUERY_CACHE_SIZE, max_edits: int = 0,
+                    snippets: int = 0, lazy: bool = False):
+    """The function that performs querying against the inverted index
+
+    With top_k set, queries are treated as bags of words and the best
+    top_k documents by BM25 are printed, the best first.
+    Batch mode (implied by several workers) skips per-query logging,
+    evaluates duplicate queries once and writes results in one stream.
+    Blank and malformed boolean queries get an empty result line.
+    Otherwise boolean query results are kept in an LRU of cache_size
+    entries, 0 disables it. With max_edits set, terms of boolean queries
+    also match dictionary terms within that many edits. With snippets set,
+    every result line is followed by "doc id<TAB>snippet" lines for that
+    many best results, taken from the document store of the index.
+    With lazy set, posting lists are decoded on first access instead of
+    at load, so startup does not depend on the index size.
+    """
     if isinstance(query_file, str):
         query_file = [query_file]
+    document_store = None
+    if snippets:
+        if batch or workers > 1:
+            raise ValueError("Snippets are not supported in batch mode.")
+        document_store = load_document_store(inverted_index_filepath)
+        if document_store is None:
+            raise ValueError("Snippets need an index built with a document store.")
+    if batch or workers > 1:
+        from sharded_index import is_sharded_index
+
+        if is_sharded_index(inverted_index_filepath):
+            raise ValueError("Batch mode is not supported for sharded indexes.")
+        run_batch_queries(inverted_index_filepath, query_file, sys.stdout,
+                          storage_policy=storage_policy, workers=workers,
+                          batch_size=batch_size, top_k=top_k, max_edits=max_edits)
+        return
+    query_cache = QueryCache(cache_size) if cache_size > 0 else None
+    inverted_index = load_index(inverted_index_filepath, storage_policy=storage_policy,
+                                query_cache=query_cache, lazy=lazy)
     for query in query_file:
-        query = query.strip().split()
-        print(f"Use the following query to run against InvertedIndex: {query}",
-            file=sys.stderr)
-        result = inverted_index.query(query)
+        query = query.strip()
+        if not query:
+            print()
+            continue
+        start = time.perf_counter_ns()
+        if top_k is not None:
+            query = query.split()
+            print(f"Use the following query to rank documents in InvertedIndex: {query}",
+                file=sys.stderr)
+            result = [doc_id for doc_id, _ in inverted_index.rank(query, top_k)]
+            evaluated = time.perf_counter_ns()
+            stage_metrics.record("rank", evaluated - start)
+            terms = query
+            if not inverted_index.analyzer.keeps_terms:
+                terms = inverted_index.analyzer.analyze(" ".join(query))
+        else:
+            try:
+                query = parse_query(query, inverted_index.analyzer)
+                if max_edits:
+                    query = fuzzy_query(query, max_edits)
+                parsed = time.perf_counter_ns()
+                stage_metrics.record("parse", parsed - start)
+                print(f"Use the following query to run against InvertedIndex: {query}",
+                    file=sys.stderr)
+                result = inverted_index.evaluate(query)
+            except QuerySyntaxError as error:
+                print(f"Skip malformed query: {error}", file=sys.stderr)
+                print()
+                continue
+            evaluated = time.perf_counter_ns()
+            stage_metrics.record("evaluate", evaluated - parsed)
+            terms = query_terms(query)
         print(",".join([str(x) for x in result]))
+        if document_store is not None:
+            for doc_id, snippet in make_snippets(document_store, result[:snippets], terms,
+                                                 inverted_index.analyzer):
+                print(f"{doc_id}\t{snippet}")
+        finished = time.perf_counter_ns()
+        stage_metrics.record("output", finished - evaluated)
+        stage_metrics.record("query", finished - start)
+    if query_cache is not None:
+        print(f"Query cache statistics: {query_cache.stats()}", file=sys.stderr)
+    if hasattr(inverted_index, "close"):
+        inverted_index.close()
+
+
+def callback_serve(arguments):
+    """Callback function for "serve" argument"""
+    return process_serve(arguments.inverted_index_filepath,
+                         storage_policy=get_storage_policy(arguments),
+                         host=arguments.host, port=arguments.port,
+                         unix_socket=arguments.unix_socket,
+                         top_k=arguments.top_k,
+                         reload_interval=arguments.reload_interval,
+                         cache_size=arguments.cache_size)
+
+
+def process_serve(inverted_index_filepath, storage_policy=None,
+                  host: str = DEFAULT_SERVER_HOST, port: int = DEFAULT_SERVER_PORT,
+                  unix_socket: str = None, top_k: int = None,
+                  reload_interval: float = DEFAULT_RELOAD_INTERVAL,
+                  cache_size: int = DEFAULT_QUERY_CACHE_SIZE):
+    """The function that serves queries against the inverted index until interrupted"""
+    query_cache = QueryCache(cache_size) if cache_size > 0 else None
+    index_holder = IndexHolder(inverted_index_filepath, storage_policy=storage_policy,
+                               query_cache=query_cache)
+    query_server = QueryServer(index_holder, top_k=top_k, reload_interval=reload_interval)
+    if unix_socket is not None:
+        server = query_server.make_unix_server(unix_socket)
+        print(f"Serve inverted index on unix socket {unix_socket}.", file=sys.stderr)
+    else:
+        server = query_server.make_http_server(host, port)
+        print(f"Serve inverted index on http://{host}:{server.server_address[1]}.",
+              file=sys.stderr)
+    query_server.serve_forever(server)
 
 
 def setup_parser(parser):
     """The function to setup parser arguments"""
+    parser.add_argument(
+        "--metrics-file",
+        dest="metrics_filepath",
+        metavar="PATH",
+        help="write per-stage latency metrics to PATH at exit and on SIGUSR1",
+    )
+    parser.add_argument(
+        "--metrics-format",
+        default=DEFAULT_EXPORT_FORMAT,
+        choices=EXPORT_FORMATS,
+        help="format of the metrics file",
+    )
     subparsers = parser.add_subparsers(help="choose command")
 
     build_parser = subparsers.add_parser(
@@ -187,6 +1086,59 @@ def setup_parser(parser):
         dest="inverted_index_filepath",
         help="path to store inverted index in binary format",
     )
+    build_parser.add_argument(
+        "--positional",
+        action="store_true",
+        help="store term positions to support phrase and NEAR queries",
+    )
+    build_parser.add_argument(
+        "--ranked",
+        action="store_true",
+        help="store term frequencies and document lengths for BM25 ranking",
+    )
+    build_mode_group = build_parser.add_mutually_exclusive_group()
+    build_mode_group.add_argument(
+        "-w", "--workers",
+        default=1,
+        type=positive_int,
+        help="number of processes tokenizing dataset in parallel",
+    )
+    build_mode_group.add_argument(
+        "-m", "--memory-budget",
+        type=int,
+        metavar="MB",
+        help="build index in bounded memory, flushing partial runs to disk",
+    )
+    build_mode_group.add_argument(
+        "--segment-size",
+        type=positive_int,
+        metavar="DOCUMENTS",
+        help="build a directory of segments with this many documents each, merged by tiers",
+    )
+    build_parser.add_argument(
+        "--shards",
+        type=positive_int,
+        metavar="N",
+        help="build a directory of N document-partitioned shards, "
+             "queried by one worker process per shard",
+    )
+    build_parser.add_argument(
+        "--storage-policy",
+        default=DEFAULT_STORAGE_POLICY_NAME,
+        choices=sorted(STORAGE_POLICIES),
+        help="binary format of the inverted index on disk",
+    )
+    build_parser.add_argument(
+        "--analyzer",
+        default=DEFAULT_ANALYZER_NAME,
+        choices=ANALYZER_NAMES,
+        help="text analysis applied to documents and later to queries",
+    )
+    build_parser.add_argument(
+        "--store-documents",
+        action="store_true",
+        help="store compressed document texts next to the index for result snippets",
+    )
     build_parser.set_defaults(callback=callback_build)
 
     query_parser = subparsers.add_parser(
@@ -200,6 +1152,11 @@ def setup_parser(parser):
         dest="inverted_index_filepath",
         help="path to load inverted index in binary format",
     )
+    query_parser.add_argument(
+        "--storage-policy",
+        choices=sorted(STORAGE_POLICIES),
+        help="binary format of the inverted index on disk, detected from file header if omitted",
+    )
     query_file_group = query_parser.add_mutually_exclusive_group(required=True)
     query_file_group.add_argument(
         "--query-file-utf8",
@@ -222,8 +1179,112 @@ def setup_parser(parser):
         default=TextIOWrapper(sys.stdin.buffer, encoding="utf-8"),
         help="query string to get queries for inverted index",
     )
+    query_parser.add_argument(
+        "-k", "--top-k",
+        type=positive_int,
+        metavar="K",
+        help="rank documents with BM25 and print the best K, needs an index built with --ranked",
+    )
+    query_parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="evaluate queries in batches, sharing work between duplicate queries",
+    )
+    query_parser.add_argument(
+        "--batch-size",
+        default=DEFAULT_BATCH_SIZE,
+        type=positive_int,
+        help="number of queries evaluated together in batch mode",
+    )
+    query_parser.add_argument(
+        "-w", "--workers",
+        default=1,
+        type=positive_int,
+        help="number of processes evaluating query batches, implies --batch",
+    )
+    query_parser.add_argument(
+        "--cache-size",
+        default=DEFAULT_QUERY_CACHE_SIZE,
+        type=int,
+        help="number of query results kept in the LRU cache, 0 disables it",
+    )
+    query_parser.add_argument(
+        "--fuzzy",
+        default=0,
+        type=int,
+        choices=range(MAX_EDITS_LIMIT + 1),
+        metavar="MAX_EDITS",
+        help="also match terms within MAX_EDITS edits of the query terms, 0 disables it",
+    )
+    query_parser.add_argument(
+        "--snippets",
+        default=0,
+        type=non_negative_int,
+        metavar="N",
+        help="print highlighted snippets of the best N results, "
+             "needs an index built with --store-documents",
+    )
+    query_parser.add_argument(
+        "--lazy",
+        action="store_true",
+        help="read only the term dictionary at load, decode posting lists on first access",
+    )
     query_parser.set_defaults(callback=callback_query)
 
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="load inverted index once and answer queries over HTTP or a unix socket",
+        formatter_class = ArgumentDefaultsHelpFormatter,
+    )
+    serve_parser.add_argument(
+        "-i", "--index",
+        default=DEFAULT_INVERTED_INDEX_SAVE_PATH,
+        dest="inverted_index_filepath",
+        help="path to load inverted index in binary format, reloaded when the file changes",
+    )
+    serve_parser.add_argument(
+        "--storage-policy",
+        choices=sorted(STORAGE_POLICIES),
+        help="binary format of the inverted index on disk, detected from file header if omitted",
+    )
+    serve_parser.add_argument(
+        "--host",
+        default=DEFAULT_SERVER_HOST,
+        help="address to listen for HTTP requests on",
+    )
+    serve_address_group = serve_parser.add_mutually_exclusive_group()
+    serve_address_group.add_argument(
+        "--port",
+        default=DEFAULT_SERVER_PORT,
+        type=int,
+        help="port to listen for HTTP requests on",
+    )
+    serve_address_group.add_argument(
+        "--unix-socket",
+        metavar="PATH",
+        help="answer queries line by line over a unix socket instead of HTTP",
+    )
+    serve_parser.add_argument(
+        "-k", "--top-k",
+        type=positive_int,
+        metavar="K",
+        help="rank documents with BM25 and return the best K by default",
+    )
+    serve_parser.add_argument(
+        "--reload-interval",
+        default=DEFAULT_RELOAD_INTERVAL,
+        type=float,
+        metavar="SECONDS",
+        help="how often to check the index file for changes",
+    )
+    serve_parser.add_argument(
+        "--cache-size",
+        default=DEFAULT_QUERY_CACHE_SIZE,
+        type=int,
+        help="number of query results kept in the LRU cache, 0 disables it",
+    )
+    serve_parser.set_defaults(callback=callback_serve)
+
 
 def main():
     """Main module function"""
@@ -234,6 +1295,13 @@ def main():
     )
     setup_parser(parser)
     arguments = parser.parse_args()
+    if arguments.callback is callback_build:
+        try:
+            check_build_arguments(arguments)
+        except ValueError as error:
+            parser.error(str(error))
+    if arguments.metrics_filepath is not None:
+        install_export(arguments.metrics_filepath, arguments.metrics_format)
     arguments.callback(arguments)
 
 
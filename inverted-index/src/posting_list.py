@@ -0,0 +1,256 @@
+"""
+Compressed posting lists for the inverted index.
+
+Document ids are sorted, split into fixed-size blocks and stored as deltas.
+Each block is encoded with a codec: variable-byte integers by default or
+bit packing with one bit width per block. A small skip table with the last
+document id and the byte size of every block lets readers decode only the
+blocks they actually need.
+"""
+
+from collections.abc import Mapping
+
+BLOCK_SIZE = 128
+
+
+def encode_varint(value: int, out: bytearray):
+    """Append value to out as a little-endian base-128 varint"""
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(buffer, offset: int):
+    """Return decoded varint and the offset right after it"""
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class VarByteCodec:
+    """Every delta is written as a separate varint"""
+    CODEC_ID = 1
+
+    @staticmethod
+    def encode_block(deltas: list) -> bytes:
+        """Encode block of non-negative integers"""
+        out = bytearray()
+        for delta in deltas:
+            encode_varint(delta, out)
+        return bytes(out)
+
+    @staticmethod
+    def decode_block(buffer, count: int) -> list:
+        """Decode block of count integers"""
+        deltas = []
+        offset = 0
+        for _ in range(count):
+            delta, offset = decode_varint(buffer, offset)
+            deltas.append(delta)
+        return deltas
+
+
+class BitPackedCodec:
+    """Deltas of a block are packed with the bit width of the largest one"""
+    CODEC_ID = 2
+
+    @staticmethod
+    def encode_block(deltas: list) -> bytes:
+        """Encode block of non-negative integers"""
+        width = max(deltas).bit_length()
+        packed = 0
+        for position, delta in enumerate(deltas):
+            packed |= delta << (position * width)
+        return bytes([width]) + packed.to_bytes((width * len(deltas) + 7) // 8, "little")
+
+    @staticmethod
+    def decode_block(buffer, count: int) -> list:
+        """Decode block of count integers"""
+        width = buffer[0]
+        packed = int.from_bytes(buffer[1:], "little")
+        mask = (1 << width) - 1
+        return [(packed >> (position * width)) & mask for position in range(count)]
+
+
+CODECS = {codec.CODEC_ID: codec for codec in (VarByteCodec, BitPackedCodec)}
+
+
+class CompressedPostingList:
+    """Read-only sorted posting list decoded lazily block by block
+
+    Serialized layout: varint count, then a skip table with a varint pair
+    (last doc id delta, block byte size) per block, then encoded blocks.
+    """
+    def __init__(self, buffer, codec=VarByteCodec):
+        self._buffer = buffer
+        self._codec = codec
+        self._count, offset = decode_varint(buffer, 0)
+        self._block_last = []
+        self._block_start = []
+        block_sizes = []
+        last = 0
+        for _ in range((self._count + BLOCK_SIZE - 1) // BLOCK_SIZE):
+            delta, offset = decode_varint(buffer, offset)
+            size, offset = decode_varint(buffer, offset)
+            last += delta
+            self._block_last.append(last)
+            block_sizes.append(size)
+        for size in block_sizes:
+            self._block_start.append(offset)
+            offset += size
+        self._block_start.append(offset)
+
+    @staticmethod
+    def encode(doc_ids, codec=VarByteCodec) -> bytes:
+        """Serialize sorted unique document ids"""
+        doc_ids = list(doc_ids)
+        skip_table = bytearray()
+        blocks = bytearray()
+        previous = 0
+        for start in range(0, len(doc_ids), BLOCK_SIZE):
+            block = doc_ids[start:start + BLOCK_SIZE]
+            deltas = [block[0] - previous]
+            deltas.extend(current - prior for prior, current in zip(block, block[1:]))
+            encoded = codec.encode_block(deltas)
+            encode_varint(block[-1] - previous, skip_table)
+            encode_varint(len(encoded), skip_table)
+            blocks += encoded
+            previous = block[-1]
+        out = bytearray()
+        encode_varint(len(doc_ids), out)
+        return bytes(out + skip_table + blocks)
+
+    @classmethod
+    def from_sorted(cls, doc_ids, codec=VarByteCodec):
+        """Build compressed posting list from sorted unique document ids"""
+        return cls(cls.encode(doc_ids, codec), codec)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def blocks_count(self) -> int:
+        """Return number of encoded blocks"""
+        return len(self._block_last)
+
+    def block_last(self, block: int) -> int:
+        """Return the largest document id stored in the block"""
+        return self._block_last[block]
+
+    def decode_block(self, block: int) -> list:
+        """Return document ids of the block"""
+        count = min(BLOCK_SIZE, self._count - block * BLOCK_SIZE)
+        start, end = self._block_start[block], self._block_start[block + 1]
+        doc_ids = self._codec.decode_block(self._buffer[start:end], count)
+        doc_id = self._block_last[block - 1] if block else 0
+        for position, delta in enumerate(doc_ids):
+            doc_id += delta
+            doc_ids[position] = doc_id
+        return doc_ids
+
+    def find_block(self, doc_id: int) -> int:
+        """Return the first block that may contain doc_id"""
+        low, high = 0, len(self._block_last)
+        while low < high:
+            middle = (low + high) // 2
+            if self._block_last[middle] < doc_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __iter__(self):
+        for block in range(len(self._block_last)):
+            yield from self.decode_block(block)
+
+    def __contains__(self, doc_id) -> bool:
+        block = self.find_block(doc_id)
+        return block < len(self._block_last) and doc_id in self.decode_block(block)
+
+    def intersection(self, doc_ids) -> list:
+        """Return sorted document ids present both here and in doc_ids
+
+        Only blocks that may hold one of the given ids are decoded.
+        """
+        result = []
+        decoded_block, decoded = -1, set()
+        for doc_id in sorted(doc_ids):
+            block = self.find_block(doc_id)
+            if block == len(self._block_last):
+                break
+            if block != decoded_block:
+                decoded_block, decoded = block, set(self.decode_block(block))
+            if doc_id in decoded:
+                result.append(doc_id)
+        return result
+
+
+class TermPositions(Mapping):
+    """Read-only mapping of doc id to sorted positions of a single term
+
+    Serialized layout: for every document in doc id order a varint doc id
+    delta and a varint byte size of its positions, followed by the varint
+    positions count and position deltas. Sizes let a lookup skip documents
+    without decoding their positions.
+    """
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._offsets = None
+
+    @staticmethod
+    def encode(doc_positions) -> bytes:
+        """Serialize (doc id, sorted positions) pairs ordered by doc id"""
+        out = bytearray()
+        previous_doc_id = 0
+        for doc_id, positions in doc_positions:
+            encoded = bytearray()
+            encode_varint(len(positions), encoded)
+            previous_position = 0
+            for position in positions:
+                encode_varint(position - previous_position, encoded)
+                previous_position = position
+            encode_varint(doc_id - previous_doc_id, out)
+            encode_varint(len(encoded), out)
+            out += encoded
+            previous_doc_id = doc_id
+        return bytes(out)
+
+    def _index(self) -> dict:
+        """Return doc id to positions offset mapping, scanning sizes once"""
+        if self._offsets is None:
+            self._offsets = {}
+            offset = 0
+            doc_id = 0
+            while offset < len(self._buffer):
+                delta, offset = decode_varint(self._buffer, offset)
+                size, offset = decode_varint(self._buffer, offset)
+                doc_id += delta
+                self._offsets[doc_id] = offset
+                offset += size
+        return self._offsets
+
+    def __getitem__(self, doc_id: int) -> list:
+        offset = self._index()[doc_id]
+        count, offset = decode_varint(self._buffer, offset)
+        positions = []
+        position = 0
+        for _ in range(count):
+            delta, offset = decode_varint(self._buffer, offset)
+            position += delta
+            positions.append(position)
+        return positions
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._index()
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def __len__(self) -> int:
+        return len(self._index())
@@ -0,0 +1,86 @@
+"""
+Query result cache for the inverted index.
+
+Results are kept in an LRU bounded both by the number of entries and by
+the total number of cached doc ids. Only queries whose evaluation touched
+at least min_cost postings are admitted: cheap queries are faster to
+recompute than to keep around. Every entry belongs to an index generation,
+an index gets a new generation when it is loaded or updated, and a cache
+seeing another generation drops all its entries. The cache is safe to
+share between threads.
+"""
+
+from collections import OrderedDict
+import threading
+
+DEFAULT_QUERY_CACHE_SIZE = 1024
+DEFAULT_QUERY_CACHE_MAX_DOC_IDS = 2 ** 20
+DEFAULT_QUERY_CACHE_MIN_COST = 64
+
+
+class QueryCache:
+    """Size-bounded LRU of query results with cost-aware admission"""
+    def __init__(self, max_size: int = DEFAULT_QUERY_CACHE_SIZE,
+                 max_doc_ids: int = DEFAULT_QUERY_CACHE_MAX_DOC_IDS,
+                 min_cost: int = DEFAULT_QUERY_CACHE_MIN_COST):
+        self.max_size = max_size
+        self.max_doc_ids = max_doc_ids
+        self.min_cost = min_cost
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self._entries = OrderedDict()
+        self._doc_ids_count = 0
+        self._lock = threading.Lock()
+
+    def _sync(self, generation):
+        """Drop entries computed against another index generation"""
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+    def get(self, key, generation):
+        """Return a copy of the cached result or None"""
+        with self._lock:
+            self._sync(generation)
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return list(result)
+
+    def put(self, key, result: list, cost: int, generation) -> bool:
+        """Cache the result if it was expensive enough, return whether it was admitted"""
+        with self._lock:
+            self._sync(generation)
+            if cost < self.min_cost or len(result) > self.max_doc_ids or self.max_size <= 0:
+                self.rejected += 1
+                return False
+            if key in self._entries:
+                self._doc_ids_count -= len(self._entries.pop(key))
+            self._entries[key] = tuple(result)
+            self._doc_ids_count += len(result)
+            while len(self._entries) > self.max_size or self._doc_ids_count > self.max_doc_ids:
+                _, evicted = self._entries.popitem(last=False)
+                self._doc_ids_count -= len(evicted)
+            return True
+
+    def clear(self):
+        """Drop all cached results"""
+        self._entries.clear()
+        self._doc_ids_count = 0
+
+    def stats(self) -> dict:
+        """Return cache counters"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "rejected": self.rejected,
+            "entries": len(self._entries),
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
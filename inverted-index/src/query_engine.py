@@ -0,0 +1,135 @@
+"""
+Query evaluation over posting lists of the inverted index.
+
+Posting lists may be Python sets (freshly built index), sorted sequences
+(lists, memory-mapped arrays), compressed posting lists or roaring bitmaps,
+which are combined with bitwise operations when all operands are bitmaps.
+Query evaluation
+never modifies them: every operation returns a new sorted list of doc ids.
+"""
+
+from functools import reduce
+from operator import and_
+from operator import or_
+
+from posting_list import CompressedPostingList
+from roaring import RoaringBitmap
+
+
+def galloping_search(postings, target: int, low: int = 0) -> int:
+    """Return the first position at or after low holding a value >= target
+
+    Probes positions low + 1, low + 3, low + 7, ... before a binary search,
+    so advancing by a short distance costs only a few comparisons.
+    """
+    size = len(postings)
+    if low >= size or postings[low] >= target:
+        return low
+    step = 1
+    high = low + step
+    while high < size and postings[high] < target:
+        low = high
+        step *= 2
+        high = low + step
+    high = min(high, size)
+    low += 1
+    while low < high:
+        middle = (low + high) // 2
+        if postings[middle] < target:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def to_sorted_list(postings) -> list:
+    """Return a new sorted list with document ids of the posting list"""
+    if isinstance(postings, (set, frozenset)):
+        return sorted(postings)
+    return list(postings)
+
+
+def intersect(doc_ids: list, postings) -> list:
+    """Return sorted doc ids from doc_ids which are present in postings
+
+    The cost depends on len(doc_ids), not on the size of postings: sets are
+    probed by hash, compressed lists only decode the blocks their skip
+    table points at, sorted sequences are searched with galloping.
+    """
+    if isinstance(postings, (set, frozenset)):
+        return [doc_id for doc_id in doc_ids if doc_id in postings]
+    if isinstance(postings, (CompressedPostingList, RoaringBitmap)):
+        return postings.intersection(doc_ids)
+    result = []
+    position = 0
+    for doc_id in doc_ids:
+        position = galloping_search(postings, doc_id, position)
+        if position == len(postings):
+            break
+        if postings[position] == doc_id:
+            result.append(doc_id)
+    return result
+
+
+def plan_intersection(postings_lists: list) -> list:
+    """Order posting lists for intersection, the shortest one first"""
+    return sorted(postings_lists, key=len)
+
+
+def intersect_all(postings_lists: list) -> list:
+    """Return sorted doc ids present in every posting list"""
+    if not postings_lists:
+        return []
+    if all(isinstance(postings, RoaringBitmap) for postings in postings_lists):
+        return list(reduce(and_, plan_intersection(postings_lists)))
+    ordered = plan_intersection(postings_lists)
+    result = to_sorted_list(ordered[0])
+    for postings in ordered[1:]:
+        if not result:
+            break
+        result = intersect(result, postings)
+    return result
+
+
+def union(doc_ids: list, other_doc_ids: list) -> list:
+    """Merge two sorted doc id lists into a sorted list without duplicates"""
+    result = []
+    left, right = 0, 0
+    while left < len(doc_ids) and right < len(other_doc_ids):
+        if doc_ids[left] < other_doc_ids[right]:
+            result.append(doc_ids[left])
+            left += 1
+        elif doc_ids[left] > other_doc_ids[right]:
+            result.append(other_doc_ids[right])
+            right += 1
+        else:
+            result.append(doc_ids[left])
+            left += 1
+            right += 1
+    result.extend(doc_ids[left:])
+    result.extend(other_doc_ids[right:])
+    return result
+
+
+def union_all(postings_lists: list) -> list:
+    """Return sorted doc ids present in any posting list"""
+    if postings_lists and all(isinstance(postings, RoaringBitmap) for postings in postings_lists):
+        return list(reduce(or_, postings_lists))
+    result = []
+    for postings in sorted(postings_lists, key=len):
+        result = union(result, to_sorted_list(postings))
+    return result
+
+
+def difference(doc_ids: list, postings) -> list:
+    """Return sorted doc ids from doc_ids which are absent in postings"""
+    if isinstance(postings, (set, frozenset, CompressedPostingList, RoaringBitmap)):
+        excluded = set(intersect(doc_ids, postings))
+        return [doc_id for doc_id in doc_ids if doc_id not in excluded]
+    result = []
+    position = 0
+    for doc_id in doc_ids:
+        position = galloping_search(postings, doc_id, position)
+        if position == len(postings) or postings[position] != doc_id:
+            result.append(doc_id)
+    return result
@@ -0,0 +1,483 @@
+"""
+Boolean query language for the inverted index.
+
+Grammar (AND binds tighter than OR, adjacent operands mean AND):
+    query := and_query ("OR" and_query)*
+    and_query := near_query (["AND"] near_query)*
+    near_query := not_query ("NEAR/" distance term)*
+    not_query := "NOT" not_query | "(" query ")" | '"' phrase '"' | prefix "*"
+        | term "~" [max_edits] | term
+
+Queries are parsed into a tree of nodes, each node evaluates to a sorted
+list of doc ids. NOT is only allowed as an AND operand, where it is
+evaluated as a difference, so the whole collection is never enumerated.
+"""
+
+import re
+
+from fuzzy import DEFAULT_MAX_EDITS
+from fuzzy import MAX_EDITS_LIMIT
+from query_engine import difference
+from query_engine import intersect
+from query_engine import intersect_all
+from query_engine import to_sorted_list
+from query_engine import union_all
+
+TOKEN_PATTERN = re.compile(
+    r'"(?P<phrase>[^"]*)"|(?P<paren>[()])|NEAR/(?P<near>\d+)(?=[\s()"]|$)'
+    r'|(?P<word>[^\s()"]+)|(?P<error>")'
+)
+FUZZY_PATTERN = re.compile(r"(?P<term>.+)~(?P<max_edits>\d*)")
+OPERATORS = ("AND", "OR", "NOT")
+
+
+class QuerySyntaxError(ValueError):
+    """Raised when a query string can not be parsed"""
+
+
+class Term:
+    """Documents containing the term"""
+    def __init__(self, term: str):
+        self.term = term
+
+    def postings(self, index):
+        """Return stored posting list without copying it"""
+        postings = index.get_postings(self.term)
+        return postings if postings is not None else []
+
+    def evaluate(self, index) -> list:
+        """Return sorted doc ids matching the node"""
+        return to_sorted_list(self.postings(index))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.term == other.term
+
+    def __repr__(self):
+        return f"Term({self.term!r})"
+
+
+class Phrase:
+    """Documents containing the terms next to each other in the given order"""
+    def __init__(self, terms: list):
+        self.terms = terms
+
+    def postings(self, index):
+        """Return matching doc ids"""
+        return self.evaluate(index)
+
+    def evaluate(self, index) -> list:
+        """Return sorted doc ids matching the node"""
+        candidates = intersect_all([Term(term).postings(index) for term in set(self.terms)])
+        if not candidates:
+            return []
+        terms_positions = [index.get_positions(term) for term in self.terms]
+        return [
+            doc_id for doc_id in candidates
+            if match_phrase([positions[doc_id] for positions in terms_positions])
+        ]
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.terms == other.terms
+
+    def __repr__(self):
+        return f"Phrase({self.terms!r})"
+
+
+class Near:
+    """Documents where two terms occur within distance positions of each other"""
+    def __init__(self, left: Term, right: Term, distance: int):
+        self.left = left
+        self.right = right
+        self.distance = distance
+
+    def postings(self, index):
+        """Return matching doc ids"""
+        return self.evaluate(index)
+
+    def evaluate(self, index) -> list:
+        """Return sorted doc ids matching the node"""
+        candidates = intersect_all([self.left.postings(index), self.right.postings(index)])
+        if not candidates:
+            return []
+        left_positions = index.get_positions(self.left.term)
+        right_positions = index.get_positions(self.right.term)
+        return [
+            doc_id for doc_id in candidates
+            if min_distance(left_positions[doc_id], right_positions[doc_id]) <= self.distance
+        ]
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and self.left == other.left
+                and self.right == other.right and self.distance == other.distance)
+
+    def __repr__(self):
+        return f"Near({self.left!r}, {self.right!r}, {self.distance})"
+
+
+class Prefix:
+    """Documents containing any term starting with the prefix, written as prefix*"""
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+
+    def postings(self, index):
+        """Return matching doc ids"""
+        return self.evaluate(index)
+
+    def evaluate(self, index) -> list:
+        """Return sorted doc ids matching the node"""
+        return union_all([index.get_postings(term) for term in index.terms_with_prefix(self.prefix)])
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.prefix == other.prefix
+
+    def __repr__(self):
+        return f"Prefix({self.prefix!r})"
+
+
+class Fuzzy:
+    """Documents containing any term within max_edits edits of the term, written as term~k"""
+    def __init__(self, term: str, max_edits: int = DEFAULT_MAX_EDITS):
+        self.term = term
+        self.max_edits = max_edits
+
+    def postings(self, index):
+        """Return matching doc ids"""
+        return self.evaluate(index)
+
+    def evaluate(self, index) -> list:
+        """Return sorted doc ids matching the node"""
+        terms = index.terms_within_distance(self.term, self.max_edits)
+        return union_all([index.get_postings(term) for term in terms])
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and self.term == other.term
+                and self.max_edits == other.max_edits)
+
+    def __repr__(self):
+        return f"Fuzzy({self.term!r}, {self.max_edits})"
+
+
+class TermRange:
+    """Documents containing any term between low and high, both inclusive"""
+    def __init__(self, low: str = None, high: str = None):
+        self.low = low
+        self.high = high
+
+    def postings(self, index):
+        """Return matching doc ids"""
+        return self.evaluate(index)
+
+    def evaluate(self, index) -> list:
+        """Return sorted doc ids matching the node"""
+        terms = index.terms_in_range(self.low, self.high)
+        return union_all([index.get_postings(term) for term in terms])
+
+    def __eq__(self, other):
+        return type(self) is type(other) and (self.low, self.high) == (other.low, other.high)
+
+    def __repr__(self):
+        return f"TermRange({self.low!r}, {self.high!r})"
+
+
+class Not:
+    """Documents not matching the operand, valid only inside And"""
+    def __init__(self, operand):
+        self.operand = operand
+
+    def postings(self, index):
+        """NOT is only valid as an operand of And"""
+        return self.evaluate(index)
+
+    def evaluate(self, index) -> list:
+        """NOT without a positive operand would match the whole collection"""
+        raise QuerySyntaxError("NOT can only be used together with a positive operand.")
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.operand == other.operand
+
+    def __repr__(self):
+        return f"Not({self.operand!r})"
+
+
+class And:
+    """Documents matching every operand"""
+    def __init__(self, operands: list):
+        self.operands = operands
+
+    def postings(self, index):
+        """Return matching doc ids"""
+        return self.evaluate(index)
+
+    def evaluate(self, index) -> list:
+        """Return sorted doc ids matching the node
+
+        Positive operands are intersected shortest first, negated operands
+        are then subtracted from the result.
+        """
+        positive = [operand for operand in self.operands if not isinstance(operand, Not)]
+        negative = [operand.operand for operand in self.operands if isinstance(operand, Not)]
+        if not positive:
+            raise QuerySyntaxError("NOT can only be used together with a positive operand.")
+        result = intersect_all([operand.postings(index) for operand in positive])
+        for operand in negative:
+            if not result:
+                break
+            result = difference(result, operand.postings(index))
+        return result
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.operands == other.operands
+
+    def __repr__(self):
+        return f"And({self.operands!r})"
+
+
+class Or:
+    """Documents matching any operand"""
+    def __init__(self, operands: list):
+        self.operands = operands
+
+    def postings(self, index):
+        """Return matching doc ids"""
+        return self.evaluate(index)
+
+    def evaluate(self, index) -> list:
+        """Return sorted doc ids matching the node"""
+        return union_all([operand.postings(index) for operand in self.operands])
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.operands == other.operands
+
+    def __repr__(self):
+        return f"Or({self.operands!r})"
+
+
+def match_phrase(positions_lists: list) -> bool:
+    """Check that some position p in the first list has p + i in the i-th list"""
+    starts = list(positions_lists[0])
+    for offset, positions in enumerate(positions_lists[1:], start=1):
+        starts = intersect(starts, [position - offset for position in positions])
+        if not starts:
+            return False
+    return True
+
+
+def min_distance(positions: list, other_positions: list) -> int:
+    """Return the smallest distance between two sorted position lists"""
+    result = float("inf")
+    left, right = 0, 0
+    while left < len(positions) and right < len(other_positions):
+        result = min(result, abs(positions[left] - other_positions[right]))
+        if positions[left] < other_positions[right]:
+            left += 1
+        else:
+            right += 1
+    return result
+
+
+def conjunctive_terms(query) -> list:
+    """Return sorted terms of a query tree made of ANDed terms only, or None"""
+    if isinstance(query, Term):
+        return [query.term]
+    if isinstance(query, And) and all(isinstance(operand, Term) for operand in query.operands):
+        return sorted({operand.term for operand in query.operands})
+    return None
+
+
+def query_terms(query) -> set:
+    """Return all terms a query tree refers to"""
+    if isinstance(query, Term):
+        return {query.term}
+    if isinstance(query, Phrase):
+        return set(query.terms)
+    if isinstance(query, Near):
+        return {query.left.term, query.right.term}
+    if isinstance(query, Not):
+        return query_terms(query.operand)
+    if isinstance(query, (Prefix, Fuzzy, TermRange)):
+        return set()
+    return set().union(*(query_terms(operand) for operand in query.operands))
+
+
+def fuzzy_query(query, max_edits: int = DEFAULT_MAX_EDITS):
+    """Return query tree with plain terms replaced by fuzzy ones
+
+    Phrases and NEAR keep exact terms, they are matched by positions.
+    """
+    if isinstance(query, Term):
+        return Fuzzy(query.term, max_edits)
+    if isinstance(query, Not):
+        return Not(fuzzy_query(query.operand, max_edits))
+    if isinstance(query, (And, Or)):
+        return type(query)([fuzzy_query(operand, max_edits) for operand in query.operands])
+    return query
+
+
+def tokenize(query: str) -> list:
+    """Split query string into (kind, value) tokens"""
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(query):
+        kind = match.lastgroup
+        if kind == "error":
+            raise QuerySyntaxError(f"Unterminated phrase in query: {query!r}.")
+        value = match.group(kind)
+        if kind == "near":
+            value = int(value)
+        if kind == "word" and value in OPERATORS:
+            kind = "operator"
+        tokens.append((kind, value))
+    return tokens
+
+
+class QueryParser:
+    """Recursive descent parser producing a query tree"""
+    def __init__(self, query: str):
+        self.query = query
+        self.tokens = tokenize(query)
+        self.position = 0
+
+    def peek(self):
+        """Return the current token or None at the end of query"""
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def advance(self):
+        """Return the current token and move to the next one"""
+        token = self.peek()
+        if token is None:
+            raise QuerySyntaxError(f"Unexpected end of query: {self.query!r}.")
+        self.position += 1
+        return token
+
+    def parse(self):
+        """Parse the whole query"""
+        if not self.tokens:
+            raise QuerySyntaxError("Query is empty.")
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise QuerySyntaxError(f"Unexpected {self.peek()[1]!r} in query: {self.query!r}.")
+        return node
+
+    def parse_or(self):
+        """Parse operands joined by OR"""
+        operands = [self.parse_and()]
+        while self.peek() == ("operator", "OR"):
+            self.advance()
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else Or(operands)
+
+    def parse_and(self):
+        """Parse operands joined by AND or written next to each other"""
+        operands = [self.parse_near()]
+        while self.peek() is not None and self.peek() not in (("operator", "OR"), ("paren", ")")):
+            if self.peek() == ("operator", "AND"):
+                self.advance()
+            operands.append(self.parse_near())
+        return operands[0] if len(operands) == 1 else And(operands)
+
+    def parse_near(self):
+        """Parse terms joined by NEAR/k"""
+        node = self.parse_not()
+        left = node
+        nears = []
+        while self.peek() is not None and self.peek()[0] == "near":
+            _, distance = self.advance()
+            right = self.parse_not()
+            if not isinstance(left, Term) or not isinstance(right, Term):
+                raise QuerySyntaxError(f"NEAR/{distance} can only join terms: {self.query!r}.")
+            nears.append(Near(left, right, distance))
+            left = right
+        if not nears:
+            return node
+        return nears[0] if len(nears) == 1 else And(nears)
+
+    def parse_not(self):
+        """Parse a possibly negated operand"""
+        kind, value = self.advance()
+        if (kind, value) == ("operator", "NOT"):
+            return Not(self.parse_not())
+        if (kind, value) == ("paren", "("):
+            node = self.parse_or()
+            if self.advance() != ("paren", ")"):
+                raise QuerySyntaxError(f"Missing closing parenthesis in query: {self.query!r}.")
+            return node
+        if kind == "phrase":
+            terms = value.split()
+            if not terms:
+                raise QuerySyntaxError(f"Empty phrase in query: {self.query!r}.")
+            return Term(terms[0]) if len(terms) == 1 else Phrase(terms)
+        if kind == "word":
+            if len(value) > 1 and value.endswith("*"):
+                return Prefix(value[:-1])
+            match = FUZZY_PATTERN.fullmatch(value)
+            if match:
+                max_edits = int(match.group("max_edits") or DEFAULT_MAX_EDITS)
+                if max_edits > MAX_EDITS_LIMIT:
+                    raise QuerySyntaxError(
+                        f"Fuzzy terms allow up to {MAX_EDITS_LIMIT} edits: {self.query!r}."
+                    )
+                return Fuzzy(match.group("term"), max_edits)
+            return Term(value)
+        raise QuerySyntaxError(f"Unexpected {value!r} in query: {self.query!r}.")
+
+
+def _analyze_term(term: Term, analyzer):
+    """Return Term, And of terms or None for a term the analyzer drops"""
+    terms = [Term(value) for value in analyzer.analyze(term.term)]
+    if not terms:
+        return None
+    return terms[0] if len(terms) == 1 else And(terms)
+
+
+def _analyze_node(query, analyzer):
+    """Return query tree with terms analyzed, None if nothing is left of it"""
+    if isinstance(query, Term):
+        return _analyze_term(query, analyzer)
+    if isinstance(query, Phrase):
+        terms = analyzer.analyze(" ".join(query.terms))
+        if len(terms) < 2:
+            return Term(terms[0]) if terms else None
+        return Phrase(terms)
+    if isinstance(query, Near):
+        left, right = _analyze_term(query.left, analyzer), _analyze_term(query.right, analyzer)
+        if isinstance(left, Term) and isinstance(right, Term):
+            return Near(left, right, query.distance)
+        operands = [operand for operand in (left, right) if operand is not None]
+        return And(operands) if operands else None
+    if isinstance(query, Prefix):
+        return Prefix(analyzer.normalize(query.prefix))
+    if isinstance(query, Fuzzy):
+        return Fuzzy(analyzer.normalize(query.term), query.max_edits)
+    if isinstance(query, TermRange):
+        return TermRange(*(
+            None if bound is None else analyzer.normalize(bound)
+            for bound in (query.low, query.high)
+        ))
+    if isinstance(query, Not):
+        operand = _analyze_node(query.operand, analyzer)
+        return Not(operand) if operand is not None else None
+    operands = [
+        operand for operand in (_analyze_node(operand, analyzer) for operand in query.operands)
+        if operand is not None
+    ]
+    if not operands:
+        return None
+    return operands[0] if len(operands) == 1 else type(query)(operands)
+
+
+def analyze_query(query, analyzer):
+    """Return query tree with terms analyzed the way documents were
+
+    Terms the analyzer drops, such as stop words, are removed from the
+    tree, a query left without terms matches no documents.
+    """
+    if analyzer is None or analyzer.keeps_terms:
+        return query
+    analyzed = _analyze_node(query, analyzer)
+    return analyzed if analyzed is not None else Or([])
+
+
+def parse_query(query: str, analyzer=None):
+    """Parse query string into a query tree, analyzing its terms with analyzer"""
+    return analyze_query(QueryParser(query).parse(), analyzer)
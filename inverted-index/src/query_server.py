@@ -0,0 +1,261 @@
+"""
+Long-running query server for the inverted index.
+
+The index is loaded once and queries are answered over HTTP or a local
+Unix socket, every client connection is handled in its own thread.
+A watcher thread polls the index file and loads a replacement as soon as
+it changes (SIGHUP or POST /reload force it), then swaps it in with a
+single reference assignment: requests already running finish against the
+old index, new ones see the new index, nothing is refused meanwhile.
+Indexes holding resources, like the worker processes of a sharded index,
+are closed once the last request using them is done.
+Rebuild the index in place: the new index file replaces the served one
+last and its analyzer and section files are versioned for it, so the
+server never pairs postings with sidecar files of another build. For a
+segmented or sharded index directory its manifest is watched.
+
+HTTP endpoints:
+    GET /query?q=QUERY[&k=K]    comma separated doc ids
+    GET /stats                  JSON with index and cache statistics
+    POST /reload                reload the index file unconditionally
+
+Unix socket protocol: one query per line, one line of comma separated
+doc ids or "ERROR: message" per query.
+"""
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import os
+import signal
+from socketserver import StreamRequestHandler
+from socketserver import ThreadingUnixStreamServer
+import sys
+import threading
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+from query_language import parse_query
+from storage_policy import IndexFormatError
+
+DEFAULT_SERVER_HOST = "127.0.0.1"
+DEFAULT_SERVER_PORT = 8080
+DEFAULT_RELOAD_INTERVAL = 1.0
+
+
+class IndexHolder:
+    """Reference to the currently served index, replaced on reload"""
+    def __init__(self, inverted_index_filepath: str, storage_policy=None, query_cache=None):
+        self.inverted_index_filepath = inverted_index_filepath
+        self.storage_policy = storage_policy
+        self.query_cache = query_cache
+        self.inverted_index = None
+        self.reloads_count = 0
+        self._signature = None
+        self._lock = threading.Lock()
+        self._users_lock = threading.Lock()
+        self._users = {}
+        self._retired = {}
+        self.reload()
+
+    def _file_signature(self) -> tuple:
+        """Return values changing whenever the index file is replaced or rewritten"""
+        from segmented_index import MANIFEST_FILENAME
+        from sharded_index import SHARDS_MANIFEST_FILENAME
+        from sharded_index import is_sharded_index
+
+        filepath = self.inverted_index_filepath
+        if is_sharded_index(filepath):
+            filepath = os.path.join(filepath, SHARDS_MANIFEST_FILENAME)
+        elif os.path.isdir(filepath):
+            filepath = os.path.join(filepath, MANIFEST_FILENAME)
+        stat = os.stat(filepath)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def reload(self, force: bool = True) -> bool:
+        """Load the index file and swap it in, return whether it was reloaded"""
+        from inverted_index import load_index
+
+        with self._lock:
+            signature = self._file_signature()
+            if not force and signature == self._signature:
+                return False
+            inverted_index = load_index(self.inverted_index_filepath,
+                                        storage_policy=self.storage_policy,
+                                        query_cache=self.query_cache)
+            with self._users_lock:
+                replaced = self.inverted_index
+                self.inverted_index, self._signature = inverted_index, signature
+                self.reloads_count += 1
+                if id(replaced) in self._users:
+                    self._retired[id(replaced)] = replaced
+                    replaced = None
+        if hasattr(replaced, "close"):
+            replaced.close()
+        return True
+
+    @contextmanager
+    def acquire(self):
+        """Return the current index, a replaced one is closed only after all users release it"""
+        with self._users_lock:
+            inverted_index = self.inverted_index
+            self._users[id(inverted_index)] = self._users.get(id(inverted_index), 0) + 1
+        try:
+            yield inverted_index
+        finally:
+            retired = None
+            with self._users_lock:
+                self._users[id(inverted_index)] -= 1
+                if not self._users[id(inverted_index)]:
+                    del self._users[id(inverted_index)]
+                    retired = self._retired.pop(id(inverted_index), None)
+            if hasattr(retired, "close"):
+                retired.close()
+
+    def reload_if_changed(self) -> bool:
+        """Reload the index if its file changed, keep serving the old one on errors"""
+        try:
+            return self.reload(force=False)
+        except (OSError, IndexFormatError) as error:
+            print(f"Keep serving the current index, reload failed: {error}", file=sys.stderr)
+            return False
+
+
+def answer_query(inverted_index, query: str, top_k: int = None) -> list:
+    """Return doc ids matching the query string
+
+    With top_k set the query is a bag of words ranked by BM25.
+    """
+    if top_k is not None:
+        return [doc_id for doc_id, _ in inverted_index.rank(query.split(), top_k)]
+    return inverted_index.evaluate(parse_query(query, inverted_index.analyzer))
+
+
+class QueryServer:
+    """Query front ends sharing one hot-swappable index"""
+    def __init__(self, index_holder: IndexHolder, top_k: int = None,
+                 reload_interval: float = DEFAULT_RELOAD_INTERVAL):
+        self.index_holder = index_holder
+        self.top_k = top_k
+        self.reload_interval = reload_interval
+        self._stopped = threading.Event()
+
+    def answer(self, query: str, top_k: int = None) -> list:
+        """Answer a query against the current index"""
+        with self.index_holder.acquire() as inverted_index:
+            return answer_query(inverted_index, query, top_k if top_k is not None else self.top_k)
+
+    def stats(self) -> dict:
+        """Return statistics of the served index"""
+        query_cache = self.index_holder.query_cache
+        return {
+            "index": str(self.index_holder.inverted_index_filepath),
+            "generation": self.index_holder.inverted_index.generation,
+            "reloads": self.index_holder.reloads_count,
+            "cache": query_cache.stats() if query_cache is not None else None,
+        }
+
+    def make_http_server(self, host: str = DEFAULT_SERVER_HOST,
+                         port: int = DEFAULT_SERVER_PORT) -> ThreadingHTTPServer:
+        """Return HTTP server answering queries"""
+        server = ThreadingHTTPServer((host, port), QueryHTTPRequestHandler)
+        server.daemon_threads = True
+        server.query_server = self
+        return server
+
+    def make_unix_server(self, socket_filepath: str) -> ThreadingUnixStreamServer:
+        """Return Unix socket server answering one query per line"""
+        if os.path.exists(socket_filepath):
+            os.remove(socket_filepath)
+        server = ThreadingUnixStreamServer(socket_filepath, QueryStreamRequestHandler)
+        server.daemon_threads = True
+        server.query_server = self
+        return server
+
+    def watch_index(self):
+        """Poll the index file and reload it when it changes, until stopped"""
+        while not self._stopped.wait(self.reload_interval):
+            self.index_holder.reload_if_changed()
+
+    def serve_forever(self, server):
+        """Serve requests until interrupted"""
+        watcher = threading.Thread(target=self.watch_index, daemon=True)
+        watcher.start()
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+                target=self.index_holder.reload_if_changed, daemon=True).start())
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stopped.set()
+            server.server_close()
+
+
+class QueryHTTPRequestHandler(BaseHTTPRequestHandler):
+    """HTTP front end of the query server"""
+    def _send(self, status: int, body: str, content_type: str = "text/plain; charset=utf-8"):
+        """Send a complete response"""
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        """Answer a query or report statistics"""
+        query_server = self.server.query_server
+        url = urlsplit(self.path)
+        if url.path == "/stats":
+            self._send(200, json.dumps(query_server.stats()), "application/json")
+            return
+        if url.path != "/query":
+            self._send(404, "Not found.\n")
+            return
+        parameters = parse_qs(url.query)
+        try:
+            query = parameters["q"][0]
+            top_k = int(parameters["k"][0]) if "k" in parameters else None
+            result = query_server.answer(query, top_k)
+        except (KeyError, ValueError) as error:
+            self._send(400, f"ERROR: {error}\n")
+            return
+        except Exception as error:
+            self._send(500, f"ERROR: {error}\n")
+            return
+        self._send(200, ",".join(map(str, result)) + "\n")
+
+    def do_POST(self):
+        """Reload the index on request"""
+        if urlsplit(self.path).path != "/reload":
+            self._send(404, "Not found.\n")
+            return
+        try:
+            self.server.query_server.index_holder.reload()
+        except (OSError, IndexFormatError) as error:
+            self._send(500, f"ERROR: {error}\n")
+            return
+        self._send(200, json.dumps(self.server.query_server.stats()), "application/json")
+
+    def log_message(self, format, *args):
+        """Keep stderr quiet, every request would be logged otherwise"""
+
+
+class QueryStreamRequestHandler(StreamRequestHandler):
+    """Unix socket front end of the query server"""
+    def handle(self):
+        """Answer queries until the client closes the connection"""
+        query_server = self.server.query_server
+        for line in self.rfile:
+            query = line.decode("utf-8").strip()
+            if not query:
+                continue
+            try:
+                response = ",".join(map(str, query_server.answer(query)))
+            except Exception as error:
+                response = f"ERROR: {error}"
+            self.wfile.write(response.encode("utf-8") + b"\n")
+            self.wfile.flush()
@@ -0,0 +1,152 @@
+"""
+BM25 ranked retrieval over the inverted index.
+
+Top-k documents are collected in a min-heap. WAND evaluation keeps one
+cursor per query term and uses per-term score upper bounds to jump over
+documents which can not enter the current top-k.
+"""
+
+import heapq
+import math
+
+from query_engine import galloping_search
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+DEFAULT_TOP_K = 10
+
+
+class BM25:
+    """Okapi BM25 scoring function for a collection"""
+    def __init__(self, documents_count: int, average_length: float,
+                 k1: float = BM25_K1, b: float = BM25_B):
+        self.documents_count = documents_count
+        self.average_length = average_length or 1.0
+        self.k1 = k1
+        self.b = b
+
+    def idf(self, document_frequency: int) -> float:
+        """Return inverse document frequency of a term"""
+        return math.log(
+            1 + (self.documents_count - document_frequency + 0.5) / (document_frequency + 0.5)
+        )
+
+    def score(self, idf: float, term_frequency: int, length: int) -> float:
+        """Return contribution of a term to the document score"""
+        norm = self.k1 * (1 - self.b + self.b * length / self.average_length)
+        return idf * term_frequency * (self.k1 + 1) / (term_frequency + norm)
+
+    def upper_bound(self, idf: float, max_frequency: int, min_length: int) -> float:
+        """Return the largest possible contribution of a term to any document"""
+        return self.score(idf, max_frequency, min_length)
+
+
+class TermCursor:
+    """Position in a sorted posting list with aligned term frequencies"""
+    def __init__(self, doc_ids: list, frequencies: list, idf: float, upper_bound: float):
+        self.doc_ids = doc_ids
+        self.frequencies = frequencies
+        self.idf = idf
+        self.upper_bound = upper_bound
+        self.position = 0
+
+    @property
+    def exhausted(self) -> bool:
+        """Whether all postings were consumed"""
+        return self.position >= len(self.doc_ids)
+
+    @property
+    def doc_id(self) -> int:
+        """Current document id"""
+        return self.doc_ids[self.position]
+
+    @property
+    def frequency(self) -> int:
+        """Term frequency in the current document"""
+        return self.frequencies[self.position]
+
+    def next(self):
+        """Move to the next posting"""
+        self.position += 1
+
+    def advance_to(self, doc_id: int):
+        """Skip to the first posting with document id not less than doc_id"""
+        self.position = galloping_search(self.doc_ids, doc_id, self.position)
+
+
+class TopK:
+    """Min-heap holding the k best (score, doc id) pairs seen so far
+
+    On equal scores a smaller doc id ranks higher.
+    """
+    def __init__(self, k: int):
+        self.k = k
+        self.heap = []
+
+    @property
+    def threshold(self) -> float:
+        """Score a document has to reach to enter the heap"""
+        return self.heap[0][0] if len(self.heap) == self.k else 0.0
+
+    def push(self, doc_id: int, score: float):
+        """Offer a scored document"""
+        entry = (score, -doc_id)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def results(self) -> list:
+        """Return (doc id, score) pairs, the best first"""
+        return [(-doc_id, score) for score, doc_id in sorted(self.heap, reverse=True)]
+
+
+def wand_top_k(cursors: list, bm25: BM25, document_lengths, k: int) -> list:
+    """Return top-k (doc id, score) pairs using WAND dynamic pruning
+
+    Cursors are kept ordered by current document. The pivot is the first
+    cursor at which the sum of upper bounds reaches the heap threshold:
+    documents before it can not score high enough and are skipped.
+    """
+    top_k = TopK(k)
+    cursors = [cursor for cursor in cursors if not cursor.exhausted]
+    while cursors:
+        cursors.sort(key=lambda cursor: cursor.doc_id)
+        threshold = top_k.threshold
+        bound = 0.0
+        pivot = None
+        for position, cursor in enumerate(cursors):
+            bound += cursor.upper_bound
+            if bound >= threshold and bound > 0:
+                pivot = position
+                break
+        if pivot is None:
+            break
+        pivot_doc_id = cursors[pivot].doc_id
+        if cursors[0].doc_id == pivot_doc_id:
+            length = document_lengths[pivot_doc_id]
+            score = 0.0
+            for cursor in cursors:
+                if cursor.doc_id != pivot_doc_id:
+                    break
+                score += bm25.score(cursor.idf, cursor.frequency, length)
+                cursor.next()
+            top_k.push(pivot_doc_id, score)
+        else:
+            for cursor in cursors[:pivot]:
+                cursor.advance_to(pivot_doc_id)
+        cursors = [cursor for cursor in cursors if not cursor.exhausted]
+    return top_k.results()
+
+
+def exhaustive_top_k(cursors: list, bm25: BM25, document_lengths, k: int) -> list:
+    """Return top-k (doc id, score) pairs scoring every posting"""
+    scores = {}
+    for cursor in cursors:
+        for doc_id, frequency in zip(cursor.doc_ids, cursor.frequencies):
+            score = bm25.score(cursor.idf, frequency, document_lengths[doc_id])
+            scores[doc_id] = scores.get(doc_id, 0.0) + score
+    top_k = TopK(k)
+    for doc_id, score in scores.items():
+        top_k.push(doc_id, score)
+    return top_k.results()
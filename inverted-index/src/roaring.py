@@ -0,0 +1,314 @@
+"""
+Roaring bitmaps for dense posting lists.
+
+Document ids are split by their high bits into chunks of 2^16 ids. Every
+chunk is stored in the smallest of three containers: a sorted array of
+16-bit values, a 2^16-bit bitmap or a list of runs. Bitmaps are Python
+integers, so AND, OR and ANDNOT between dense chunks are single big
+integer operations, sparse chunks are combined by probing their values.
+
+Serialized layout: varint containers count, then for every container
+a varint chunk key, a kind byte and the payload: varint count and uint16
+values for arrays, 8192 bytes for bitmaps, varint count and uint16
+(start, length - 1) pairs for runs. Integers are little-endian.
+"""
+
+from array import array
+import sys
+
+from posting_list import decode_varint
+from posting_list import encode_varint
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+LOW_MASK = CHUNK_SIZE - 1
+BITMAP_BYTES = CHUNK_SIZE // 8
+ARRAY_CONTAINER = 1
+BITMAP_CONTAINER = 2
+RUN_CONTAINER = 3
+
+_BYTE_BITS = [[bit for bit in range(8) if value & (1 << bit)] for value in range(256)]
+
+
+def _uint16_array(buffer) -> array:
+    """Return array of uint16 values stored little-endian in buffer"""
+    values = array("H")
+    values.frombytes(buffer)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def _uint16_bytes(values: array) -> bytes:
+    """Return uint16 values as little-endian bytes"""
+    if sys.byteorder == "big":
+        values = array("H", values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _popcount(bits: int) -> int:
+    return bin(bits).count("1")
+
+
+def bits_to_values(bits: int) -> array:
+    """Return sorted positions of the set bits of a chunk bitmap"""
+    values = array("H")
+    for byte, value in enumerate(bits.to_bytes(BITMAP_BYTES, "little")):
+        if value:
+            base = byte * 8
+            values.extend(base + bit for bit in _BYTE_BITS[value])
+    return values
+
+
+def values_to_bits(values) -> int:
+    """Return chunk bitmap with the given positions set"""
+    buffer = bytearray(BITMAP_BYTES)
+    for value in values:
+        buffer[value >> 3] |= 1 << (value & 7)
+    return int.from_bytes(buffer, "little")
+
+
+class ArrayContainer:
+    """Sorted 16-bit values of a sparse chunk"""
+    KIND = ARRAY_CONTAINER
+
+    def __init__(self, values: array):
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __contains__(self, value) -> bool:
+        low, high = 0, len(self.values)
+        while low < high:
+            middle = (low + high) // 2
+            if self.values[middle] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low < len(self.values) and self.values[low] == value
+
+    def to_bits(self) -> int:
+        return values_to_bits(self.values)
+
+    def payload(self) -> bytes:
+        out = bytearray()
+        encode_varint(len(self.values), out)
+        return bytes(out) + _uint16_bytes(self.values)
+
+
+class BitmapContainer:
+    """Bitmap of a dense chunk"""
+    KIND = BITMAP_CONTAINER
+
+    def __init__(self, bits: int, count: int = None):
+        self.bits = bits
+        self.count = _popcount(bits) if count is None else count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        return iter(bits_to_values(self.bits))
+
+    def __contains__(self, value) -> bool:
+        return bool(self.bits >> value & 1)
+
+    def to_bits(self) -> int:
+        return self.bits
+
+    def payload(self) -> bytes:
+        return self.bits.to_bytes(BITMAP_BYTES, "little")
+
+
+class RunContainer:
+    """Runs of consecutive values as (start, length - 1) pairs"""
+    KIND = RUN_CONTAINER
+
+    def __init__(self, runs: array):
+        self.runs = runs
+        self.count = sum(runs[1::2]) + len(runs) // 2
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        for start, extra in zip(self.runs[::2], self.runs[1::2]):
+            yield from range(start, start + extra + 1)
+
+    def __contains__(self, value) -> bool:
+        low, high = 0, len(self.runs) // 2
+        while low < high:
+            middle = (low + high) // 2
+            if self.runs[2 * middle] + self.runs[2 * middle + 1] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low < len(self.runs) // 2 and self.runs[2 * low] <= value
+
+    def to_bits(self) -> int:
+        bits = 0
+        for start, extra in zip(self.runs[::2], self.runs[1::2]):
+            bits |= ((1 << (extra + 1)) - 1) << start
+        return bits
+
+    def payload(self) -> bytes:
+        out = bytearray()
+        encode_varint(len(self.runs) // 2, out)
+        return bytes(out) + _uint16_bytes(self.runs)
+
+
+def values_to_runs(values) -> array:
+    """Return (start, length - 1) pairs of sorted unique values"""
+    runs = array("H")
+    for value in values:
+        if runs and runs[-2] + runs[-1] + 1 == value:
+            runs[-1] += 1
+        else:
+            runs.extend((value, 0))
+    return runs
+
+
+def best_container(bits: int = None, values: array = None):
+    """Return the smallest container holding the chunk given as bitmap or sorted values"""
+    if values is None:
+        count = _popcount(bits)
+        runs_count = _popcount(bits & ~(bits << 1))
+    else:
+        count = len(values)
+        runs_count = sum(
+            1 for position, value in enumerate(values)
+            if not position or values[position - 1] + 1 != value
+        )
+    sizes = {ARRAY_CONTAINER: 2 * count, BITMAP_CONTAINER: BITMAP_BYTES, RUN_CONTAINER: 4 * runs_count}
+    kind = min(sizes, key=lambda kind: (sizes[kind], kind))
+    if kind == BITMAP_CONTAINER:
+        return BitmapContainer(bits if bits is not None else values_to_bits(values), count)
+    if values is None:
+        values = bits_to_values(bits)
+    if kind == RUN_CONTAINER:
+        return RunContainer(values_to_runs(values))
+    return ArrayContainer(values)
+
+
+class RoaringBitmap:
+    """Read-only sorted set of document ids in roaring chunks"""
+    def __init__(self, containers: dict):
+        self._keys = sorted(key for key, container in containers.items() if len(container))
+        self._containers = containers
+        self._count = sum(len(containers[key]) for key in self._keys)
+
+    @classmethod
+    def from_sorted(cls, doc_ids):
+        """Build roaring bitmap from sorted unique document ids"""
+        containers = {}
+        key, values = None, None
+        for doc_id in doc_ids:
+            if doc_id >> CHUNK_BITS != key:
+                if values:
+                    containers[key] = best_container(values=values)
+                key, values = doc_id >> CHUNK_BITS, array("H")
+            values.append(doc_id & LOW_MASK)
+        if values:
+            containers[key] = best_container(values=values)
+        return cls(containers)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self):
+        for key in self._keys:
+            base = key << CHUNK_BITS
+            for value in self._containers[key]:
+                yield base + value
+
+    def __contains__(self, doc_id) -> bool:
+        container = self._containers.get(doc_id >> CHUNK_BITS)
+        return container is not None and (doc_id & LOW_MASK) in container
+
+    def __eq__(self, other):
+        return isinstance(other, RoaringBitmap) and list(self) == list(other)
+
+    def intersection(self, doc_ids) -> list:
+        """Return sorted document ids present both here and in doc_ids"""
+        return [doc_id for doc_id in sorted(doc_ids) if doc_id in self]
+
+    def __and__(self, other):
+        containers = {}
+        for key in set(self._keys).intersection(other._keys):
+            left, right = self._containers[key], other._containers[key]
+            if isinstance(right, ArrayContainer) and not isinstance(left, ArrayContainer):
+                left, right = right, left
+            if isinstance(left, ArrayContainer):
+                values = array("H", (value for value in left.values if value in right))
+                if values:
+                    containers[key] = ArrayContainer(values)
+            else:
+                bits = left.to_bits() & right.to_bits()
+                if bits:
+                    containers[key] = best_container(bits=bits)
+        return RoaringBitmap(containers)
+
+    def __or__(self, other):
+        containers = {}
+        for key in set(self._keys).union(other._keys):
+            left, right = self._containers.get(key), other._containers.get(key)
+            if left is None or right is None:
+                containers[key] = left if right is None else right
+            else:
+                containers[key] = best_container(bits=left.to_bits() | right.to_bits())
+        return RoaringBitmap(containers)
+
+    def __sub__(self, other):
+        containers = {}
+        for key in self._keys:
+            left, right = self._containers[key], other._containers.get(key)
+            if right is None:
+                containers[key] = left
+            elif isinstance(left, ArrayContainer):
+                values = array("H", (value for value in left.values if value not in right))
+                if values:
+                    containers[key] = ArrayContainer(values)
+            else:
+                bits = left.to_bits() & ~right.to_bits()
+                if bits:
+                    containers[key] = best_container(bits=bits)
+        return RoaringBitmap(containers)
+
+    def serialize(self) -> bytes:
+        """Return serialized bitmap"""
+        out = bytearray()
+        encode_varint(len(self._keys), out)
+        for key in self._keys:
+            container = self._containers[key]
+            encode_varint(key, out)
+            out.append(container.KIND)
+            out += container.payload()
+        return bytes(out)
+
+    @classmethod
+    def deserialize(cls, buffer):
+        """Read bitmap written by serialize"""
+        containers = {}
+        count, offset = decode_varint(buffer, 0)
+        for _ in range(count):
+            key, offset = decode_varint(buffer, offset)
+            kind = buffer[offset]
+            offset += 1
+            if kind == BITMAP_CONTAINER:
+                containers[key] = BitmapContainer(
+                    int.from_bytes(buffer[offset:offset + BITMAP_BYTES], "little")
+                )
+                offset += BITMAP_BYTES
+                continue
+            size, offset = decode_varint(buffer, offset)
+            if kind == RUN_CONTAINER:
+                size *= 2
+            values = _uint16_array(buffer[offset:offset + 2 * size])
+            offset += 2 * size
+            containers[key] = RunContainer(values) if kind == RUN_CONTAINER else ArrayContainer(values)
+        return cls(containers)
@@ -0,0 +1,308 @@
+"""
+Segmented inverted index.
+
+The index is a directory of immutable segments, each segment is a regular
+index file with its own term dictionary and optional sections. The
+MANIFEST file lists live segments and is replaced atomically, so readers
+always see a complete set of segments. New documents are written as new
+segments, queries are evaluated on every segment and their results are
+merged. A tiered merge policy combines segments of similar size whenever
+a tier grows too large, which keeps the number of segments logarithmic
+in the size of the collection. Ranked queries score every segment with
+collection statistics summed over all segments.
+"""
+
+from collections import defaultdict
+from collections import namedtuple
+import heapq
+from itertools import islice
+import json
+import math
+import os
+
+from analysis import ANALYZER_FILE_SUFFIX
+from analysis import DEFAULT_ANALYZER_NAME
+from analysis import get_analyzer
+from incremental_index import TombstoneSet
+from incremental_index import write_merged_index
+from inverted_index import INDEX_SECTIONS
+from inverted_index import InvertedIndex
+from inverted_index import build_inverted_index
+from query_engine import union_all
+from query_language import And
+from query_language import Fuzzy
+from query_language import Term
+from query_language import conjunctive_terms
+from query_language import parse_query
+from query_language import query_terms
+from ranking import DEFAULT_TOP_K
+from storage_policy import DEFAULT_STORAGE_POLICY
+from storage_policy import POLICIES_BY_ID
+
+MANIFEST_FILENAME = "MANIFEST"
+MANIFEST_VERSION = 1
+SEGMENT_FILENAME_TEMPLATE = "segment_{:06d}.index"
+DEFAULT_SEGMENTS_PER_TIER = 10
+DEFAULT_MAX_MERGE_AT_ONCE = 10
+DEFAULT_FLOOR_SEGMENT_SIZE = 2 ** 20
+
+SegmentInfo = namedtuple("SegmentInfo", ["name", "documents_count", "size", "max_doc_id"])
+
+
+class TieredMergePolicy:
+    """Merge segments of similar size once a tier holds too many of them
+
+    Sizes below floor_size are rounded up to it, so tiny segments share the
+    lowest tier. A segment of size s belongs to tier
+    floor(log(s / floor_size, segments_per_tier)).
+    """
+    def __init__(self, segments_per_tier: int = DEFAULT_SEGMENTS_PER_TIER,
+                 max_merge_at_once: int = DEFAULT_MAX_MERGE_AT_ONCE,
+                 floor_size: int = DEFAULT_FLOOR_SEGMENT_SIZE):
+        if segments_per_tier < 2 or max_merge_at_once < 2:
+            raise ValueError("Merge policy needs at least two segments per tier and merge.")
+        self.segments_per_tier = segments_per_tier
+        self.max_merge_at_once = max_merge_at_once
+        self.floor_size = floor_size
+
+    def tier(self, size: int) -> int:
+        """Return tier of a segment of the given size in bytes"""
+        return int(math.log(max(size, self.floor_size) / self.floor_size, self.segments_per_tier))
+
+    def find_merges(self, segments: list) -> list:
+        """Return groups of segment infos to merge, the smallest segments of a full tier first"""
+        tiers = defaultdict(list)
+        for segment in segments:
+            tiers[self.tier(segment.size)].append(segment)
+        merges = []
+        for tier in sorted(tiers):
+            members = sorted(tiers[tier], key=lambda segment: segment.size)
+            while len(members) >= self.segments_per_tier:
+                merges.append(members[:self.max_merge_at_once])
+                members = members[self.max_merge_at_once:]
+        return merges
+
+
+def segment_files_size(segment_filepath: str) -> int:
+    """Return total size of a segment file and its sections"""
+    return sum(
+        os.path.getsize(filepath)
+        for filepath in [segment_filepath] + [
+            f"{segment_filepath}{suffix}" for suffix, _ in INDEX_SECTIONS.values()
+        ]
+        if os.path.exists(filepath)
+    )
+
+
+class SegmentedIndex:
+    """Inverted index split into immutable segments listed in a manifest"""
+    def __init__(self, directory: str, storage_policy=None,
+                 merge_policy: TieredMergePolicy = None, query_cache=None, analyzer=None,
+                 lazy: bool = False):
+        self.directory = str(directory)
+        self.lazy = lazy
+        self.merge_policy = merge_policy or TieredMergePolicy()
+        self.query_cache = query_cache
+        self.segments = []
+        self._next_segment_id = 1
+        os.makedirs(self.directory, exist_ok=True)
+        manifest_filepath = os.path.join(self.directory, MANIFEST_FILENAME)
+        if os.path.exists(manifest_filepath):
+            with open(manifest_filepath, "r") as fin:
+                manifest = json.load(fin)
+            if manifest.get("version") != MANIFEST_VERSION:
+                raise ValueError(f"{manifest_filepath} has unsupported version.")
+            self.storage_policy = storage_policy or POLICIES_BY_ID[manifest["storage_policy"]]
+            self._next_segment_id = manifest["next_segment_id"]
+            self.analyzer = analyzer or get_analyzer(
+                manifest.get("analyzer", DEFAULT_ANALYZER_NAME)
+            )
+            for info in manifest["segments"]:
+                info = SegmentInfo(**info)
+                self.segments.append((info, self._load_segment(info.name)))
+        else:
+            self.storage_policy = storage_policy or DEFAULT_STORAGE_POLICY
+            self.analyzer = analyzer or get_analyzer()
+            self._write_manifest()
+
+    @classmethod
+    def create(cls, directory: str, storage_policy=DEFAULT_STORAGE_POLICY,
+               merge_policy: TieredMergePolicy = None, analyzer=None):
+        """Create an empty segmented index, dropping segments of an existing one"""
+        if os.path.exists(os.path.join(str(directory), MANIFEST_FILENAME)):
+            cls(directory).clear()
+        segmented_index = cls(directory, storage_policy=storage_policy,
+                              merge_policy=merge_policy, analyzer=analyzer)
+        segmented_index._write_manifest()
+        return segmented_index
+
+    def _segment_filepath(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load_segment(self, name: str) -> InvertedIndex:
+        return InvertedIndex.load(self._segment_filepath(name), storage_policy=self.storage_policy,
+                                  lazy=self.lazy)
+
+    def _write_manifest(self):
+        """Atomically replace the manifest with the current list of segments"""
+        manifest_filepath = os.path.join(self.directory, MANIFEST_FILENAME)
+        with open(f"{manifest_filepath}.tmp", "w") as fout:
+            json.dump({
+                "version": MANIFEST_VERSION,
+                "storage_policy": self.storage_policy.POLICY_ID,
+                "analyzer": self.analyzer.name,
+                "next_segment_id": self._next_segment_id,
+                "segments": [info._asdict() for info, _ in self.segments],
+            }, fout, indent=2)
+        os.replace(f"{manifest_filepath}.tmp", manifest_filepath)
+
+    def _new_segment_name(self) -> str:
+        name = SEGMENT_FILENAME_TEMPLATE.format(self._next_segment_id)
+        self._next_segment_id += 1
+        return name
+
+    def _remove_segment_files(self, name: str):
+        segment_filepath = self._segment_filepath(name)
+        for filepath in [segment_filepath, f"{segment_filepath}{ANALYZER_FILE_SUFFIX}"] + [
+            f"{segment_filepath}{suffix}" for suffix, _ in INDEX_SECTIONS.values()
+        ]:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+    @property
+    def generation(self) -> tuple:
+        """Changes whenever the set of segments changes"""
+        return tuple(segment.generation for _, segment in self.segments)
+
+    def add_documents(self, documents: dict, positional: bool = False,
+                      ranked: bool = False) -> SegmentInfo:
+        """Write documents as a new segment and run merges the policy asks for
+
+        Doc ids have to be new to the index, segments never overlap.
+        """
+        name = self._new_segment_name()
+        segment_filepath = self._segment_filepath(name)
+        build_inverted_index(documents, positional=positional, ranked=ranked,
+                             analyzer=self.analyzer).dump(
+            segment_filepath, storage_policy=self.storage_policy
+        )
+        info = SegmentInfo(name, len(documents), segment_files_size(segment_filepath),
+                           max(documents, default=0))
+        self.segments.append((info, self._load_segment(name)))
+        self._write_manifest()
+        self.maybe_merge()
+        return info
+
+    def maybe_merge(self) -> int:
+        """Merge segments until the policy is satisfied, return number of merges"""
+        merges_count = 0
+        merges = self.merge_policy.find_merges([info for info, _ in self.segments])
+        while merges:
+            for infos in merges:
+                self.merge_segments([info.name for info in infos])
+                merges_count += 1
+            merges = self.merge_policy.find_merges([info for info, _ in self.segments])
+        return merges_count
+
+    def merge_segments(self, names: list) -> SegmentInfo:
+        """Replace the named segments with a single merged one"""
+        merged = [(info, segment) for info, segment in self.segments if info.name in names]
+        segments = [segment for _, segment in merged]
+        section_names = [
+            name for name in INDEX_SECTIONS
+            if all(name in segment.section_filepaths for segment in segments)
+        ]
+        max_doc_id = max(info.max_doc_id for info, _ in merged)
+        name = self._new_segment_name()
+        segment_filepath = self._segment_filepath(name)
+        write_merged_index(segments, [TombstoneSet() for _ in segments], segment_filepath,
+                           self.storage_policy, section_names, max_doc_id)
+        info = SegmentInfo(name, sum(info.documents_count for info, _ in merged),
+                           segment_files_size(segment_filepath), max_doc_id)
+        position = self.segments.index(merged[0])
+        remaining = [entry for entry in self.segments if entry[0].name not in names]
+        remaining.insert(position, (info, self._load_segment(name)))
+        self.segments = remaining
+        self._write_manifest()
+        for old_info, _ in merged:
+            self._remove_segment_files(old_info.name)
+        return info
+
+    def clear(self):
+        """Drop all segments"""
+        names = [info.name for info, _ in self.segments]
+        self.segments = []
+        self._write_manifest()
+        for name in names:
+            self._remove_segment_files(name)
+
+    def evaluate(self, query) -> list:
+        """Return sorted list of documents matching the parsed query tree in any segment"""
+        terms = conjunctive_terms(query)
+        key = frozenset(terms) if terms is not None else repr(query)
+        if self.query_cache is not None:
+            result = self.query_cache.get(key, self.generation)
+            if result is not None:
+                return result
+        result = union_all([query.evaluate(segment) for _, segment in self.segments])
+        if self.query_cache is not None:
+            cost = sum(
+                len(segment.get_postings(term) or ())
+                for _, segment in self.segments for term in query_terms(query)
+            )
+            self.query_cache.put(key, result, cost, self.generation)
+        return result
+
+    def search(self, query: str) -> list:
+        """Return sorted list of documents matching the boolean query string"""
+        return self.evaluate(parse_query(query, self.analyzer))
+
+    def query(self, words: list, max_edits: int = 0) -> list:
+        """Return sorted list of documents containing all the words, fuzzily with max_edits"""
+        if not self.analyzer.keeps_terms:
+            words = self.analyzer.analyze(" ".join(words))
+        terms = [
+            Fuzzy(word, max_edits) if max_edits else Term(word) for word in sorted(set(words))
+        ]
+        if not terms:
+            return []
+        return self.evaluate(terms[0] if len(terms) == 1 else And(terms))
+
+    def rank(self, words: list, top_k: int = DEFAULT_TOP_K, pruning: bool = True) -> list:
+        """Return up to top_k (doc id, score) pairs ranked by BM25 over all segments"""
+        documents_count, total_length, document_frequencies = 0, 0, {}
+        for _, segment in self.segments:
+            segment_count, segment_length, segment_frequencies = (
+                segment.collection_statistics(words)
+            )
+            documents_count += segment_count
+            total_length += segment_length
+            for term, frequency in segment_frequencies.items():
+                document_frequencies[term] = document_frequencies.get(term, 0) + frequency
+        average_length = total_length / documents_count if documents_count else 0
+        statistics = (documents_count, average_length, document_frequencies)
+        return heapq.nsmallest(
+            top_k,
+            (pair for _, segment in self.segments
+             for pair in segment.rank(words, top_k, pruning, statistics)),
+            key=lambda pair: (-pair[1], pair[0]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+
+def build_segmented_index(documents, directory: str, segment_size: int,
+                          storage_policy=DEFAULT_STORAGE_POLICY, positional: bool = False,
+                          ranked: bool = False, merge_policy: TieredMergePolicy = None,
+                          analyzer=None):
+    """Build segmented index from (doc id, document) pairs, segment_size documents at a time"""
+    segmented_index = SegmentedIndex.create(directory, storage_policy=storage_policy,
+                                            merge_policy=merge_policy, analyzer=analyzer)
+    documents = iter(documents)
+    while True:
+        batch = dict(islice(documents, segment_size))
+        if not batch:
+            break
+        segmented_index.add_documents(batch, positional=positional, ranked=ranked)
+    return segmented_index
@@ -0,0 +1,278 @@
+"""
+Document-partitioned sharded inverted index.
+
+The dataset is split into byte ranges aligned to line boundaries, every
+range becomes a shard: a regular index file holding only its documents,
+so every document lives in exactly one shard. Shards are listed in a
+manifest in the index directory.
+
+A ShardedIndex is the coordinator: it starts one worker process per
+shard, each worker loads its shard once and answers requests sent over
+a pipe. A query is sent to every worker at once and the per-shard
+results are merged: boolean results are unions of disjoint sorted lists,
+ranked results are the best top_k of the per-shard top_k lists. Ranking
+takes two round trips, the first one sums collection statistics over the
+shards, so scores are the same as those of a single index.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+from itertools import count
+import json
+import multiprocessing
+import os
+import threading
+
+from analysis import DEFAULT_ANALYZER_NAME
+from analysis import get_analyzer
+from dataset import MappedDataset
+from inverted_index import InvertedIndex
+from inverted_index import build_inverted_index
+from inverted_index import remove_stale_sections
+from inverted_index import split_dataset
+from query_language import conjunctive_terms
+from query_language import parse_query
+from query_language import query_terms
+from ranking import DEFAULT_TOP_K
+from storage_policy import DEFAULT_STORAGE_POLICY
+from storage_policy import POLICIES_BY_ID
+
+SHARDS_MANIFEST_FILENAME = "shards.json"
+SHARDS_MANIFEST_VERSION = 1
+SHARD_FILENAME_TEMPLATE = "shard-{:04d}.index"
+
+ShardInfo = namedtuple("ShardInfo", ["name", "documents_count"])
+
+_sharded_index_generations = count()
+
+
+def is_sharded_index(filepath: str) -> bool:
+    """Whether the path is a sharded index directory"""
+    return os.path.isfile(os.path.join(str(filepath), SHARDS_MANIFEST_FILENAME))
+
+
+def _build_shard(dataset_filepath: str, start: int, end: int, shard_filepath: str,
+                 storage_policy, positional: bool, ranked: bool, analyzer_name: str) -> int:
+    """Index documents of the byte range into the shard file, return their number"""
+    with MappedDataset(dataset_filepath, start, end) as documents:
+        build_inverted_index(documents, positional=positional, ranked=ranked,
+                             analyzer=get_analyzer(analyzer_name)).dump(
+            shard_filepath, storage_policy=storage_policy
+        )
+        return len(documents)
+
+
+def _remove_shard_files(shard_filepath: str):
+    if os.path.exists(shard_filepath):
+        os.remove(shard_filepath)
+    remove_stale_sections(shard_filepath)
+
+
+def read_shards_manifest(directory: str) -> dict:
+    """Return the manifest of the sharded index directory"""
+    manifest_filepath = os.path.join(str(directory), SHARDS_MANIFEST_FILENAME)
+    with open(manifest_filepath, "r") as fin:
+        manifest = json.load(fin)
+    if manifest.get("version") != SHARDS_MANIFEST_VERSION:
+        raise ValueError(f"{manifest_filepath} has unsupported version.")
+    return manifest
+
+
+def build_sharded_index(dataset_filepath: str, directory: str, shards: int,
+                        storage_policy=DEFAULT_STORAGE_POLICY, positional: bool = False,
+                        ranked: bool = False, analyzer_name: str = DEFAULT_ANALYZER_NAME,
+                        workers: int = 1) -> list:
+    """Build shards of the dataset in the directory, workers of them at a time
+
+    The manifest is replaced once all shards are written, shards of a
+    previous build left out of the new one are removed afterwards.
+    """
+    if shards < 1:
+        raise ValueError("A sharded index needs at least one shard.")
+    directory = str(directory)
+    os.makedirs(directory, exist_ok=True)
+    old_names = []
+    if is_sharded_index(directory):
+        old_names = [info["name"] for info in read_shards_manifest(directory)["shards"]]
+    ranges = split_dataset(dataset_filepath, shards)
+    end = ranges[-1][1] if ranges else 0
+    ranges += [(end, end)] * (shards - len(ranges))
+    names = [SHARD_FILENAME_TEMPLATE.format(shard) for shard in range(shards)]
+    arguments = [
+        (dataset_filepath, start, end, os.path.join(directory, name), storage_policy,
+         positional, ranked, analyzer_name)
+        for name, (start, end) in zip(names, ranges)
+    ]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            counts = list(executor.map(_build_shard, *zip(*arguments)))
+    else:
+        counts = [_build_shard(*shard_arguments) for shard_arguments in arguments]
+    infos = [ShardInfo(name, documents_count) for name, documents_count in zip(names, counts)]
+    manifest_filepath = os.path.join(directory, SHARDS_MANIFEST_FILENAME)
+    with open(f"{manifest_filepath}.tmp", "w") as fout:
+        json.dump({
+            "version": SHARDS_MANIFEST_VERSION,
+            "storage_policy": storage_policy.POLICY_ID,
+            "analyzer": analyzer_name,
+            "shards": [info._asdict() for info in infos],
+        }, fout, indent=2)
+    os.replace(f"{manifest_filepath}.tmp", manifest_filepath)
+    for name in set(old_names) - set(names):
+        _remove_shard_files(os.path.join(directory, name))
+    return infos
+
+
+def _evaluate_on_shard(shard: InvertedIndex, query) -> tuple:
+    """Return matching doc ids and the number of postings the query touched"""
+    cost = sum(len(shard.get_postings(term) or ()) for term in query_terms(query))
+    return query.evaluate(shard), cost
+
+
+SHARD_COMMANDS = {
+    "evaluate": _evaluate_on_shard,
+    "query": InvertedIndex.query,
+    "statistics": InvertedIndex.collection_statistics,
+    "rank": InvertedIndex.rank,
+}
+
+
+def serve_shard(connection, shard_filepath: str, storage_policy, lazy: bool = False):
+    """Answer (command, arguments) requests against the shard until None is received
+
+    Every reply is (True, result) or (False, exception).
+    """
+    try:
+        shard = InvertedIndex.load(shard_filepath, storage_policy=storage_policy, lazy=lazy)
+    except Exception as error:
+        connection.send((False, error))
+        return
+    connection.send((True, None))
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        command, arguments = request
+        try:
+            connection.send((True, SHARD_COMMANDS[command](shard, *arguments)))
+        except Exception as error:
+            connection.send((False, error))
+    connection.close()
+
+
+class ShardedIndex:
+    """Coordinator of a sharded index, fanning queries out to one worker process per shard
+
+    Requests are serialized by a lock, so the index can be shared
+    between threads. Close it to stop the workers, they are daemonic and
+    stop with the process otherwise.
+    """
+    def __init__(self, directory: str, storage_policy=None, query_cache=None,
+                 lazy: bool = False, start_method: str = None):
+        self.directory = str(directory)
+        manifest = read_shards_manifest(self.directory)
+        self.storage_policy = storage_policy or POLICIES_BY_ID[manifest["storage_policy"]]
+        self.shards = [ShardInfo(**info) for info in manifest["shards"]]
+        self.analyzer = get_analyzer(manifest["analyzer"])
+        self.query_cache = query_cache
+        self.generation = ("shards", next(_sharded_index_generations))
+        self._lock = threading.Lock()
+        self._connections = []
+        self._workers = []
+        context = multiprocessing.get_context(start_method)
+        for info in self.shards:
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(
+                target=serve_shard, daemon=True,
+                args=(worker_connection, self._shard_filepath(info.name),
+                      self.storage_policy, lazy),
+            )
+            worker.start()
+            worker_connection.close()
+            self._connections.append(connection)
+            self._workers.append(worker)
+        try:
+            self._receive_all()
+        except Exception:
+            self.close()
+            raise
+
+    def _shard_filepath(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _receive_all(self) -> list:
+        """Return replies of all workers, raising the first error among them"""
+        replies = [connection.recv() for connection in self._connections]
+        for succeeded, result in replies:
+            if not succeeded:
+                raise result
+        return [result for _, result in replies]
+
+    def fan_out(self, command: str, *arguments) -> list:
+        """Run the command on every shard in parallel and return per-shard results"""
+        with self._lock:
+            if not self._connections:
+                raise ValueError("The sharded index is closed.")
+            for connection in self._connections:
+                connection.send((command, arguments))
+            return self._receive_all()
+
+    def evaluate(self, query) -> list:
+        """Return sorted list of documents matching the parsed query tree in any shard"""
+        terms = conjunctive_terms(query)
+        key = frozenset(terms) if terms is not None else repr(query)
+        if self.query_cache is not None:
+            result = self.query_cache.get(key, self.generation)
+            if result is not None:
+                return result
+        results = self.fan_out("evaluate", query)
+        result = list(heapq.merge(*[doc_ids for doc_ids, _ in results]))
+        if self.query_cache is not None:
+            self.query_cache.put(key, result, sum(cost for _, cost in results), self.generation)
+        return result
+
+    def search(self, query: str) -> list:
+        """Return sorted list of documents matching the boolean query string"""
+        return self.evaluate(parse_query(query, self.analyzer))
+
+    def query(self, words: list, max_edits: int = 0) -> list:
+        """Return sorted list of documents containing all the words, fuzzily with max_edits"""
+        return list(heapq.merge(*self.fan_out("query", words, max_edits)))
+
+    def rank(self, words: list, top_k: int = DEFAULT_TOP_K, pruning: bool = True) -> list:
+        """Return up to top_k (doc id, score) pairs ranked by BM25 over all shards, the best first"""
+        documents_count, total_length, document_frequencies = 0, 0, {}
+        for shard_count, shard_length, shard_frequencies in self.fan_out("statistics", words):
+            documents_count += shard_count
+            total_length += shard_length
+            for term, frequency in shard_frequencies.items():
+                document_frequencies[term] = document_frequencies.get(term, 0) + frequency
+        average_length = total_length / documents_count if documents_count else 0
+        statistics = (documents_count, average_length, document_frequencies)
+        results = self.fan_out("rank", words, top_k, pruning, statistics)
+        return heapq.nsmallest(
+            top_k, (pair for result in results for pair in result),
+            key=lambda pair: (-pair[1], pair[0]),
+        )
+
+    def close(self):
+        """Stop the worker processes once the running request is answered"""
+        with self._lock:
+            for connection, worker in zip(self._connections, self._workers):
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+                worker.join()
+                connection.close()
+            self._connections, self._workers = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.shards)
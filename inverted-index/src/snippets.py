@@ -0,0 +1,70 @@
+"""
+Highlighted snippets of query results.
+
+A snippet is the passage of a document holding the most occurrences of
+the query terms, cut at word boundaries, with the occurrences wrapped in
+highlight marks. Documents are tokenized with the analyzer of the index,
+so "Anarchists" is highlighted for the term "anarchist" when the index
+stems plurals.
+"""
+
+import re
+
+DEFAULT_SNIPPET_WIDTH = 160
+DEFAULT_HIGHLIGHT_MARKS = ("<b>", "</b>")
+ELLIPSIS = "..."
+WHITESPACE_PATTERN = re.compile(r"\s")
+
+
+def _best_window(spans: list, width: int) -> tuple:
+    """Return first and last index of the most spans fitting in width characters"""
+    best_first, best_last = 0, 0
+    first = 0
+    for last, (_, end) in enumerate(spans):
+        while first < last and end - spans[first][0] > width:
+            first += 1
+        if last - first > best_last - best_first:
+            best_first, best_last = first, last
+    return best_first, best_last
+
+
+def make_snippet(text: str, terms, analyzer, width: int = DEFAULT_SNIPPET_WIDTH,
+                 marks: tuple = DEFAULT_HIGHLIGHT_MARKS) -> str:
+    """Return about width characters of the text around the query terms, highlighted"""
+    terms = set(terms)
+    spans = [(start, end) for start, end, term in analyzer.analyze_spans(text) if term in terms]
+    if spans:
+        first, last = _best_window(spans, width)
+        covered_start, covered_end = spans[first][0], spans[last][1]
+        start = max(0, covered_start - max(0, width - covered_end + covered_start) // 2)
+    else:
+        covered_start = covered_end = start = 0
+    end = min(len(text), max(start + width, covered_end))
+    start = max(0, min(start, end - width, covered_start))
+    if start > 0 and not WHITESPACE_PATTERN.match(text[start - 1]):
+        boundary = WHITESPACE_PATTERN.search(text, start, covered_start if spans else end)
+        if boundary is not None:
+            start = boundary.end()
+    if end < len(text) and not WHITESPACE_PATTERN.match(text[end]):
+        boundaries = list(WHITESPACE_PATTERN.finditer(text, covered_end, end))
+        if boundaries:
+            end = boundaries[-1].start()
+    pieces = [ELLIPSIS] if start > 0 else []
+    position = start
+    for span_start, span_end in spans:
+        if span_start >= start and span_end <= end:
+            pieces += [text[position:span_start], marks[0], text[span_start:span_end], marks[1]]
+            position = span_end
+    pieces.append(text[position:end])
+    if end < len(text):
+        pieces.append(ELLIPSIS)
+    return " ".join("".join(pieces).split())
+
+
+def make_snippets(document_store, doc_ids, terms, analyzer,
+                  width: int = DEFAULT_SNIPPET_WIDTH) -> list:
+    """Return (doc id, snippet) pairs for the stored documents among doc ids"""
+    return [
+        (doc_id, make_snippet(document_store[doc_id], terms, analyzer, width))
+        for doc_id in doc_ids if doc_id in document_store
+    ]
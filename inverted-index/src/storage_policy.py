@@ -1,8 +1,852 @@
+"""
+Storage policies define how an inverted index is laid out on disk.
+
+Every policy provides two class-level methods: dump writes a mapping
+of terms to document ids to a file, load reads it back as a mapping.
+
+All files start with a common versioned header, so a file can be checked
+for compatibility before its payload is touched.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from collections import namedtuple
+from collections.abc import Mapping
+from contextlib import contextmanager
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from fuzzy import fuzzy_terms
+from posting_list import BitPackedCodec
+from posting_list import CompressedPostingList
+from roaring import RoaringBitmap
+from term_dictionary import FrontCodedTermDictionary
+from term_dictionary import SortedTermDictionary
+from term_dictionary import TermDictionary
+from posting_list import TermPositions
+from posting_list import VarByteCodec
+from posting_list import decode_varint
+from posting_list import encode_varint
+
+FORMAT_MAGIC = b"INVINDEX"
+FORMAT_VERSION = 1
+FILE_HEADER = struct.Struct("<8sHHBB2xQI4x")
+CHECKSUM_CHUNK_SIZE = 1 << 20
+DOCUMENT_BLOCK_SIZE = 1 << 16
+CACHED_DOCUMENT_BLOCKS = 4
+DEFAULT_CACHED_POSTINGS = 256
+ZLIB_CODEC_ID = 1
+ZSTD_CODEC_ID = 2
+
+IndexHeader = namedtuple(
+    "IndexHeader",
+    ["version", "policy_id", "doc_id_width", "length_width", "payload_size", "checksum"],
+)
+
+
+class IndexFormatError(ValueError):
+    """Raised when an index file is incompatible with the reader"""
+
+
+def width_for(max_value: int) -> int:
+    """Return the smallest supported integer width in bytes for max_value"""
+    return 4 if max_value < (1 << 32) else 8
+
+
+def read_header(fin, storage_policy=None) -> IndexHeader:
+    """Read and validate the file header, leaving fin at the payload start"""
+    name = getattr(fin, "name", "index file")
+    raw_header = fin.read(FILE_HEADER.size)
+    if len(raw_header) < FILE_HEADER.size:
+        raise IndexFormatError(f"{name} is too short to be an inverted index.")
+    magic, *fields = FILE_HEADER.unpack(raw_header)
+    header = IndexHeader(*fields)
+    if magic != FORMAT_MAGIC:
+        raise IndexFormatError(f"{name} is not an inverted index file.")
+    if header.version > FORMAT_VERSION:
+        raise IndexFormatError(
+            f"{name} has format version {header.version}, "
+            f"but only versions up to {FORMAT_VERSION} are supported."
+        )
+    if header.policy_id not in POLICIES_BY_ID:
+        raise IndexFormatError(f"{name} uses unknown storage policy {header.policy_id}.")
+    if storage_policy is not None and header.policy_id != storage_policy.POLICY_ID:
+        raise IndexFormatError(
+            f"{name} was written by {POLICIES_BY_ID[header.policy_id].__name__}, "
+            f"not by {storage_policy.__name__}."
+        )
+    if header.doc_id_width not in (4, 8) or header.length_width not in (4, 8):
+        raise IndexFormatError(f"{name} uses unsupported integer widths.")
+    file_size = os.fstat(fin.fileno()).st_size
+    if file_size != FILE_HEADER.size + header.payload_size:
+        raise IndexFormatError(
+            f"{name} is truncated or corrupted: expected "
+            f"{FILE_HEADER.size + header.payload_size} bytes, found {file_size}."
+        )
+    return header
+
+
+def detect_storage_policy(filepath: str):
+    """Return storage policy class that wrote the index file"""
+    with open(filepath, "rb") as fin:
+        return POLICIES_BY_ID[read_header(fin).policy_id]
+
+
+def verify_checksum(filepath: str):
+    """Check the payload checksum of the index file, reading it in chunks"""
+    with open(filepath, "rb") as fin:
+        header = read_header(fin)
+        checksum = 0
+        for chunk in iter(lambda: fin.read(CHECKSUM_CHUNK_SIZE), b""):
+            checksum = zlib.crc32(chunk, checksum)
+    if checksum != header.checksum:
+        raise IndexFormatError(f"{filepath} checksum mismatch, the file is corrupted.")
+
+
+class ChecksumWriter:
+    """File wrapper counting size and CRC32 of everything written"""
+    def __init__(self, fout):
+        self._fout = fout
+        self.size = 0
+        self.checksum = 0
+
+    def write(self, data) -> int:
+        """Write data to the wrapped file"""
+        self.checksum = zlib.crc32(data, self.checksum)
+        self.size += len(data)
+        return self._fout.write(data)
+
+
+@contextmanager
+def open_for_dump(filepath: str, storage_policy, doc_id_width: int = 4, length_width: int = 8):
+    """Open index file for writing and fill in its header once payload is written
+
+    The file is written next to the target and replaced into place when
+    complete, so readers that have the old file memory-mapped keep it.
+    """
+    tmp_filepath = f"{filepath}.tmp"
+    try:
+        with open(tmp_filepath, "wb") as fout:
+            fout.write(bytes(FILE_HEADER.size))
+            writer = ChecksumWriter(fout)
+            yield writer
+            fout.seek(0)
+            fout.write(FILE_HEADER.pack(
+                FORMAT_MAGIC, FORMAT_VERSION, storage_policy.POLICY_ID,
+                doc_id_width, length_width, writer.size, writer.checksum,
+            ))
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+    os.replace(tmp_filepath, filepath)
+
+
+class StructStoragePolicy:
+    """Length-prefixed big-endian format with 32 or 64 bit integers"""
+    POLICY_ID = 1
+
+    @classmethod
+    def dump(cls, word_to_docs_mapping, filepath: str):
+        """Write term to documents mapping to disk"""
+        max_doc_id = max((max(vals) for vals in word_to_docs_mapping.values() if vals), default=0)
+        max_length = max(
+            (max(len(key.encode("utf-8")), len(vals))
+             for key, vals in word_to_docs_mapping.items()),
+            default=0,
+        )
+        doc_id_width = width_for(max_doc_id)
+        length_width = width_for(max(max_length, len(word_to_docs_mapping)))
+        doc_id_code = _struct_code(doc_id_width)
+        length_code = _struct_code(length_width)
+        with open_for_dump(filepath, cls, doc_id_width, length_width) as fout:
+            fout.write(struct.pack(f">{length_code}", len(word_to_docs_mapping)))
+            for key, vals in word_to_docs_mapping.items():
+                key = bytes(key, 'utf-8')
+                fout.write(struct.pack(f">{length_code}{len(key)}s", len(key), key))
+                fout.write(struct.pack(f">{length_code}", len(vals)))
+                fout.write(struct.pack(f">{len(vals)}{doc_id_code}", *vals))
+
+    @classmethod
+    def load(cls, filepath: str) -> dict:
+        """Read term to documents mapping from disk"""
+        with open(filepath, "rb") as fin:
+            header = read_header(fin, cls)
+            payload = fin.read()
+        if zlib.crc32(payload) != header.checksum:
+            raise IndexFormatError(f"{filepath} checksum mismatch, the file is corrupted.")
+
+        encoding = 'utf-8'
+        doc_id_code = _struct_code(header.doc_id_width)
+        length = struct.Struct(f">{_struct_code(header.length_width)}")
+        index_len, offset = length.unpack_from(payload)[0], length.size
+        word_to_docs_mapping = {}
+        for _ in range(index_len):
+            key_len = length.unpack_from(payload, offset)[0]
+            offset += length.size
+            key = payload[offset:offset + key_len].decode(encoding)
+            offset += key_len
+            vals_num = length.unpack_from(payload, offset)[0]
+            offset += length.size
+            vals = struct.unpack_from(f">{vals_num}{doc_id_code}", payload, offset)
+            offset += vals_num * header.doc_id_width
+            word_to_docs_mapping[key] = set(vals)
+
+        return word_to_docs_mapping
+
+    @classmethod
+    def load_lazy(cls, filepath: str) -> "StructIndexMapping":
+        """Memory-map the index file and return a mapping decoding posting lists on access
+
+        Only term headers are read up front, the payload checksum is not
+        verified.
+        """
+        with open(filepath, "rb") as fin:
+            header = read_header(fin, cls)
+            buffer = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        return StructIndexMapping(buffer, header.doc_id_width, header.length_width)
+
+
+class PostingsCache:
+    """LRU of decoded posting lists, safe to share between threads"""
+    def __init__(self, max_size: int = DEFAULT_CACHED_POSTINGS):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, decode):
+        """Return the cached posting list, decoding and caching it on a miss"""
+        with self._lock:
+            postings = self._entries.get(key)
+            if postings is not None:
+                self._entries.move_to_end(key)
+                return postings
+        postings = decode()
+        with self._lock:
+            self._entries[key] = postings
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return postings
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class StructIndexMapping(Mapping):
+    """Read-only term to documents mapping over a memory-mapped StructStoragePolicy file
+
+    The constructor walks the term headers only, skipping posting lists,
+    to build a term to (offset, count) dictionary. Posting lists are
+    decoded into frozensets on first access and the hot ones are kept in
+    a PostingsCache.
+    """
+    def __init__(self, buffer, doc_id_width: int, length_width: int,
+                 cached_postings: int = DEFAULT_CACHED_POSTINGS):
+        self._buffer = buffer
+        self._doc_id_code = _struct_code(doc_id_width)
+        self._doc_id_width = doc_id_width
+        self._postings_cache = PostingsCache(cached_postings)
+        self._offsets = {}
+        length = struct.Struct(f">{_struct_code(length_width)}")
+        offset = FILE_HEADER.size
+        index_len = length.unpack_from(buffer, offset)[0]
+        offset += length.size
+        for _ in range(index_len):
+            key_len = length.unpack_from(buffer, offset)[0]
+            offset += length.size
+            key = buffer[offset:offset + key_len]
+            offset += key_len
+            vals_num = length.unpack_from(buffer, offset)[0]
+            offset += length.size
+            self._offsets[key] = (offset, vals_num)
+            offset += vals_num * doc_id_width
+
+    def _decode(self, offset: int, count: int) -> frozenset:
+        return frozenset(struct.unpack_from(f">{count}{self._doc_id_code}", self._buffer, offset))
+
+    def __getitem__(self, term: str) -> frozenset:
+        location = self._offsets.get(term.encode("utf-8")) if isinstance(term, str) else None
+        if location is None:
+            raise KeyError(term)
+        return self._postings_cache.get(location[0], lambda: self._decode(*location))
+
+    def __contains__(self, term) -> bool:
+        return isinstance(term, str) and term.encode("utf-8") in self._offsets
+
+    def __iter__(self):
+        for term in self._offsets:
+            yield term.decode("utf-8")
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+
+class ArrayIndexMapping(Mapping):
+    """Read-only term to documents mapping backed by a memory-mapped file
+
+    Terms are kept sorted by their UTF-8 bytes in a term dictionary, so a
+    lookup is a binary search and prefix or range queries return adjacent
+    positions. Posting lists are returned as zero-copy memoryview slices of
+    the mapped postings array.
+    """
+    def __init__(self, buffer, postings, posting_offsets, terms: TermDictionary):
+        self._buffer = buffer
+        self._postings = postings
+        self._posting_offsets = posting_offsets
+        self._terms = terms
+        self._postings_cache = PostingsCache()
+
+    def _find(self, term: bytes) -> int:
+        """Return the position of the term or -1 if it is absent"""
+        return self._terms.find(term)
+
+    def _postings_at(self, position: int):
+        """Return posting list of the term stored at the given position"""
+        start = self._posting_offsets[position]
+        end = self._posting_offsets[position + 1]
+        return self._postings[start:end]
+
+    def __getitem__(self, term: str):
+        position = self._find(term.encode("utf-8"))
+        if position < 0:
+            raise KeyError(term)
+        return self._postings_at(position)
+
+    def __contains__(self, term) -> bool:
+        return isinstance(term, str) and self._find(term.encode("utf-8")) >= 0
+
+    def __iter__(self):
+        for term in self._terms:
+            yield term.decode("utf-8")
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def keys_with_prefix(self, prefix: str):
+        """Yield terms starting with prefix in sorted order"""
+        for position in self._terms.prefix_range(prefix.encode("utf-8")):
+            yield self._terms.term_at(position).decode("utf-8")
+
+    def keys_within_distance(self, term: str, max_edits: int, prefix_length: int = 0) -> list:
+        """Return sorted terms within max_edits edits of the term"""
+        return fuzzy_terms(self._terms, term, max_edits, prefix_length)
+
+    def keys_in_range(self, low: str = None, high: str = None):
+        """Yield terms between low and high, both inclusive, in sorted order"""
+        positions = self._terms.term_range(
+            None if low is None else low.encode("utf-8"),
+            None if high is None else high.encode("utf-8"),
+        )
+        for position in positions:
+            yield self._terms.term_at(position).decode("utf-8")
+
+
+class CompressedIndexMapping(ArrayIndexMapping):
+    """Memory-mapped term to documents mapping with compressed posting lists
+
+    Parsed posting lists of hot terms are kept in a PostingsCache, so
+    their skip tables are not decoded again on every access.
+    """
+    def __init__(self, buffer, postings, posting_offsets, terms, codec=VarByteCodec):
+        super().__init__(buffer, postings, posting_offsets, terms)
+        self._codec = codec
+
+    def _postings_at(self, position: int) -> CompressedPostingList:
+        return self._postings_cache.get(position, lambda: CompressedPostingList(
+            super(CompressedIndexMapping, self)._postings_at(position), self._codec,
+        ))
+
+
 class ArrayStoragePolicy:
+    """Sorted term dictionary plus contiguous posting arrays, loaded with mmap
+
+    Payload layout after the file header (all integers are little-endian):
+        postings: uint32 or uint64 document ids, one run per term
+        posting offsets: uint64, terms count + 1 entries
+        term dictionary index: uint64, terms count + 1 term offsets
+        terms blob: concatenated UTF-8 terms in sorted order
+        sections footer: terms count, postings section size, terms blob size
+    """
+    POLICY_ID = 2
+    SECTIONS = struct.Struct("<QQQ")
+    TERM_DICTIONARY = SortedTermDictionary
+
+    @classmethod
+    def dump(cls, word_to_docs_mapping, filepath: str):
+        """Write term to documents mapping to disk"""
+        items = sorted(
+            (term.encode("utf-8"), sorted(docs))
+            for term, docs in word_to_docs_mapping.items()
+        )
+        max_doc_id = max((docs[-1] for _, docs in items if docs), default=0)
+        cls.dump_sorted(items, filepath, doc_id_width=width_for(max_doc_id))
+
+    @classmethod
+    def dump_sorted(cls, items, filepath: str, doc_id_width: int = 4):
+        """Write (term bytes, sorted doc ids) pairs ordered by term to disk
+
+        Postings are streamed to the file as they come, so only the term
+        dictionary is kept in memory.
+        """
+        posting_offsets = array("Q", [0])
+        terms = []
+        with open_for_dump(filepath, cls, doc_id_width) as fout:
+            for term, docs in items:
+                size = cls._write_postings(fout, docs, doc_id_width)
+                posting_offsets.append(posting_offsets[-1] + size)
+                terms.append(term)
+            terms_index, terms_blob = cls.TERM_DICTIONARY.encode(terms)
+            fout.write(bytes(_padding(fout.size)))
+            _write_array(fout, posting_offsets)
+            _write_array(fout, terms_index)
+            fout.write(terms_blob)
+            fout.write(cls.SECTIONS.pack(
+                len(terms), posting_offsets[-1], len(terms_blob),
+            ))
+
+    @classmethod
+    def load(cls, filepath: str) -> ArrayIndexMapping:
+        """Memory-map the index file and return a lazy mapping over it"""
+        with open(filepath, "rb") as fin:
+            header = read_header(fin, cls)
+            buffer = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        terms_count, postings_size, blob_size = cls.SECTIONS.unpack_from(
+            buffer, len(buffer) - cls.SECTIONS.size,
+        )
+
+        offset = FILE_HEADER.size
+        postings, offset = cls._read_postings(buffer, offset, postings_size, header.doc_id_width)
+        offset += _padding(offset - FILE_HEADER.size)
+        posting_offsets, offset = _read_array(buffer, offset, "Q", terms_count + 1)
+        terms_index, offset = _read_array(
+            buffer, offset, "Q", cls.TERM_DICTIONARY.index_size(terms_count),
+        )
+        terms_blob = memoryview(buffer)[offset:offset + blob_size]
+        terms = cls.TERM_DICTIONARY(terms_index, terms_blob, terms_count)
+        return cls._make_mapping(buffer, postings, posting_offsets, terms)
+
+    @staticmethod
+    def _write_postings(fout, docs, doc_id_width: int) -> int:
+        """Write sorted posting list and return its size in postings section units"""
+        postings = array(_struct_code(doc_id_width), docs)
+        _write_array(fout, postings)
+        return len(postings)
+
     @staticmethod
-    def dump(word_to_docs_mapping, filepath: str):
-        pass
+    def _read_postings(buffer, offset: int, size: int, doc_id_width: int):
+        """Return postings section view and the offset after it"""
+        return _read_array(buffer, offset, _struct_code(doc_id_width), size)
 
     @staticmethod
-    def load(filepath: str):
-        pass
+    def _make_mapping(*sections) -> ArrayIndexMapping:
+        """Wrap mapped file sections into a mapping"""
+        return ArrayIndexMapping(*sections)
+
+
+class CompressedStoragePolicy(ArrayStoragePolicy):
+    """Array layout where every posting list is delta encoded with varints
+
+    Varints have no fixed width, so the header always declares 64-bit ids.
+    """
+    POLICY_ID = 3
+    CODEC = VarByteCodec
+
+    @classmethod
+    def dump_sorted(cls, items, filepath: str, doc_id_width: int = 8):
+        super().dump_sorted(items, filepath, doc_id_width=8)
+
+    @classmethod
+    def _write_postings(cls, fout, docs, doc_id_width: int) -> int:
+        encoded = CompressedPostingList.encode(docs, cls.CODEC)
+        fout.write(encoded)
+        return len(encoded)
+
+    @staticmethod
+    def _read_postings(buffer, offset: int, size: int, doc_id_width: int):
+        return memoryview(buffer)[offset:offset + size], offset + size
+
+    @classmethod
+    def _make_mapping(cls, *sections) -> CompressedIndexMapping:
+        return CompressedIndexMapping(*sections, codec=cls.CODEC)
+
+
+class BitPackedStoragePolicy(CompressedStoragePolicy):
+    """Array layout where every block of posting deltas is bit packed"""
+    POLICY_ID = 4
+    CODEC = BitPackedCodec
+
+
+class FrontCodedStoragePolicy(ArrayStoragePolicy):
+    """Array layout with a front-coded term dictionary
+
+    Sorted terms share long prefixes, so blocks of terms storing only the
+    suffix of each term after the first make the dictionary several times
+    smaller. Block offsets replace term offsets in the dictionary index.
+    """
+    POLICY_ID = 9
+    TERM_DICTIONARY = FrontCodedTermDictionary
+
+
+class RoaringIndexMapping(ArrayIndexMapping):
+    """Memory-mapped term to documents mapping with roaring bitmap posting lists
+
+    Deserialized bitmaps of hot terms are kept in a PostingsCache.
+    """
+    def _postings_at(self, position: int) -> RoaringBitmap:
+        return self._postings_cache.get(position, lambda: RoaringBitmap.deserialize(
+            super(RoaringIndexMapping, self)._postings_at(position),
+        ))
+
+
+class RoaringStoragePolicy(CompressedStoragePolicy):
+    """Array layout where every posting list is a serialized roaring bitmap"""
+    POLICY_ID = 8
+
+    @classmethod
+    def _write_postings(cls, fout, docs, doc_id_width: int) -> int:
+        encoded = RoaringBitmap.from_sorted(docs).serialize()
+        fout.write(encoded)
+        return len(encoded)
+
+    @classmethod
+    def _make_mapping(cls, *sections) -> RoaringIndexMapping:
+        return RoaringIndexMapping(*sections)
+
+
+class PositionsIndexMapping(ArrayIndexMapping):
+    """Memory-mapped term to (doc id to positions) mapping"""
+    def _postings_at(self, position: int) -> TermPositions:
+        return TermPositions(super()._postings_at(position))
+
+
+class PositionsStoragePolicy(CompressedStoragePolicy):
+    """Array layout holding compressed per-document term positions
+
+    Used for the positions section of positional indexes, which is stored
+    apart from posting lists and is only opened by positional queries.
+    """
+    POLICY_ID = 5
+
+    @classmethod
+    def dump(cls, term_to_positions_mapping, filepath: str):
+        """Write term to (doc id to sorted positions) mapping to disk"""
+        items = sorted(
+            (term.encode("utf-8"), sorted(doc_positions.items()))
+            for term, doc_positions in term_to_positions_mapping.items()
+        )
+        cls.dump_sorted(items, filepath)
+
+    @classmethod
+    def _write_postings(cls, fout, doc_positions, doc_id_width: int) -> int:
+        encoded = TermPositions.encode(doc_positions)
+        fout.write(encoded)
+        return len(encoded)
+
+    @classmethod
+    def _make_mapping(cls, *sections) -> PositionsIndexMapping:
+        return PositionsIndexMapping(*sections)
+
+
+TermFrequencies = namedtuple("TermFrequencies", ["max_frequency", "frequencies"])
+
+
+class FrequenciesIndexMapping(ArrayIndexMapping):
+    """Memory-mapped term to term frequencies mapping"""
+    def _postings_at(self, position: int) -> TermFrequencies:
+        buffer = super()._postings_at(position)
+        count, offset = decode_varint(buffer, 0)
+        max_frequency, offset = decode_varint(buffer, offset)
+        return TermFrequencies(max_frequency, VarByteCodec.decode_block(buffer[offset:], count))
+
+
+class FrequenciesStoragePolicy(CompressedStoragePolicy):
+    """Array layout holding term frequencies aligned with sorted posting lists
+
+    Every term stores varint count, varint largest frequency (used for
+    score upper bounds) and varint frequencies in doc id order.
+    """
+    POLICY_ID = 6
+
+    @classmethod
+    def dump(cls, term_to_frequencies_mapping, filepath: str):
+        """Write term to (doc id to term frequency) mapping to disk"""
+        items = sorted(
+            (term.encode("utf-8"), [tf for _, tf in sorted(doc_frequencies.items())])
+            for term, doc_frequencies in term_to_frequencies_mapping.items()
+        )
+        cls.dump_sorted(items, filepath)
+
+    @classmethod
+    def _write_postings(cls, fout, frequencies, doc_id_width: int) -> int:
+        encoded = bytearray()
+        encode_varint(len(frequencies), encoded)
+        encode_varint(max(frequencies, default=0), encoded)
+        encoded += VarByteCodec.encode_block(frequencies)
+        fout.write(encoded)
+        return len(encoded)
+
+    @classmethod
+    def _make_mapping(cls, *sections) -> FrequenciesIndexMapping:
+        return FrequenciesIndexMapping(*sections)
+
+
+class DocumentLengthsMapping(Mapping):
+    """Read-only doc id to document length mapping over memory-mapped arrays"""
+    def __init__(self, buffer, doc_ids, lengths, total_length: int, min_length: int):
+        self._buffer = buffer
+        self._doc_ids = doc_ids
+        self._lengths = lengths
+        self.total_length = total_length
+        self.min_length = min_length
+
+    def __getitem__(self, doc_id: int) -> int:
+        position = bisect_left(self._doc_ids, doc_id)
+        if position == len(self._doc_ids) or self._doc_ids[position] != doc_id:
+            raise KeyError(doc_id)
+        return self._lengths[position]
+
+    def __iter__(self):
+        return iter(self._doc_ids)
+
+    def __len__(self) -> int:
+        return len(self._doc_ids)
+
+
+class DocumentLengthsStoragePolicy:
+    """Sorted uint64 doc ids and their lengths in tokens, loaded with mmap
+
+    Payload layout: doc ids array, lengths array, then a footer with the
+    documents count, the total length and the shortest length.
+    """
+    POLICY_ID = 7
+    FOOTER = struct.Struct("<QQQ")
+
+    @classmethod
+    def dump(cls, document_lengths, filepath: str):
+        """Write doc id to document length mapping to disk"""
+        doc_ids = array("Q", sorted(document_lengths))
+        lengths = array("Q", (document_lengths[doc_id] for doc_id in doc_ids))
+        with open_for_dump(filepath, cls, doc_id_width=8) as fout:
+            _write_array(fout, doc_ids)
+            _write_array(fout, lengths)
+            fout.write(cls.FOOTER.pack(len(doc_ids), sum(lengths), min(lengths, default=0)))
+
+    @classmethod
+    def load(cls, filepath: str) -> DocumentLengthsMapping:
+        """Memory-map the file and return a lazy mapping over it"""
+        with open(filepath, "rb") as fin:
+            read_header(fin, cls)
+            buffer = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        count, total_length, min_length = cls.FOOTER.unpack_from(
+            buffer, len(buffer) - cls.FOOTER.size,
+        )
+        doc_ids, offset = _read_array(buffer, FILE_HEADER.size, "Q", count)
+        lengths, offset = _read_array(buffer, offset, "Q", count)
+        return DocumentLengthsMapping(buffer, doc_ids, lengths, total_length, min_length)
+
+
+class DocumentStore(Mapping):
+    """Read-only doc id to document text mapping over compressed blocks of a mapped file
+
+    A lookup finds the row of the doc id by binary search, the offset
+    table gives its block and its start within the decompressed block
+    directly. The most recently decompressed blocks are cached.
+    """
+    def __init__(self, buffer, doc_ids, row_blocks, row_starts, block_offsets,
+                 codec_id: int):
+        self._buffer = buffer
+        self._doc_ids = doc_ids
+        self._row_blocks = row_blocks
+        self._row_starts = row_starts
+        self._block_offsets = block_offsets
+        self._decompress = _document_block_codec(codec_id)[1]
+        self._cached = ()
+
+    def _find(self, doc_id: int) -> int:
+        """Return the row of the doc id or -1 if it is absent"""
+        row = bisect_left(self._doc_ids, doc_id)
+        if row == len(self._doc_ids) or self._doc_ids[row] != doc_id:
+            return -1
+        return row
+
+    def _block(self, block: int) -> bytes:
+        """Return decompressed block contents"""
+        cached = self._cached
+        for cached_block, contents in cached:
+            if cached_block == block:
+                return contents
+        start = self._block_offsets[block]
+        contents = self._decompress(self._buffer[start:self._block_offsets[block + 1]])
+        self._cached = ((block, contents),) + cached[:CACHED_DOCUMENT_BLOCKS - 1]
+        return contents
+
+    def get_bytes(self, doc_id: int) -> bytes:
+        """Return UTF-8 document text"""
+        row = self._find(doc_id)
+        if row < 0:
+            raise KeyError(doc_id)
+        block = self._row_blocks[row]
+        contents = self._block(block)
+        end = len(contents)
+        if row + 1 < len(self._doc_ids) and self._row_blocks[row + 1] == block:
+            end = self._row_starts[row + 1]
+        return contents[self._row_starts[row]:end]
+
+    def __getitem__(self, doc_id: int) -> str:
+        return self.get_bytes(doc_id).decode("utf-8")
+
+    def __contains__(self, doc_id) -> bool:
+        return isinstance(doc_id, int) and self._find(doc_id) >= 0
+
+    def __iter__(self):
+        return iter(self._doc_ids)
+
+    def __len__(self) -> int:
+        return len(self._doc_ids)
+
+
+def _document_block_codec(codec_id: int):
+    """Return (compress, decompress) functions of the block codec"""
+    if codec_id == ZLIB_CODEC_ID:
+        return zlib.compress, zlib.decompress
+    if codec_id == ZSTD_CODEC_ID:
+        if zstandard is None:
+            raise IndexFormatError("Document store is zstd-compressed, install zstandard.")
+        return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+    raise IndexFormatError(f"Unknown document store codec {codec_id}.")
+
+
+class DocumentStoreStoragePolicy:
+    """Document texts compressed in blocks with an offset table, loaded with mmap
+
+    Payload layout after the file header (all integers are little-endian):
+        blocks: documents in doc id order, UTF-8 texts concatenated and
+            compressed together up to block_size bytes per block
+        doc ids: sorted uint64, documents count entries
+        row blocks: uint32 block of every document
+        row starts: uint32 start of every document in its decompressed block
+        block offsets: uint64, blocks count + 1 entries
+        footer: documents count, blocks count, codec id
+    Blocks are compressed with zstd when zstandard is installed, zlib otherwise.
+    """
+    POLICY_ID = 10
+    FOOTER = struct.Struct("<QQQ")
+
+    @classmethod
+    def dump(cls, documents, filepath: str, block_size: int = DOCUMENT_BLOCK_SIZE,
+             codec_id: int = None):
+        """Write doc id to document text mapping to disk, one block in memory at a time
+
+        Documents providing a view method (a mapped dataset) are copied
+        without being decoded.
+        """
+        if codec_id is None:
+            codec_id = ZSTD_CODEC_ID if zstandard is not None else ZLIB_CODEC_ID
+        compress = _document_block_codec(codec_id)[0]
+        doc_ids = array("Q", sorted(documents))
+        row_blocks = array("I")
+        row_starts = array("I")
+        block_offsets = array("Q", [FILE_HEADER.size])
+        block = bytearray()
+        get_view = getattr(documents, "view", None)
+        with open_for_dump(filepath, cls, doc_id_width=8) as fout:
+            def flush():
+                fout.write(compress(bytes(block)))
+                block_offsets.append(FILE_HEADER.size + fout.size)
+                block.clear()
+
+            for doc_id in doc_ids:
+                if get_view is not None:
+                    text = get_view(doc_id)
+                else:
+                    text = documents[doc_id].encode("utf-8")
+                if block and len(block) + len(text) > block_size:
+                    flush()
+                row_blocks.append(len(block_offsets) - 1)
+                row_starts.append(len(block))
+                block += text
+            if block:
+                flush()
+            fout.write(bytes(_padding(fout.size)))
+            _write_array(fout, doc_ids)
+            _write_array(fout, row_blocks)
+            _write_array(fout, row_starts)
+            fout.write(bytes(_padding(fout.size)))
+            _write_array(fout, block_offsets)
+            fout.write(cls.FOOTER.pack(len(doc_ids), len(block_offsets) - 1, codec_id))
+
+    @classmethod
+    def load(cls, filepath: str) -> DocumentStore:
+        """Memory-map the file and return a lazy mapping over it"""
+        with open(filepath, "rb") as fin:
+            read_header(fin, cls)
+            buffer = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        count, blocks_count, codec_id = cls.FOOTER.unpack_from(
+            buffer, len(buffer) - cls.FOOTER.size,
+        )
+        block_offsets, _ = _read_array(
+            buffer, len(buffer) - cls.FOOTER.size - 8 * (blocks_count + 1), "Q", blocks_count + 1,
+        )
+        offset = block_offsets[-1]
+        offset += _padding(offset - FILE_HEADER.size)
+        doc_ids, offset = _read_array(buffer, offset, "Q", count)
+        row_blocks, offset = _read_array(buffer, offset, "I", count)
+        row_starts, offset = _read_array(buffer, offset, "I", count)
+        return DocumentStore(buffer, doc_ids, row_blocks, row_starts, block_offsets, codec_id)
+
+
+def _struct_code(width: int) -> str:
+    """Return unsigned struct and array format code for the integer width"""
+    return {4: "I", 8: "Q"}[width]
+
+
+def _padding(position: int, alignment: int = 8) -> int:
+    """Return number of bytes needed to align the position"""
+    return -position % alignment
+
+
+def _write_array(fout, values: array):
+    """Write array to file in little-endian byte order"""
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    fout.write(values.tobytes())
+
+
+def _read_array(buffer, offset: int, typecode: str, count: int):
+    """Return a view of count little-endian values and the offset after them"""
+    end = offset + array(typecode).itemsize * count
+    view = memoryview(buffer)[offset:end]
+    if sys.byteorder == "big":
+        values = array(typecode, view.tobytes())
+        values.byteswap()
+        return memoryview(values), end
+    return view.cast(typecode), end
+
+
+POLICIES_BY_ID = {
+    policy.POLICY_ID: policy
+    for policy in (StructStoragePolicy, ArrayStoragePolicy, CompressedStoragePolicy,
+                   BitPackedStoragePolicy, PositionsStoragePolicy, FrequenciesStoragePolicy,
+                   DocumentLengthsStoragePolicy, RoaringStoragePolicy, FrontCodedStoragePolicy,
+                   DocumentStoreStoragePolicy)
+}
+DEFAULT_STORAGE_POLICY = ArrayStoragePolicy
+STORAGE_POLICIES = {
+    "array": ArrayStoragePolicy,
+    "bitpacked": BitPackedStoragePolicy,
+    "compressed": CompressedStoragePolicy,
+    "frontcoded": FrontCodedStoragePolicy,
+    "roaring": RoaringStoragePolicy,
+    "struct": StructStoragePolicy,
+}
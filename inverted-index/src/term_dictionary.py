@@ -0,0 +1,227 @@
+"""
+Sorted term dictionaries for memory-mapped indexes.
+
+Terms are kept as raw UTF-8 bytes sorted bytewise, which is also the code
+point order of the decoded strings. Dictionaries map a term to its
+position in the sorted order, so that exact lookups, prefix and range
+queries are binary searches returning position ranges, and only terms
+actually visited are decoded.
+
+Two layouts are available:
+    SortedTermDictionary: uint64 offsets of every term into a blob of
+        concatenated terms.
+    FrontCodedTermDictionary: blocks of BLOCK_TERMS terms, the first term
+        of a block is stored whole, every next one as a varint length of
+        the prefix shared with its predecessor, a varint suffix length and
+        the suffix; uint64 offsets of the blocks into the blob.
+"""
+
+from array import array
+
+from posting_list import decode_varint
+from posting_list import encode_varint
+
+BLOCK_TERMS = 16
+CACHED_BLOCKS = 4
+
+
+def prefix_successor(prefix: bytes):
+    """Return the smallest byte string greater than every string starting with prefix
+
+    None means there is no such string, the prefix is all 0xFF bytes.
+    """
+    prefix = prefix.rstrip(b"\xff")
+    if not prefix:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+class TermDictionary:
+    """Searches shared by the dictionary layouts, based on term_at"""
+    def term_at(self, position: int) -> bytes:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def bisect_left(self, term: bytes, low: int = 0, high: int = None) -> int:
+        """Return the first position holding a term not less than the given one"""
+        high = len(self) if high is None else high
+        while low < high:
+            middle = (low + high) // 2
+            if self.term_at(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def seek(self, term: bytes, low: int, high: int) -> int:
+        """Return bisect_left(term, low, high), expecting the result close to low
+
+        The step doubles from low before bisecting, so short skips cost
+        a few comparisons only.
+        """
+        step = 1
+        start, end = low, low + 1
+        while end < high and self.term_at(end) < term:
+            start = end + 1
+            step *= 2
+            end = low + step
+        return self.bisect_left(term, start, min(end, high))
+
+    def find(self, term: bytes) -> int:
+        """Return the position of the term or -1 if it is absent"""
+        position = self.bisect_left(term)
+        if position < len(self) and self.term_at(position) == term:
+            return position
+        return -1
+
+    def prefix_range(self, prefix: bytes) -> range:
+        """Return positions of the terms starting with prefix"""
+        successor = prefix_successor(prefix)
+        end = len(self) if successor is None else self.bisect_left(successor)
+        return range(self.bisect_left(prefix), end)
+
+    def term_range(self, low: bytes = None, high: bytes = None) -> range:
+        """Return positions of the terms between low and high, both inclusive"""
+        start = 0 if low is None else self.bisect_left(low)
+        end = len(self) if high is None else self.bisect_left(high + b"\x00")
+        return range(start, max(start, end))
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self.term_at(position)
+
+
+class SortedTermDictionary(TermDictionary):
+    """Offsets of every term into a blob of concatenated sorted terms"""
+    def __init__(self, index, blob, terms_count: int):
+        self._offsets = index
+        self._blob = blob
+        self._count = terms_count
+
+    @staticmethod
+    def index_size(terms_count: int) -> int:
+        """Return number of uint64 index entries for the given number of terms"""
+        return terms_count + 1
+
+    @staticmethod
+    def encode(terms):
+        """Return (uint64 index, blob) for sorted term bytes"""
+        offsets = array("Q", [0])
+        blob = bytearray()
+        for term in terms:
+            blob += term
+            offsets.append(len(blob))
+        return offsets, blob
+
+    def term_at(self, position: int) -> bytes:
+        return bytes(self._blob[self._offsets[position]:self._offsets[position + 1]])
+
+    def __len__(self) -> int:
+        return self._count
+
+
+class FrontCodedTermDictionary(TermDictionary):
+    """Blocks of front-coded sorted terms with an offset per block"""
+    def __init__(self, index, blob, terms_count: int):
+        self._block_offsets = index
+        self._blob = blob
+        self._count = terms_count
+        self._cached = ()
+
+    @staticmethod
+    def index_size(terms_count: int) -> int:
+        """Return number of uint64 index entries for the given number of terms"""
+        return (terms_count + BLOCK_TERMS - 1) // BLOCK_TERMS + 1
+
+    @staticmethod
+    def encode(terms):
+        """Return (uint64 index, blob) for sorted term bytes"""
+        block_offsets = array("Q", [0])
+        blob = bytearray()
+        previous = b""
+        for position, term in enumerate(terms):
+            if position % BLOCK_TERMS == 0:
+                if position:
+                    block_offsets.append(len(blob))
+                encode_varint(len(term), blob)
+                blob += term
+            else:
+                shared = 0
+                limit = min(len(previous), len(term))
+                while shared < limit and previous[shared] == term[shared]:
+                    shared += 1
+                encode_varint(shared, blob)
+                encode_varint(len(term) - shared, blob)
+                blob += term[shared:]
+            previous = term
+        if blob:
+            block_offsets.append(len(blob))
+        return block_offsets, blob
+
+    def _first_term(self, block: int) -> bytes:
+        """Return the first term of a block without decoding the rest"""
+        size, offset = decode_varint(self._blob, self._block_offsets[block])
+        return bytes(self._blob[offset:offset + size])
+
+    def _block_terms(self, block: int) -> list:
+        """Return all terms of a block, remembering the last decoded blocks
+
+        The cache is a tuple replaced as a whole, so concurrent readers
+        never see it half updated.
+        """
+        cached = self._cached
+        for cached_block, cached_terms in cached:
+            if cached_block == block:
+                return cached_terms
+        offset = self._block_offsets[block]
+        end = self._block_offsets[block + 1]
+        size, offset = decode_varint(self._blob, offset)
+        term = bytes(self._blob[offset:offset + size])
+        offset += size
+        terms = [term]
+        while offset < end:
+            shared, offset = decode_varint(self._blob, offset)
+            size, offset = decode_varint(self._blob, offset)
+            term = term[:shared] + bytes(self._blob[offset:offset + size])
+            offset += size
+            terms.append(term)
+        self._cached = ((block, terms),) + cached[:CACHED_BLOCKS - 1]
+        return terms
+
+    def term_at(self, position: int) -> bytes:
+        block, index = divmod(position, BLOCK_TERMS)
+        return self._block_terms(block)[index]
+
+    def bisect_left(self, term: bytes, low: int = 0, high: int = None) -> int:
+        """Binary search over first terms of blocks, then inside a single block"""
+        high = len(self) if high is None else high
+        if low >= high:
+            return low
+        first_block, last_block = low // BLOCK_TERMS, (high - 1) // BLOCK_TERMS
+        lower, upper = first_block + 1, last_block + 1
+        while lower < upper:
+            middle = (lower + upper) // 2
+            if self._first_term(middle) <= term:
+                lower = middle + 1
+            else:
+                upper = middle
+        block = lower - 1
+        terms = self._block_terms(block)
+        position = max(low - block * BLOCK_TERMS, 0)
+        limit = min(len(terms), high - block * BLOCK_TERMS)
+        while position < limit and terms[position] < term:
+            position += 1
+        return block * BLOCK_TERMS + position
+
+    def seek(self, term: bytes, low: int, high: int) -> int:
+        """Blocks are searched by their first terms, which is cheaper than probing"""
+        return self.bisect_left(term, low, high)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self):
+        for block in range(len(self._block_offsets) - 1):
+            yield from self._block_terms(block)
@@ -1,20 +1,80 @@
+from argparse import ArgumentParser
 from argparse import Namespace
+from collections import Counter
+import json
+import os
+import socket
+import sys
 from textwrap import dedent
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
 
 import pytest
 
+from analysis import ANALYZER_FILE_SUFFIX, analyze_documents, get_analyzer, stem_plural
+from batch_query import PairIntersectionCache, evaluate_batch
+from benchmark_index import compare_results, generate_corpus, run_benchmark
+from dataset import MappedDataset
+from fuzzy import fuzzy_terms
 from inverted_index import InvertedIndex
 from inverted_index import build_inverted_index
 from inverted_index import DEFAULT_INVERTED_INDEX_SAVE_PATH
+from inverted_index import DOCUMENT_STORE_FILE_SUFFIX
+from inverted_index import POSITIONS_FILE_SUFFIX
 from inverted_index import callback_query, process_queries
 from inverted_index import callback_build, process_build
 from inverted_index import load_documents
+from inverted_index import build_inverted_index_parallel
+from inverted_index import merge_partial_indexes
+from inverted_index import setup_parser, split_dataset
+from inverted_index import build_runs, iter_documents, read_run, write_run
+from incremental_index import TombstoneSet, UpdatableIndex
+from metrics import LatencyHistogram, StageMetrics, stage_metrics
+import inverted_index
+from posting_list import BitPackedCodec
+from posting_list import CompressedPostingList
+from posting_list import TermPositions
+from posting_list import VarByteCodec
+from ranking import BM25, TermCursor, wand_top_k
+from roaring import ArrayContainer, BitmapContainer, RoaringBitmap, RunContainer
+from query_cache import QueryCache
+from query_engine import galloping_search, intersect_all, plan_intersection
+from query_language import And, Fuzzy, Near, Not, Or, Phrase, Prefix, Term, TermRange
+from query_language import QuerySyntaxError, fuzzy_query, parse_query
+from query_server import IndexHolder, QueryServer
+from segmented_index import MANIFEST_FILENAME, SegmentInfo, SegmentedIndex
+from segmented_index import TieredMergePolicy, build_segmented_index
+from sharded_index import SHARDS_MANIFEST_FILENAME, ShardedIndex
+from snippets import make_snippet
 from storage_policy import ArrayStoragePolicy
+from storage_policy import BitPackedStoragePolicy
+from storage_policy import CompressedStoragePolicy
+from storage_policy import DOCUMENT_BLOCK_SIZE
+from storage_policy import DocumentStoreStoragePolicy
+from storage_policy import FrontCodedStoragePolicy
+from storage_policy import IndexFormatError
+from storage_policy import PostingsCache
+from storage_policy import PositionsStoragePolicy
+from storage_policy import RoaringStoragePolicy
+from storage_policy import StructIndexMapping
+from storage_policy import StructStoragePolicy
+from storage_policy import detect_storage_policy
+from term_dictionary import FrontCodedTermDictionary, SortedTermDictionary
 
 DATASET_BIG_FPATH = "../resources/wikipedia_sample"
 DATASET_SMALL_FPATH = "../resources/small_wikipedia_sample"
 DATASET_TINY_FPATH = "../resources/tiny_wikipedia_sample"
 
+ALL_STORAGE_POLICIES = [
+    pytest.param(StructStoragePolicy, id="struct"),
+    pytest.param(ArrayStoragePolicy, id="array"),
+    pytest.param(CompressedStoragePolicy, id="varbyte"),
+    pytest.param(BitPackedStoragePolicy, id="bitpacked"),
+    pytest.param(RoaringStoragePolicy, id="roaring"),
+    pytest.param(FrontCodedStoragePolicy, id="frontcoded"),
+]
+
 
 def test_can_load_documents_v1():
     documents = load_documents(DATASET_TINY_FPATH)
@@ -96,6 +156,569 @@ def test_query_inverted_index_intersect_results(tiny_dataset_fio, query, etalon_
     )
 
 
+@pytest.mark.parametrize(
+    "postings",
+    [
+        pytest.param(list(range(0, 3000, 3)), id="list"),
+        pytest.param(set(range(0, 3000, 3)), id="set"),
+        pytest.param(CompressedPostingList.from_sorted(range(0, 3000, 3)), id="compressed"),
+    ],
+)
+def test_intersect_all_does_not_depend_on_postings_type(postings):
+    assert intersect_all([postings, [2, 3, 4, 5, 6, 2997, 3000]]) == [3, 6, 2997]
+    assert intersect_all([[1, 2], postings]) == []
+    assert intersect_all([postings]) == list(range(0, 3000, 3))
+
+
+@pytest.mark.parametrize("target", [-1, 0, 1, 2, 15, 16, 17, 1000, 1023, 5000])
+@pytest.mark.parametrize("low", [0, 3, 500])
+def test_galloping_search_finds_first_not_less_value(target, low):
+    postings = list(range(0, 2048, 2))
+    expected = low
+    while expected < len(postings) and postings[expected] < target:
+        expected += 1
+    assert galloping_search(postings, target, low) == expected
+
+
+def test_query_starts_from_rarest_term():
+    rare, common = [7, 9], list(range(100))
+    assert plan_intersection([common, rare]) == [rare, common]
+
+
+def test_query_does_not_modify_inverted_index(tiny_dataset_fio):
+    tiny_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio))
+    etalon_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio))
+    assert tiny_inverted_index.query(["A_word", "B_word"]) == [37]
+    assert tiny_inverted_index.query(["word_does_not_exist", "A_word"]) == []
+    assert tiny_inverted_index.query(["A_word"]) == [37, 123]
+    assert tiny_inverted_index == etalon_inverted_index
+    assert "word_does_not_exist" not in tiny_inverted_index.inverted_index
+
+
+@pytest.mark.parametrize(
+    "query, etalon_tree",
+    [
+        pytest.param("a b", And([Term("a"), Term("b")]), id="implicit and"),
+        pytest.param("a AND b OR c", Or([And([Term("a"), Term("b")]), Term("c")]), id="precedence"),
+        pytest.param("a AND (b OR c)", And([Term("a"), Or([Term("b"), Term("c")])]), id="parentheses"),
+        pytest.param("a NOT b", And([Term("a"), Not(Term("b"))]), id="not"),
+        pytest.param('"to be" or', And([Phrase(["to", "be"]), Term("or")]), id="phrase"),
+        pytest.param('"word"', Term("word"), id="one word phrase"),
+    ],
+)
+def test_parse_query(query, etalon_tree):
+    assert parse_query(query) == etalon_tree
+
+
+@pytest.mark.parametrize(
+    "query",
+    ["", "a AND", "(a OR b", "a)", '"to be', '""', "OR a"],
+)
+def test_parse_query_rejects_malformed_queries(query):
+    with pytest.raises(QuerySyntaxError):
+        parse_query(query)
+
+
+@pytest.mark.parametrize(
+    "query, etalon_answer",
+    [
+        pytest.param("A_word B_word", [37], id="implicit and"),
+        pytest.param("A_word AND B_word", [37], id="and"),
+        pytest.param("A_word OR B_word", [2, 37, 123], id="or"),
+        pytest.param("A_word NOT B_word", [123], id="not"),
+        pytest.param("some AND NOT (A_word OR B_word)", [], id="not group"),
+        pytest.param("(famous_phrases OR nothing) AND NOT here", [5, 123], id="groups"),
+        pytest.param('"to be or not to be"', [5], id="phrase"),
+        pytest.param('"be to"', [], id="phrase in wrong order"),
+        pytest.param('"A_word and" OR "such as"', [37, 123], id="phrases union"),
+        pytest.param("word_does_not_exist OR A_word", [37, 123], id="missing term"),
+    ],
+)
+def test_search_boolean_queries(tiny_dataset_fio, query, etalon_answer):
+    tiny_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio), positional=True)
+    assert tiny_inverted_index.search(query) == etalon_answer
+
+
+def test_process_queries_supports_boolean_queries(tmpdir, capsys):
+    index_fio = tmpdir.join("index.dump")
+    process_build(DATASET_TINY_FPATH, index_fio)
+    process_queries(index_fio, ["A_word OR B_word\n", "\n", "A_word NOT B_word\n"])
+    captured = capsys.readouterr()
+    assert captured.out == "2,37,123\n\n123\n"
+
+
+@pytest.mark.parametrize(
+    "query, etalon_answer",
+    [
+        pytest.param("to NEAR/0 to", [5], id="same term"),
+        pytest.param("famous_phrases NEAR/1 to", [5], id="adjacent"),
+        pytest.param("be NEAR/1 famous_phrases", [], id="too far"),
+        pytest.param("be NEAR/2 famous_phrases", [5], id="reverse order"),
+        pytest.param("some NEAR/3 A_word", [123], id="within distance"),
+        pytest.param("all NEAR/1 words NEAR/1 such", [37], id="chain"),
+        pytest.param("all NEAR/1 words NEAR/1 such NEAR/1 as NEAR/1 A_word", [37],
+                     id="long chain"),
+        pytest.param("all NEAR/1 words NEAR/1 such NEAR/1 A_word", [], id="long chain too far"),
+    ],
+)
+def test_search_near_queries(tiny_dataset_fio, query, etalon_answer):
+    tiny_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio), positional=True)
+    assert tiny_inverted_index.search(query) == etalon_answer
+
+
+def test_parse_near_query():
+    assert parse_query("a NEAR/2 b") == Near(Term("a"), Term("b"), 2)
+    assert parse_query("a NEAR/1 b NEAR/2 c NEAR/3 d") == And([
+        Near(Term("a"), Term("b"), 1), Near(Term("b"), Term("c"), 2),
+        Near(Term("c"), Term("d"), 3),
+    ])
+    assert parse_query("a NEAR/2b") == And([Term("a"), Term("NEAR/2b")])
+    with pytest.raises(QuerySyntaxError):
+        parse_query('"a b" NEAR/2 c')
+
+
+def test_term_positions_round_trip():
+    doc_positions = [(3, [0, 5, 300]), (70_000, [2])]
+    term_positions = TermPositions(TermPositions.encode(doc_positions))
+    assert dict(term_positions) == dict(doc_positions)
+    assert 4 not in term_positions
+
+
+@pytest.mark.parametrize("storage_policy", ALL_STORAGE_POLICIES)
+def test_positions_are_stored_in_separate_lazily_loaded_section(storage_policy, tmpdir,
+                                                                tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    process_build(tiny_dataset_fio, index_fio, storage_policy=storage_policy, positional=True)
+    positions_fio = tmpdir.join("index.dump" + POSITIONS_FILE_SUFFIX)
+    assert detect_storage_policy(positions_fio) is PositionsStoragePolicy
+
+    loaded_inverted_index = InvertedIndex.load(index_fio)
+    assert loaded_inverted_index.search("to be") == [5]
+    assert loaded_inverted_index.positions is None, "plain queries should not load positions"
+    assert loaded_inverted_index.search('"to be or not to be"') == [5]
+    assert loaded_inverted_index.search('"or to"') == []
+    assert loaded_inverted_index.get_positions("to")[5] == [1, 5]
+
+    process_build(tiny_dataset_fio, index_fio, storage_policy=storage_policy)
+    assert loaded_inverted_index.search('"to be"') == [5], "replaced positions are kept"
+    with pytest.raises(ValueError):
+        InvertedIndex.load(index_fio).search('"to be"')
+    process_build(tiny_dataset_fio, index_fio, storage_policy=storage_policy)
+    assert not positions_fio.exists(), "stale positions should be removed"
+
+
+def test_bm25_prefers_rare_terms_and_short_documents():
+    bm25 = BM25(documents_count=100, average_length=10)
+    assert bm25.idf(1) > bm25.idf(50)
+    assert bm25.score(bm25.idf(1), 1, 5) > bm25.score(bm25.idf(1), 1, 20)
+    assert bm25.score(bm25.idf(1), 3, 10) > bm25.score(bm25.idf(1), 1, 10)
+    assert bm25.upper_bound(bm25.idf(1), 3, 5) >= bm25.score(bm25.idf(1), 3, 10)
+
+
+def test_rank_returns_top_k_by_bm25(tiny_dataset_fio):
+    tiny_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio), ranked=True)
+    ranking = tiny_inverted_index.rank(["A_word", "B_word"], top_k=2)
+    assert [doc_id for doc_id, _ in ranking] == [37, 123]
+    assert ranking[0][1] > ranking[1][1]
+    assert tiny_inverted_index.rank(["to"], top_k=10)[0][0] == 5
+    assert tiny_inverted_index.rank(["word_does_not_exist"]) == []
+
+
+@pytest.mark.parametrize("top_k", [0, -1])
+def test_rank_rejects_top_k_below_one(tiny_dataset_fio, top_k, capsys):
+    tiny_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio), ranked=True)
+    with pytest.raises(ValueError, match="top_k"):
+        tiny_inverted_index.rank(["A_word"], top_k=top_k)
+    parser = ArgumentParser()
+    setup_parser(parser)
+    for command in [["query", "-k"], ["serve", "-k"]]:
+        with pytest.raises(SystemExit):
+            parser.parse_args(command + [str(top_k)])
+        assert "not a positive integer" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("top_k", [1, 3, 10, 1000])
+@pytest.mark.parametrize(
+    "words",
+    [["the"], ["the", "of", "anarchism"], ["political", "philosophy", "state", "a"]],
+)
+def test_wand_returns_the_same_top_k_as_exhaustive_scoring(small_sample_wikipedia_documents, words, top_k):
+    small_inverted_index = build_inverted_index(small_sample_wikipedia_documents, ranked=True)
+    pruned = small_inverted_index.rank(words, top_k)
+    exhaustive = small_inverted_index.rank(words, top_k, pruning=False)
+    assert [doc_id for doc_id, _ in pruned] == [doc_id for doc_id, _ in exhaustive]
+    assert [score for _, score in pruned] == pytest.approx([score for _, score in exhaustive])
+
+
+def test_wand_skips_postings():
+    bm25 = BM25(documents_count=10_000, average_length=10)
+    document_lengths = dict.fromkeys(range(10_000), 10)
+    rare = TermCursor([5, 7000], [3, 3], bm25.idf(2), bm25.upper_bound(bm25.idf(2), 3, 10))
+    common = TermCursor(list(range(10_000)), [1] * 10_000, bm25.idf(10_000),
+                        bm25.upper_bound(bm25.idf(10_000), 1, 10))
+    assert [doc_id for doc_id, _ in wand_top_k([rare, common], bm25, document_lengths, 2)] == [5, 7000]
+    assert common.position < 10_000 and common.doc_ids[common.position - 1] <= 7000
+
+
+@pytest.mark.parametrize("storage_policy", ALL_STORAGE_POLICIES)
+def test_ranked_index_can_be_dumped_and_loaded(storage_policy, tmpdir, small_sample_wikipedia_documents):
+    index_fio = tmpdir.join("index.dump")
+    etalon_inverted_index = build_inverted_index(small_sample_wikipedia_documents, ranked=True)
+    etalon_inverted_index.dump(index_fio, storage_policy=storage_policy)
+    loaded_inverted_index = InvertedIndex.load(index_fio)
+    assert loaded_inverted_index.frequencies is None
+    assert loaded_inverted_index.rank(["the", "anarchism"], 5) == pytest.approx(
+        etalon_inverted_index.rank(["the", "anarchism"], 5)
+    )
+    loaded_inverted_index.dump(tmpdir.join("copy.dump"))
+    assert InvertedIndex.load(tmpdir.join("copy.dump")).rank(["the"], 3) == pytest.approx(
+        etalon_inverted_index.rank(["the"], 3)
+    )
+
+
+def test_process_queries_prints_ranked_results(tmpdir, capsys):
+    index_fio = tmpdir.join("index.dump")
+    process_build(DATASET_TINY_FPATH, index_fio, ranked=True)
+    process_queries(index_fio, "A_word B_word", top_k=2)
+    assert capsys.readouterr().out == "37,123\n"
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_batch_queries_print_the_same_results_as_serial_queries(workers, tmpdir, capsys):
+    index_fio = str(tmpdir.join("index.dump"))
+    process_build(DATASET_TINY_FPATH, index_fio, positional=True)
+    queries = [
+        "A_word B_word\n", "A_word OR B_word\n", "\n", "A_word B_word\n",
+        '"to be"\n', "some A_word\n", "B_word A_word\n", "missing A_word\n",
+    ]
+    process_queries(index_fio, queries)
+    etalon_output = capsys.readouterr().out
+    process_queries(index_fio, queries, workers=workers, batch=True, batch_size=3)
+    assert capsys.readouterr().out == etalon_output
+
+
+@pytest.mark.parametrize("option", ["--workers", "--batch-size"])
+@pytest.mark.parametrize("value", [0, -1])
+def test_query_rejects_batch_counts_below_one(option, value, capsys):
+    parser = ArgumentParser()
+    setup_parser(parser)
+    with pytest.raises(SystemExit):
+        parser.parse_args(["query", "--query", "A_word", option, str(value)])
+    assert "not a positive integer" in capsys.readouterr().err
+
+
+def test_batch_evaluates_shared_term_pairs_once(tiny_dataset_fio):
+    tiny_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio))
+    pair_cache = PairIntersectionCache()
+    queries = ["A_word B_word", "B_word all A_word", "A_word B_word", "A_word AND B_word here"]
+    results = evaluate_batch(tiny_inverted_index, queries, pair_cache)
+    assert results == [[37], [37], [37], [37]]
+    assert (pair_cache.hits, pair_cache.misses) == (2, 1)
+
+
+def test_query_cache_shares_results_between_equivalent_queries(tiny_dataset_fio):
+    tiny_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio))
+    tiny_inverted_index.query_cache = QueryCache(min_cost=0)
+    assert tiny_inverted_index.query(["A_word", "B_word"]) == [37]
+    tiny_inverted_index.query(["B_word", "A_word"]).append(5)
+    assert tiny_inverted_index.search("B_word AND A_word") == [37]
+    assert tiny_inverted_index.search("A_word OR B_word") == [2, 37, 123]
+    assert tiny_inverted_index.search("B_word OR A_word") == [2, 37, 123]
+    assert (tiny_inverted_index.query_cache.hits, tiny_inverted_index.query_cache.misses) == (2, 3)
+
+
+def test_query_cache_admits_only_expensive_results_and_evicts_least_recently_used():
+    query_cache = QueryCache(max_size=2, min_cost=10)
+    assert not query_cache.put(frozenset(["cheap"]), [1], 9, generation=1)
+    for term in ["a", "b", "a", "c"]:
+        if query_cache.get(frozenset([term]), generation=1) is None:
+            query_cache.put(frozenset([term]), [1, 2], 10, generation=1)
+    assert query_cache.get(frozenset(["b"]), generation=1) is None
+    assert query_cache.get(frozenset(["a"]), generation=1) == [1, 2]
+    assert query_cache.stats() == {"hits": 2, "misses": 4, "rejected": 1, "entries": 2}
+
+
+def test_query_cache_is_invalidated_on_reload_and_update(tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    build_inverted_index(load_documents(tiny_dataset_fio)).dump(index_fio)
+    query_cache = QueryCache(min_cost=0)
+    loaded_inverted_index = InvertedIndex.load(index_fio, query_cache=query_cache)
+    loaded_inverted_index.query(["A_word"])
+    assert len(query_cache) == 1
+    loaded_inverted_index.mark_updated()
+    loaded_inverted_index.query(["B_word"])
+    assert len(query_cache) == 1
+    InvertedIndex.load(index_fio, query_cache=query_cache).query(["B_word"])
+    assert (query_cache.hits, query_cache.misses, len(query_cache)) == (0, 3, 1)
+
+
+def test_tombstone_set_operations():
+    tombstones = TombstoneSet()
+    for doc_id in [3, 0, 1000, 3]:
+        tombstones.add(doc_id)
+    assert (list(tombstones), len(tombstones)) == ([0, 3, 1000], 3)
+    tombstones.add(2 ** 63)
+    assert 2 ** 63 in tombstones and 2 ** 63 - 1 not in tombstones
+    tombstones = tombstones.difference(TombstoneSet([2 ** 63]))
+    other = TombstoneSet()
+    other.add(3)
+    other.add(17)
+    assert list(tombstones.difference(other)) == [0, 1000]
+    assert list(tombstones.union(other)) == [0, 3, 17, 1000]
+
+
+@pytest.mark.parametrize("storage_policy", ALL_STORAGE_POLICIES)
+def test_updatable_index_sees_updates_before_and_after_merge(storage_policy, tmpdir,
+                                                             tiny_dataset_fio):
+    index_fio = str(tmpdir.join("index.dump"))
+    build_inverted_index(load_documents(tiny_dataset_fio), positional=True).dump(
+        index_fio, storage_policy=storage_policy
+    )
+    updatable_index = UpdatableIndex(index_fio)
+    updatable_index.add_document(7, "a fresh A_word and B_word")
+    updatable_index.add_document(123, "replaced words")
+    updatable_index.delete_document(2)
+    updatable_index.add_document(8, "deleted before merge A_word")
+    updatable_index.delete_document(8)
+    expected = {
+        "A_word": [7, 37],
+        "A_word B_word": [7, 37],
+        "B_word": [7, 37],
+        "words": [37, 123],
+        '"and B_word"': [7, 37],
+    }
+    assert {query: updatable_index.search(query) for query in expected} == expected
+    assert updatable_index.query(["B_word", "A_word"]) == [7, 37]
+    assert updatable_index.merge()
+    assert not updatable_index.merge()
+    assert {query: updatable_index.search(query) for query in expected} == expected
+    assert detect_storage_policy(index_fio) is storage_policy
+    reloaded_index = UpdatableIndex(index_fio)
+    assert {query: reloaded_index.search(query) for query in expected} == expected
+
+
+def test_merge_keeps_sections_of_replaced_index_for_its_readers(tmpdir):
+    index_fio = str(tmpdir.join("index.dump"))
+    build_inverted_index({1: "to be or not", 2: "not to be"}, positional=True).dump(index_fio)
+    reader = InvertedIndex.load(index_fio)
+    updatable_index = UpdatableIndex(index_fio)
+    updatable_index.add_document(3, "be not to be")
+    updatable_index.delete_document(1)
+    assert updatable_index.merge()
+    assert reader.positions is None
+    assert reader.search('"to be"') == [1, 2]
+    assert InvertedIndex.load(index_fio).search('"to be"') == [2, 3]
+    assert updatable_index.search('"or not"') == []
+    versions = [inverted_index.index_version(index_fio)]
+    updatable_index.add_document(4, "to be")
+    assert updatable_index.merge()
+    versions.append(inverted_index.index_version(index_fio))
+    assert sorted(os.listdir(tmpdir)) == sorted(["index.dump"] + [
+        f"index.dump.{version:08x}{suffix}" for version in versions
+        for suffix in [ANALYZER_FILE_SUFFIX, POSITIONS_FILE_SUFFIX]
+    ])
+    assert InvertedIndex.load(index_fio).search('"to be"') == [2, 3, 4]
+
+
+def test_updatable_index_accepts_updates_during_background_merge(tmpdir, monkeypatch,
+                                                                 tiny_dataset_fio):
+    index_fio = str(tmpdir.join("index.dump"))
+    build_inverted_index(load_documents(tiny_dataset_fio)).dump(index_fio)
+    updatable_index = UpdatableIndex(index_fio)
+    updatable_index.add_document(7, "A_word")
+    write_merged = UpdatableIndex._write_merged
+
+    def write_merged_with_concurrent_updates(self, segments, tombstones):
+        updatable_index.add_document(9, "A_word")
+        updatable_index.delete_document(123)
+        assert updatable_index.search("A_word") == [7, 9, 37]
+        write_merged(self, segments, tombstones)
+
+    monkeypatch.setattr(UpdatableIndex, "_write_merged", write_merged_with_concurrent_updates)
+    updatable_index.merge_in_background().join()
+    assert updatable_index.search("A_word") == [7, 9, 37]
+    assert len(updatable_index.segments) == 1
+    assert InvertedIndex.load(index_fio).query(["A_word"]) == [7, 37, 123]
+
+
+def test_tiered_merge_policy_merges_smallest_segments_of_full_tiers():
+    merge_policy = TieredMergePolicy(segments_per_tier=3, max_merge_at_once=2, floor_size=10)
+    segments = [
+        SegmentInfo(f"s{size}", 1, size, 0) for size in [1, 5, 9, 12, 20, 40, 100, 200]
+    ]
+    assert [merge_policy.tier(segment.size) for segment in segments] == [0, 0, 0, 0, 0, 1, 2, 2]
+    merges = merge_policy.find_merges(segments)
+    assert [[segment.size for segment in merge] for merge in merges] == [[1, 5], [9, 12]]
+    assert merge_policy.find_merges(segments[4:]) == []
+
+
+@pytest.mark.parametrize("storage_policy", ALL_STORAGE_POLICIES)
+def test_segmented_index_equals_monolithic_index(storage_policy, tmpdir,
+                                                 small_sample_wikipedia_documents,
+                                                 small_wikipedia_inverted_index):
+    merge_policy = TieredMergePolicy(segments_per_tier=3, max_merge_at_once=3, floor_size=1)
+    segmented_index = build_segmented_index(
+        small_sample_wikipedia_documents.items(), tmpdir.join("segments"), 7,
+        storage_policy=storage_policy, positional=True, merge_policy=merge_policy,
+    )
+    tiers = Counter(merge_policy.tier(info.size) for info, _ in segmented_index.segments)
+    assert max(tiers.values()) < 3
+    reopened_index = SegmentedIndex(tmpdir.join("segments"))
+    assert sorted(os.listdir(tmpdir.join("segments"))) == sorted(
+        [MANIFEST_FILENAME] + [info.name for info, _ in reopened_index.segments]
+        + [info.name + POSITIONS_FILE_SUFFIX for info, _ in reopened_index.segments]
+    )
+    for words in [["the"], ["of", "the"], ["anarchism", "the"], ["missing", "the"]]:
+        assert reopened_index.query(words) == small_wikipedia_inverted_index.query(words)
+    assert reopened_index.search('"of the" OR anarchism') == (
+        build_inverted_index(small_sample_wikipedia_documents, positional=True)
+        .search('"of the" OR anarchism')
+    )
+
+
+def test_process_queries_can_query_segmented_index(tmpdir, capsys):
+    index_dirpath = str(tmpdir.join("segments"))
+    process_build(DATASET_TINY_FPATH, index_dirpath, segment_size=1)
+    assert len(SegmentedIndex(index_dirpath)) == 4
+    process_queries(index_dirpath, ["A_word OR B_word\n", "A_word NOT B_word\n"])
+    assert capsys.readouterr().out == "2,37,123\n123\n"
+
+
+@pytest.mark.parametrize("segment_size", [0, -1])
+def test_build_rejects_segment_size_below_one(segment_size, capsys):
+    parser = ArgumentParser()
+    setup_parser(parser)
+    with pytest.raises(SystemExit):
+        parser.parse_args(["build", "--segment-size", str(segment_size)])
+    assert "not a positive integer" in capsys.readouterr().err
+
+
+@pytest.fixture()
+def tiny_index_holder(tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    build_inverted_index(load_documents(tiny_dataset_fio)).dump(index_fio)
+    return IndexHolder(index_fio, query_cache=QueryCache(min_cost=0))
+
+
+def test_http_server_answers_queries_and_hot_swaps_index(tmpdir, tiny_index_holder):
+    query_server = QueryServer(tiny_index_holder)
+    server = query_server.make_http_server(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        assert urlopen(f"{url}/query?q=A_word").read() == b"37,123\n"
+        assert not tiny_index_holder.reload_if_changed()
+        new_index_fio = tmpdir.join("new_index.dump")
+        build_inverted_index({1: "A_word"}).dump(new_index_fio)
+        os.replace(new_index_fio, tiny_index_holder.inverted_index_filepath)
+        assert tiny_index_holder.reload_if_changed()
+        assert urlopen(f"{url}/query?q=A_word").read() == b"1\n"
+        assert json.loads(urlopen(f"{url}/stats").read())["reloads"] == 2
+        with pytest.raises(HTTPError):
+            urlopen(f"{url}/query?q=%28A_word")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_unix_socket_server_answers_concurrent_clients(tmpdir, tiny_index_holder):
+    socket_filepath = str(tmpdir.join("index.sock"))
+    server = QueryServer(tiny_index_holder).make_unix_server(socket_filepath)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        clients = [socket.socket(socket.AF_UNIX) for _ in range(2)]
+        for client in clients:
+            client.connect(socket_filepath)
+        clients[0].sendall(b"A_word B_word\n")
+        clients[1].sendall(b"A_word OR B_word\nNOT A_word\n")
+        assert clients[0].makefile("rb").readline() == b"37\n"
+        responses = clients[1].makefile("rb")
+        assert responses.readline() == b"2,37,123\n"
+        assert responses.readline().startswith(b"ERROR:")
+        for client in clients:
+            client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_reloading_during_dump_sees_a_consistent_index(tmpdir, monkeypatch):
+    index_fio = tmpdir.join("index.dump")
+    build_inverted_index({1: "x y", 2: "y"}, ranked=True).dump(index_fio)
+    index_holder = IndexHolder(index_fio)
+    query_server = QueryServer(index_holder)
+    answers = []
+
+    def reload_and_answer(function):
+        def wrapper(*args, **kwargs):
+            answers.append((index_holder.reload_if_changed(), query_server.answer("X"),
+                            query_server.answer("X", top_k=5)))
+            return function(*args, **kwargs)
+        return wrapper
+
+    for name in ["dump_analyzer", "remove_stale_sections"]:
+        monkeypatch.setattr(inverted_index, name, reload_and_answer(getattr(inverted_index, name)))
+    build_inverted_index({1: "Xs", 5: "x", 7: "X"}, ranked=True,
+                         analyzer=get_analyzer("english")).dump(index_fio)
+    assert [(reloaded, result) for reloaded, result, _ in answers] == [
+        (False, []), (True, [1, 5, 7]),
+    ]
+    assert sorted(answers[-1][2]) == [1, 5, 7]
+    assert index_holder.inverted_index.analyzer is get_analyzer("english")
+    assert not index_holder.reload_if_changed()
+
+
+def test_servers_report_unexpected_query_errors(tmpdir, tiny_index_holder):
+    query_server = QueryServer(tiny_index_holder)
+
+    def fail(query, top_k=None):
+        raise RuntimeError("shard worker died")
+
+    query_server.answer = fail
+    http_server = query_server.make_http_server(port=0)
+    socket_filepath = str(tmpdir.join("index.sock"))
+    unix_server = query_server.make_unix_server(socket_filepath)
+    for server in [http_server, unix_server]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with pytest.raises(HTTPError) as error:
+            urlopen(f"http://127.0.0.1:{http_server.server_address[1]}/query?q=A_word")
+        assert error.value.code == 500
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(socket_filepath)
+        client.sendall(b"A_word\nB_word\n")
+        responses = client.makefile("rb")
+        assert responses.readline() == b"ERROR: shard worker died\n"
+        assert responses.readline() == b"ERROR: shard worker died\n"
+        client.close()
+    finally:
+        for server in [http_server, unix_server]:
+            server.shutdown()
+            server.server_close()
+
+
+def test_dump_keeps_memory_mapped_index_readable(tmpdir):
+    index_fio = tmpdir.join("index.dump")
+    build_inverted_index({1: "red fox", 2: "red dog"}, positional=True).dump(
+        index_fio, storage_policy=ArrayStoragePolicy,
+    )
+    mapped_index = InvertedIndex.load(index_fio)
+    assert mapped_index.search('"red dog"') == [2]
+    build_inverted_index({3: "blue whale"}, positional=True).dump(
+        index_fio, storage_policy=ArrayStoragePolicy,
+    )
+    assert mapped_index.query(["red"]) == [1, 2]
+    assert mapped_index.search('"red dog"') == [2]
+    assert InvertedIndex.load(index_fio).query(["blue"]) == [3]
+    assert not [name for name in os.listdir(tmpdir) if name.endswith(".tmp")]
+
+
+def test_search_rejects_pure_negation(tiny_dataset_fio):
+    tiny_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio))
+    with pytest.raises(QuerySyntaxError):
+        tiny_inverted_index.search("NOT A_word")
+
+
 # @pytest.mark.skip
 def test_can_load_wikipedia_sample():
     documents = load_documents(DATASET_BIG_FPATH)
@@ -147,33 +770,515 @@ def test_can_dump_and_load_inverted_index(tmpdir, wikipedia_inverted_index):
     )
 
 
-# @pytest.mark.parametrize(
-#     ("filepath",),
-#     [
-#         pytest.param(DATASET_SMALL_FPATH, id="small dataset"),
-#         # pytest.param(DATASET_BIG_FPATH, marks=[pytest.mark.slow], id="big dataset"),
-#     ],
-# )
-# @pytest.mark.skip
-# def test_can_dump_and_load_inverted_index_with_array_policy_parametrized(filepath, tmpdir):
-#     index_fio = tmpdir.join("index.dump")
-# 
-#     documents = load_documents(filepath)
-#     etalon_inverted_index = build_inverted_index(documents)
-# 
-#     # class StoragePolicy:
-#     #     @staticmethod
-#     #     def dump(word_to_docs_mapping, filepath):
-#     #         pass
-#     #
-#     #     @staticmethod
-#     #     def load(filepath):#         pass
-# 
-#     etalon_inverted_index.dump(index_fio, storage_policy=ArrayStoragePolicy)
-#     loaded_inverted_index = InvertedIndex.load(index_fio, storage_policy=ArrayStoragePolicy)
-#     assert etalon_inverted_index == loaded_inverted_index, (
-#         "load should return the same inverted index"
-#     )
+@pytest.mark.parametrize(
+    ("filepath",),
+    [
+        pytest.param(DATASET_SMALL_FPATH, id="small dataset"),
+        # pytest.param(DATASET_BIG_FPATH, marks=[pytest.mark.slow], id="big dataset"),
+    ],
+)
+def test_can_dump_and_load_inverted_index_with_array_policy_parametrized(filepath, tmpdir):
+    index_fio = tmpdir.join("index.dump")
+
+    documents = load_documents(filepath)
+    etalon_inverted_index = build_inverted_index(documents)
+
+    etalon_inverted_index.dump(index_fio, storage_policy=ArrayStoragePolicy)
+    loaded_inverted_index = InvertedIndex.load(index_fio, storage_policy=ArrayStoragePolicy)
+    assert etalon_inverted_index == loaded_inverted_index, (
+        "load should return the same inverted index"
+    )
+
+
+@pytest.mark.parametrize(
+    "storage_policy",
+    [
+        pytest.param(ArrayStoragePolicy, id="array"),
+        pytest.param(CompressedStoragePolicy, id="varbyte"),
+        pytest.param(BitPackedStoragePolicy, id="bitpacked"),
+    ],
+)
+def test_can_dump_and_load_inverted_index_with_compressed_policies(storage_policy, tmpdir,
+                                                                    small_wikipedia_inverted_index):
+    index_fio = tmpdir.join("index.dump")
+    small_wikipedia_inverted_index.dump(index_fio, storage_policy=storage_policy)
+    loaded_inverted_index = InvertedIndex.load(index_fio, storage_policy=storage_policy)
+    assert small_wikipedia_inverted_index == loaded_inverted_index, (
+        "load should return the same inverted index"
+    )
+    assert sorted(loaded_inverted_index.query(["the", "of", "anarchism"])) == sorted(
+        small_wikipedia_inverted_index.query(["the", "of", "anarchism"])
+    )
+
+
+@pytest.mark.parametrize("codec", [VarByteCodec, BitPackedCodec])
+def test_compressed_posting_list_round_trip(codec):
+    doc_ids = [0, 1, 2, 300, 65535, 65536, 70000] + list(range(100_000, 100_500, 3))
+    postings = CompressedPostingList.from_sorted(doc_ids, codec)
+    assert len(postings) == len(doc_ids)
+    assert list(postings) == doc_ids
+    assert 65536 in postings
+    assert 65537 not in postings
+    assert postings.intersection([5, 2, 70000, 100_003, 200_000]) == [2, 70000, 100_003]
+
+
+ROARING_DOC_IDS = {
+    "dense": list(range(0, 200000, 3)),
+    "sparse": list(range(7, 1000000, 997)),
+    "runs": list(range(5, 70000)) + [2 ** 40],
+}
+
+
+@pytest.mark.parametrize(
+    "doc_ids, container_type",
+    [
+        pytest.param(ROARING_DOC_IDS["dense"], BitmapContainer, id="bitmap"),
+        pytest.param(ROARING_DOC_IDS["sparse"], ArrayContainer, id="array"),
+        pytest.param(ROARING_DOC_IDS["runs"], RunContainer, id="runs"),
+    ],
+)
+def test_roaring_bitmap_round_trip(doc_ids, container_type):
+    roaring_bitmap = RoaringBitmap.from_sorted(doc_ids)
+    assert isinstance(roaring_bitmap._containers[0], container_type)
+    assert (list(roaring_bitmap), len(roaring_bitmap)) == (doc_ids, len(doc_ids))
+    assert list(RoaringBitmap.deserialize(memoryview(roaring_bitmap.serialize()))) == doc_ids
+    assert [doc_id in roaring_bitmap for doc_id in (5, 6, 7, 999, 2 ** 40)] == [
+        doc_id in set(doc_ids) for doc_id in (5, 6, 7, 999, 2 ** 40)
+    ]
+
+
+@pytest.mark.parametrize("left", list(ROARING_DOC_IDS))
+@pytest.mark.parametrize("right", list(ROARING_DOC_IDS))
+def test_roaring_bitmap_set_operations(left, right):
+    left_ids, right_ids = set(ROARING_DOC_IDS[left]), set(ROARING_DOC_IDS[right])
+    left_bitmap = RoaringBitmap.from_sorted(ROARING_DOC_IDS[left])
+    right_bitmap = RoaringBitmap.from_sorted(ROARING_DOC_IDS[right])
+    assert list(left_bitmap & right_bitmap) == sorted(left_ids & right_ids)
+    assert list(left_bitmap | right_bitmap) == sorted(left_ids | right_ids)
+    assert list(left_bitmap - right_bitmap) == sorted(left_ids - right_ids)
+    assert intersect_all([left_bitmap, right_bitmap]) == sorted(left_ids & right_ids)
+    assert intersect_all([left_bitmap, sorted(right_ids)]) == sorted(left_ids & right_ids)
+
+
+def test_roaring_bitmap_is_an_order_of_magnitude_smaller_than_set_for_dense_terms():
+    doc_ids = ROARING_DOC_IDS["dense"]
+    assert 10 * len(RoaringBitmap.from_sorted(doc_ids).serialize()) < sys.getsizeof(set(doc_ids))
+
+
+def test_compacted_index_answers_the_same_queries(small_sample_wikipedia_documents):
+    etalon_inverted_index = build_inverted_index(small_sample_wikipedia_documents)
+    compact_inverted_index = build_inverted_index(small_sample_wikipedia_documents)
+    compact_inverted_index.compact()
+    assert compact_inverted_index == etalon_inverted_index
+    for query in ["the", "of the", "the OR anarchism", "the NOT anarchism"]:
+        assert compact_inverted_index.search(query) == etalon_inverted_index.search(query)
+
+
+TERM_DICTIONARY_TERMS = sorted(
+    term.encode("utf-8")
+    for term in ["wiki", "wikipedia", "wikis", "wiz", "a", "ab", "abc", "b", "\u00e9t\u00e9", "z\u00fc"]
+    + [f"term{number:03d}" for number in range(40)]
+)
+
+
+@pytest.mark.parametrize("term_dictionary_class", [SortedTermDictionary, FrontCodedTermDictionary])
+@pytest.mark.parametrize("terms", [TERM_DICTIONARY_TERMS, []], ids=["terms", "empty"])
+def test_term_dictionary_lookups(term_dictionary_class, terms):
+    index, blob = term_dictionary_class.encode(terms)
+    assert len(index) == term_dictionary_class.index_size(len(terms))
+    term_dictionary = term_dictionary_class(index, memoryview(bytes(blob)), len(terms))
+    assert list(term_dictionary) == terms
+    for position, term in enumerate(terms):
+        assert term_dictionary.find(term) == position
+    for missing in [b"", b"0", b"wik", b"wikz", b"term0405", b"\xff"]:
+        assert term_dictionary.find(missing) == -1
+    for prefix in [b"wiki", b"w", b"term01", b"", b"\xc3", b"zz"]:
+        assert [terms[position] for position in term_dictionary.prefix_range(prefix)] == [
+            term for term in terms if term.startswith(prefix)
+        ]
+    for low, high in [(b"ab", b"b"), (b"term010", b"term0199"), (b"x", b"a"), (None, b"abc")]:
+        assert [terms[position] for position in term_dictionary.term_range(low, high)] == [
+            term for term in terms if (low is None or term >= low) and term <= high
+        ]
+
+
+@pytest.mark.parametrize("storage_policy", ALL_STORAGE_POLICIES)
+def test_prefix_and_range_queries(storage_policy, tmpdir, small_sample_wikipedia_documents):
+    etalon_inverted_index = build_inverted_index(small_sample_wikipedia_documents)
+    index_fio = tmpdir.join("index.dump")
+    etalon_inverted_index.dump(index_fio, storage_policy=storage_policy)
+    loaded_inverted_index = InvertedIndex.load(index_fio)
+    terms = sorted(etalon_inverted_index.inverted_index)
+    assert loaded_inverted_index.terms_with_prefix("anarch") == [
+        term for term in terms if term.startswith("anarch")
+    ]
+    assert loaded_inverted_index.terms_in_range("th", "ti") == [
+        term for term in terms if "th" <= term <= "ti"
+    ]
+    etalon_answer = etalon_inverted_index.search("anarchis* OR the")
+    assert loaded_inverted_index.search("anarchis* OR the") == etalon_answer
+    assert parse_query("anarchis* the") == And([Prefix("anarchis"), Term("the")])
+    assert TermRange("anarchism", "anarchist").evaluate(loaded_inverted_index) == (
+        etalon_inverted_index.search("anarchism OR anarchist")
+    )
+
+
+def test_front_coded_dictionary_is_smaller(small_sample_wikipedia_documents):
+    terms = sorted(term.encode("utf-8") for term in build_inverted_index(
+        small_sample_wikipedia_documents).inverted_index)
+    sorted_index, sorted_blob = SortedTermDictionary.encode(terms)
+    front_coded_index, front_coded_blob = FrontCodedTermDictionary.encode(terms)
+    assert (len(front_coded_index) * 8 + len(front_coded_blob)) * 2 < (
+        len(sorted_index) * 8 + len(sorted_blob)
+    )
+
+
+def edit_distance(term, other):
+    row = list(range(len(other) + 1))
+    for position, char in enumerate(term, start=1):
+        previous_row, row = row, [position]
+        for other_position, other_char in enumerate(other, start=1):
+            row.append(min(row[-1] + 1, previous_row[other_position] + 1,
+                           previous_row[other_position - 1] + (char != other_char)))
+    return row[-1]
+
+
+@pytest.mark.parametrize("term_dictionary_class", [SortedTermDictionary, FrontCodedTermDictionary])
+def test_fuzzy_terms_match_edit_distance(term_dictionary_class):
+    terms = TERM_DICTIONARY_TERMS
+    term_dictionary = term_dictionary_class(*term_dictionary_class.encode(terms), len(terms))
+    decoded_terms = [term.decode("utf-8") for term in terms]
+    for query_term in ["wiki", "wikpedia", "tem012", "ab", "", "\u00e9te", "zzz"]:
+        for max_edits in [0, 1, 2]:
+            for prefix_length in [0, 2]:
+                assert fuzzy_terms(term_dictionary, query_term, max_edits, prefix_length) == [
+                    term for term in decoded_terms
+                    if edit_distance(query_term, term) <= max_edits
+                    and term.startswith(query_term[:prefix_length])
+                ]
+    with pytest.raises(ValueError):
+        fuzzy_terms(term_dictionary, "wiki", 3)
+
+
+def test_parse_fuzzy_terms():
+    assert parse_query("wikpedia~ anarchism~2") == And([
+        Fuzzy("wikpedia", 1), Fuzzy("anarchism", 2),
+    ])
+    assert fuzzy_query(parse_query('a OR NOT b "c d"'), 2) == Or([
+        Fuzzy("a", 2), And([Not(Fuzzy("b", 2)), Phrase(["c", "d"])]),
+    ])
+    with pytest.raises(QuerySyntaxError):
+        parse_query("wikpedia~3")
+
+
+@pytest.mark.parametrize("storage_policy", ALL_STORAGE_POLICIES)
+def test_fuzzy_queries_find_misspelled_terms(storage_policy, tmpdir,
+                                              small_sample_wikipedia_documents):
+    etalon_inverted_index = build_inverted_index(small_sample_wikipedia_documents)
+    index_fio = tmpdir.join("index.dump")
+    etalon_inverted_index.dump(index_fio, storage_policy=storage_policy)
+    loaded_inverted_index = InvertedIndex.load(index_fio)
+    assert loaded_inverted_index.query(["anarhcism"]) == []
+    expansion = loaded_inverted_index.terms_within_distance("anarhcism", 2)
+    assert "anarchism" in expansion
+    assert expansion == etalon_inverted_index.terms_within_distance("anarhcism", 2)
+    etalon_answer = etalon_inverted_index.search(" OR ".join(expansion))
+    assert loaded_inverted_index.query(["anarhcism"], max_edits=2) == etalon_answer
+    assert loaded_inverted_index.search("anarhcism~2") == etalon_answer
+
+
+def test_process_queries_with_fuzzy_terms(tmpdir, tiny_dataset_fio, capsys):
+    index_fio = tmpdir.join("index.dump")
+    build_inverted_index(load_documents(tiny_dataset_fio)).dump(index_fio)
+    process_queries(index_fio, ["A_wod B_wrd", "famos_phrases"], max_edits=1)
+    process_queries(index_fio, ["A_wod B_wrd", "famos_phrases"], batch=True, max_edits=1)
+    assert capsys.readouterr().out == "37\n5\n37\n5\n"
+
+
+def test_analyzers_tokenize_filter_and_stem():
+    text = "The Anarchists' studies, and THE libraries!"
+    assert get_analyzer("whitespace").analyze(text) == text.split()
+    assert get_analyzer("standard").analyze(text) == ["anarchists", "studies", "libraries"]
+    assert get_analyzer("english").analyze(text) == ["anarchist", "study", "library"]
+    for term in ["study", "glasses", "status", "does", "cities"]:
+        assert stem_plural(stem_plural(term)) == stem_plural(term)
+    documents = [(7, text), (3, ""), (5, "the and a")]
+    assert list(analyze_documents(get_analyzer("english"), documents, batch_size=2)) == [
+        (7, ["anarchist", "study", "library"]), (3, []), (5, []),
+    ]
+
+
+def test_parse_query_with_analyzer():
+    english = get_analyzer("english")
+    assert parse_query("The Anarchists OR libraries*", english) == Or([
+        Term("anarchist"), Prefix("libraries"),
+    ])
+    assert parse_query('"the Cities of" NOT Wiki~1', english) == And([
+        Term("city"), Not(Fuzzy("wiki", 1)),
+    ])
+    assert parse_query("the AND a", english) == Or([])
+
+
+@pytest.mark.parametrize("build_options", [
+    pytest.param({}, id="in-memory"),
+    pytest.param({"workers": 2}, id="parallel"),
+    pytest.param({"memory_budget": 0}, id="streaming"),
+])
+def test_process_build_with_analyzer(build_options, tmpdir, small_wikipedia_inverted_index):
+    index_fio = tmpdir.join("index.dump")
+    process_build(DATASET_SMALL_FPATH, index_fio, analyzer="english", **build_options)
+    assert tmpdir.join(f"index.dump{ANALYZER_FILE_SUFFIX}").exists()
+    loaded_inverted_index = InvertedIndex.load(index_fio)
+    assert loaded_inverted_index.analyzer is get_analyzer("english")
+    answer = loaded_inverted_index.search("anarchist")
+    assert answer and loaded_inverted_index.search("The Anarchists") == answer
+    assert set(small_wikipedia_inverted_index.search("anarchism")) <= set(
+        loaded_inverted_index.search("Anarchism")
+    )
+    assert loaded_inverted_index.query(["THE", "Anarchists"]) == answer
+    process_build(DATASET_SMALL_FPATH, index_fio, **build_options)
+    assert InvertedIndex.load(index_fio).analyzer.name == "whitespace"
+    process_build(DATASET_SMALL_FPATH, index_fio, **build_options)
+    assert not tmpdir.join(f"index.dump{ANALYZER_FILE_SUFFIX}").exists()
+    assert small_wikipedia_inverted_index == InvertedIndex.load(index_fio)
+
+
+@pytest.mark.parametrize("query_options", [
+    pytest.param({"cache_size": 0}, id="no cache"),
+    pytest.param({}, id="cache"),
+    pytest.param({"batch": True}, id="batch"),
+])
+def test_process_queries_analyzes_terms_once(tmpdir, query_options, capsys):
+    dataset_fio = tmpdir.join("dataset.txt")
+    dataset_fio.write("1\tThe threes are here\n2\the sees threes today\n3\tsees threes again\n")
+    index_fio = tmpdir.join("index.dump")
+    process_build(dataset_fio, index_fio, analyzer="english")
+    capsys.readouterr()
+    process_queries(index_fio, ["sees threes", "threes AND sees", "Threes", "sees threes"],
+                    **query_options)
+    assert capsys.readouterr().out == "2,3\n2,3\n1,2,3\n2,3\n"
+
+
+@pytest.mark.parametrize("query_options", [
+    pytest.param({}, id="single"),
+    pytest.param({"batch": True}, id="batch"),
+])
+def test_process_queries_skips_malformed_queries(tmpdir, query_options, capsys):
+    dataset_fio = tmpdir.join("dataset.txt")
+    dataset_fio.write("1\tred fox\n2\tred dog\n3\tblue fox\n")
+    index_fio = tmpdir.join("index.dump")
+    process_build(dataset_fio, index_fio)
+    inverted_index = InvertedIndex.load(index_fio)
+    with pytest.raises(QuerySyntaxError):
+        parse_query("red OR NOT fox").evaluate(inverted_index)
+    capsys.readouterr()
+    process_queries(index_fio, ["red OR NOT fox", "red AND (", "red AND NOT fox"],
+                    **query_options)
+    assert capsys.readouterr().out == "\n\n2\n"
+
+
+@pytest.mark.parametrize("query_options", [
+    pytest.param({}, id="boolean"),
+    pytest.param({"top_k": 5}, id="ranked"),
+    pytest.param({"batch": True, "batch_size": 2}, id="batch"),
+    pytest.param({"batch": True, "batch_size": 2, "top_k": 5}, id="batch-ranked"),
+])
+def test_process_queries_keeps_output_aligned_with_blank_lines(tmpdir, query_options,
+                                                               capsys):
+    dataset_fio = tmpdir.join("dataset.txt")
+    dataset_fio.write("1\tred fox\n2\tred dog\n3\tblue fox\n")
+    index_fio = tmpdir.join("index.dump")
+    process_build(dataset_fio, index_fio, ranked=True)
+    capsys.readouterr()
+    process_queries(index_fio, ["dog\n", "\n", "  \n", "blue\n"], **query_options)
+    assert capsys.readouterr().out == "2\n\n\n3\n"
+
+
+def test_segmented_index_keeps_analyzer(tmpdir):
+    index_dir = tmpdir.join("segments")
+    process_build(DATASET_SMALL_FPATH, index_dir, analyzer="english", segment_size=20)
+    segmented_index = SegmentedIndex(index_dir)
+    assert segmented_index.analyzer is get_analyzer("english")
+    answer = segmented_index.search("anarchist")
+    assert answer and segmented_index.search("The Anarchists") == answer
+    assert segmented_index.query(["Anarchists"]) == answer
+
+
+def test_segmented_index_ranks_like_single_index(tmpdir, capsys):
+    index_fio = tmpdir.join("index.dump")
+    index_dir = tmpdir.join("segments")
+    process_build(DATASET_SMALL_FPATH, index_fio, ranked=True)
+    process_build(DATASET_SMALL_FPATH, index_dir, ranked=True, segment_size=7)
+    single_index = InvertedIndex.load(index_fio)
+    segmented_index = SegmentedIndex(index_dir)
+    assert len(segmented_index) > 1
+    for words in [["anarchism", "war"], ["the"], ["no_such_word"]]:
+        expected = single_index.rank(words, 5)
+        ranked = segmented_index.rank(words, 5)
+        assert [doc_id for doc_id, _ in ranked] == [doc_id for doc_id, _ in expected]
+        assert [score for _, score in ranked] == pytest.approx(
+            [score for _, score in expected]
+        )
+    capsys.readouterr()
+    process_queries(index_dir, ["anarchism war"], top_k=3)
+    assert capsys.readouterr().out == ",".join(
+        str(doc_id) for doc_id, _ in single_index.rank(["anarchism", "war"], 3)
+    ) + "\n"
+
+
+def test_latency_histogram_quantiles_are_within_relative_error():
+    for index in range(1, 3000):
+        low, _ = LatencyHistogram.bucket_range(index)
+        assert low == LatencyHistogram.bucket_range(index - 1)[1] + 1
+        assert LatencyHistogram.bucket_index(low) == index
+    histogram = LatencyHistogram()
+    values = [(value * 7919) % 10 ** 7 for value in range(1, 20_001)]
+    for value in values:
+        histogram.record(value)
+    values.sort()
+    assert histogram.count == 20_000
+    assert histogram.min <= values[0] and values[-1] <= histogram.max <= values[-1] * 1.01
+    for quantile in [0.5, 0.9, 0.99, 0.999]:
+        etalon = values[round(quantile * len(values)) - 1]
+        assert abs(histogram.quantile(quantile) - etalon) <= etalon / 100
+    assert LatencyHistogram().quantile(0.99) == 0
+
+
+def test_process_queries_records_stage_metrics(tmpdir, tiny_dataset_fio, capsys):
+    index_fio = tmpdir.join("index.dump")
+    build_inverted_index(load_documents(tiny_dataset_fio)).dump(index_fio)
+    stage_metrics.reset()
+    process_queries(index_fio, ["A_word B_word", "A_word OR famous_phrases"], cache_size=0)
+    assert capsys.readouterr().out == "37\n5,37,123\n"
+    for stage in ["load", "parse", "evaluate", "output", "query"]:
+        assert stage_metrics.histogram(stage).count == (1 if stage == "load" else 2)
+    json_fio = tmpdir.join("metrics.json")
+    stage_metrics.export(json_fio)
+    stages = json.loads(json_fio.read())["stages"]
+    assert stages["query"]["count"] == 2
+    assert 0 < stages["query"]["quantiles_seconds"]["0.99"] <= stages["query"]["max_seconds"]
+    prometheus_fio = tmpdir.join("metrics.prom")
+    stage_metrics.export(prometheus_fio, "prometheus")
+    assert 'inverted_index_stage_seconds_count{stage="query"} 2' in prometheus_fio.read()
+    with pytest.raises(ValueError):
+        StageMetrics().export(json_fio, "xml")
+
+
+def test_compressed_policy_is_smaller_than_array_policy(tmpdir):
+    word_to_docs_mapping = {"dense": set(range(10_000)), "sparse": {7, 70_000}}
+    array_fio = tmpdir.join("array.dump")
+    compressed_fio = tmpdir.join("compressed.dump")
+    ArrayStoragePolicy.dump(word_to_docs_mapping, array_fio)
+    CompressedStoragePolicy.dump(word_to_docs_mapping, compressed_fio)
+    assert compressed_fio.size() * 3 < array_fio.size()
+    assert list(CompressedStoragePolicy.load(compressed_fio)["sparse"]) == [7, 70_000]
+
+
+def test_can_dump_and_load_inverted_index_with_struct_policy(tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    etalon_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio))
+    etalon_inverted_index.dump(index_fio, storage_policy=StructStoragePolicy)
+    loaded_inverted_index = InvertedIndex.load(index_fio, storage_policy=StructStoragePolicy)
+    assert etalon_inverted_index == loaded_inverted_index, (
+        "load should return the same inverted index"
+    )
+
+
+@pytest.mark.parametrize("storage_policy", ALL_STORAGE_POLICIES)
+def test_lazy_load_decodes_postings_on_first_access(tmpdir, tiny_dataset_fio, storage_policy,
+                                                    capsys):
+    index_fio = tmpdir.join("index.dump")
+    etalon_inverted_index = build_inverted_index(load_documents(tiny_dataset_fio))
+    etalon_inverted_index.dump(index_fio, storage_policy=storage_policy)
+    lazy_index = InvertedIndex.load(index_fio, storage_policy=storage_policy, lazy=True)
+    postings = lazy_index.inverted_index
+    if storage_policy is StructStoragePolicy:
+        assert isinstance(postings, StructIndexMapping)
+    assert lazy_index == etalon_inverted_index
+    assert lazy_index.query(["A_word", "B_word"]) == [37]
+    assert "no_such_word" not in postings and lazy_index.query(["no_such_word"]) == []
+    process_queries(index_fio, ["A_word", "A_word B_word"], lazy=True)
+    assert capsys.readouterr().out == "37,123\n37\n"
+
+
+def test_lazy_struct_mapping_caches_hot_posting_lists(tmpdir):
+    index_fio = tmpdir.join("index.dump")
+    StructStoragePolicy.dump({f"term{i}": {i, i + 1} for i in range(10)}, index_fio)
+    postings = StructStoragePolicy.load_lazy(index_fio)
+    assert len(postings) == 10 and len(postings._postings_cache) == 0
+    assert postings["term3"] == {3, 4} and postings["term3"] is postings["term3"]
+    with pytest.raises(KeyError):
+        postings["term10"]
+    cache = PostingsCache(max_size=2)
+    decoded = []
+    for key in ["a", "b", "a", "c", "b", "a"]:
+        cache.get(key, lambda key=key: decoded.append(key) or key.upper())
+    assert decoded == ["a", "b", "c", "b", "a"] and len(cache) == 2
+
+
+def test_array_policy_loads_sorted_term_dictionary(tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    build_inverted_index(load_documents(tiny_dataset_fio)).dump(
+        index_fio, storage_policy=ArrayStoragePolicy,
+    )
+    mapping = ArrayStoragePolicy.load(index_fio)
+    assert list(mapping) == sorted(mapping)
+    assert list(mapping["A_word"]) == [37, 123]
+    assert "word_does_not_exist" not in mapping
+    with pytest.raises(KeyError):
+        mapping["word_does_not_exist"]
+
+
+def test_query_does_not_depend_on_storage_policy(tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    build_inverted_index(load_documents(tiny_dataset_fio)).dump(index_fio)
+    loaded_inverted_index = InvertedIndex.load(index_fio)
+    assert sorted(loaded_inverted_index.query(["A_word", "B_word"])) == [37]
+    assert loaded_inverted_index.query(["word_does_not_exist"]) == []
+
+
+@pytest.mark.parametrize("storage_policy", ALL_STORAGE_POLICIES)
+def test_dump_supports_doc_ids_and_postings_beyond_16_bits(storage_policy, tmpdir):
+    index_fio = tmpdir.join("index.dump")
+    etalon_inverted_index = InvertedIndex({
+        "dense": set(range(70_000)),
+        "huge_ids": {65_536, 2 ** 32 + 5},
+    })
+    etalon_inverted_index.dump(index_fio, storage_policy=storage_policy)
+    loaded_inverted_index = InvertedIndex.load(index_fio, verify=True)
+    assert etalon_inverted_index == loaded_inverted_index, (
+        "load should return the same inverted index"
+    )
+
+
+@pytest.mark.parametrize("storage_policy", ALL_STORAGE_POLICIES)
+def test_load_detects_storage_policy_from_header(storage_policy, tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    build_inverted_index(load_documents(tiny_dataset_fio)).dump(index_fio, storage_policy=storage_policy)
+    assert detect_storage_policy(index_fio) is storage_policy
+    assert sorted(InvertedIndex.load(index_fio).query(["A_word"])) == [37, 123]
+
+
+def test_load_rejects_incompatible_files(tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    build_inverted_index(load_documents(tiny_dataset_fio)).dump(
+        index_fio, storage_policy=ArrayStoragePolicy,
+    )
+    with pytest.raises(IndexFormatError, match="not by StructStoragePolicy"):
+        InvertedIndex.load(index_fio, storage_policy=StructStoragePolicy)
+
+    content = index_fio.read_binary()
+    index_fio.write_binary(content[:-1])
+    with pytest.raises(IndexFormatError, match="truncated"):
+        InvertedIndex.load(index_fio)
+
+    index_fio.write_binary(content[:-1] + bytes([content[-1] ^ 0xFF]))
+    with pytest.raises(IndexFormatError, match="checksum"):
+        InvertedIndex.load(index_fio, verify=True)
+
+    index_fio.write_binary(b"not an index at all, just some text data")
+    with pytest.raises(IndexFormatError, match="not an inverted index"):
+        InvertedIndex.load(index_fio)
 
 
 @pytest.mark.parametrize(
@@ -184,8 +1289,8 @@ def test_can_dump_and_load_inverted_index(tmpdir, wikipedia_inverted_index):
         # pytest.param(DATASET_BIG_FPATH, marks=[pytest.mark.slow]),
     ],
 )
-def test_process_build_can_load_documents(dataset_filepath):
-    process_build(dataset_filepath, "inverted.index")
+def test_process_build_can_load_documents(tmpdir, dataset_filepath):
+    process_build(dataset_filepath, tmpdir.join("inverted.index"))
 
 
 @pytest.mark.parametrize(
@@ -196,18 +1301,206 @@ def test_process_build_can_load_documents(dataset_filepath):
         # pytest.param(DATASET_BIG_FPATH, marks=[pytest.mark.slow]),
     ],
 )
-def test_callback_build_can_build_inverted_index_from_provided_file(dataset_filepath):
+def test_callback_build_can_build_inverted_index_from_provided_file(tmpdir, dataset_filepath):
     build_arguments = Namespace(
         dataset_filepath=dataset_filepath,
-        inverted_index_filepath=DEFAULT_INVERTED_INDEX_SAVE_PATH,
+        inverted_index_filepath=tmpdir.join(DEFAULT_INVERTED_INDEX_SAVE_PATH),
     )
     callback_build(build_arguments)
 
 
-def test_process_queries_can_process_queries_from_provided_file(capsys):
+@pytest.mark.parametrize("workers", [1, 2, 3, 16])
+def test_split_dataset_covers_whole_file_by_lines(workers):
+    ranges = split_dataset(DATASET_SMALL_FPATH, workers)
+    with open(DATASET_SMALL_FPATH, "rb") as fin:
+        content = fin.read()
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(content)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start and content[start - 1:start] == b"\n"
+
+
+@pytest.mark.parametrize("workers", [2, 4])
+def test_parallel_build_equals_serial_build(workers, small_wikipedia_inverted_index):
+    parallel_inverted_index = build_inverted_index_parallel(DATASET_SMALL_FPATH, workers)
+    assert small_wikipedia_inverted_index == parallel_inverted_index, (
+        "parallel build should return the same inverted index"
+    )
+
+
+def test_merge_partial_indexes_merges_postings_by_term():
+    partial_indexes = [
+        [("a", [1, 5]), ("c", [3])],
+        [("a", [2]), ("b", [4]), ("c", [3, 7])],
+    ]
+    assert list(merge_partial_indexes(partial_indexes)) == [
+        ("a", [1, 2, 5]), ("b", [4]), ("c", [3, 7]),
+    ]
+    assert partial_indexes == [[], []]
+
+
+@pytest.mark.parametrize("storage_policy", ALL_STORAGE_POLICIES)
+def test_process_build_with_workers(storage_policy, tmpdir, small_wikipedia_inverted_index):
+    index_fio = tmpdir.join("index.dump")
+    process_build(DATASET_SMALL_FPATH, index_fio, storage_policy=storage_policy, workers=2)
+    assert small_wikipedia_inverted_index == InvertedIndex.load(index_fio)
+
+
+@pytest.mark.parametrize("build_options", [
+    pytest.param({"workers": 2}, id="workers"),
+    pytest.param({"memory_budget": 1}, id="memory_budget"),
+])
+def test_streamed_build_removes_stale_sections(build_options, tmpdir, tiny_dataset_fio):
+    index_fio = tmpdir.join("index.dump")
+    process_build(tiny_dataset_fio, index_fio, positional=True, ranked=True)
+    assert InvertedIndex.load(index_fio).search('"to be"') == [5]
+    for _ in range(2):
+        process_build(tiny_dataset_fio, index_fio, storage_policy=ArrayStoragePolicy,
+                      **build_options)
+        rebuilt_index = InvertedIndex.load(index_fio)
+        assert rebuilt_index.section_filepaths == {}
+        assert rebuilt_index.query(["A_word"]) == [37, 123]
+    version = inverted_index.index_version(index_fio)
+    assert sorted(os.listdir(tmpdir)) == [
+        "dataset.txt", "index.dump", f"index.dump.{version:08x}{ANALYZER_FILE_SUFFIX}",
+    ]
+
+
+def test_iter_documents_streams_dataset(tiny_dataset_fio):
+    documents = iter_documents(tiny_dataset_fio)
+    assert next(documents) == (123, "some words A_word and nothing")
+    assert dict(documents) == {
+        2: "some word B_word in this dataset",
+        5: "famous_phrases to be or not to be",
+        37: "all words such as A_word and B_word are here",
+    }
+
+
+def test_mapped_dataset_gives_zero_copy_access(tmpdir, tiny_dataset_fio):
+    with MappedDataset(tiny_dataset_fio) as dataset:
+        assert list(dataset) == [123, 2, 5, 37]
+        view = dataset.view(5)
+        assert isinstance(view, memoryview) and view.readonly
+        assert view.tobytes() == b"famous_phrases to be or not to be"
+        start, end = dataset.byte_range(5)
+        assert tiny_dataset_fio.read_binary()[start:end] == view.tobytes()
+        view.release()
+        assert [(doc_id, bytes(view)) for doc_id, view in dataset.iter_views()][-1] == (
+            37, b"all words such as A_word and B_word are here",
+        )
+        assert 2 in dataset and 3 not in dataset
+    dataset_fio = tmpdir.join("crlf.dataset")
+    dataset_fio.write_binary("1\tfirst  \r\n\n2\t\u00e9t\u00e9\r\n1\tagain".encode())
+    assert dict(MappedDataset(dataset_fio)) == {1: "again", 2: "\u00e9t\u00e9"}
+    empty_fio = tmpdir.join("empty.dataset")
+    empty_fio.write("")
+    assert len(MappedDataset(empty_fio)) == 0
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_mapped_dataset_byte_ranges_cover_dataset(workers):
+    documents = {}
+    for start, end in split_dataset(DATASET_SMALL_FPATH, workers):
+        with MappedDataset(DATASET_SMALL_FPATH, start, end) as dataset:
+            assert not documents.keys() & dataset.keys()
+            documents.update(dataset)
+    assert documents == load_documents(DATASET_SMALL_FPATH)
+
+
+@pytest.mark.parametrize("block_size", [1, 100, DOCUMENT_BLOCK_SIZE])
+def test_document_store_gives_random_access(block_size, tmpdir):
+    store_fio = tmpdir.join("index.docs")
+    with MappedDataset(DATASET_SMALL_FPATH) as dataset:
+        DocumentStoreStoragePolicy.dump(dataset, store_fio, block_size=block_size)
+    assert detect_storage_policy(store_fio) is DocumentStoreStoragePolicy
+    assert store_fio.size() < os.path.getsize(DATASET_SMALL_FPATH)
+    document_store = DocumentStoreStoragePolicy.load(store_fio)
+    documents = load_documents(DATASET_SMALL_FPATH)
+    assert list(document_store) == sorted(documents)
+    for doc_id in reversed(sorted(documents)):
+        assert document_store[doc_id] == documents[doc_id]
+    assert 0 not in document_store and "12" not in document_store
+    with pytest.raises(KeyError):
+        document_store[0]
+    DocumentStoreStoragePolicy.dump({3: "\u00e9t\u00e9", 1: ""}, store_fio, block_size=block_size)
+    assert dict(DocumentStoreStoragePolicy.load(store_fio)) == {1: "", 3: "\u00e9t\u00e9"}
+
+
+def test_make_snippet_highlights_best_passage():
+    text = " ".join(["filler"] * 50 + ["The", "Anarchists", "of", "the", "state"] + ["end"] * 50)
+    snippet = make_snippet(text, ["anarchist", "state"], get_analyzer("english"), width=40)
+    assert snippet.startswith("...") and snippet.endswith("...")
+    assert "<b>Anarchists</b> of the <b>state</b>" in snippet
+    assert len(snippet) < 80
+    assert make_snippet("some words A_word", ["A_word"], get_analyzer()) == (
+        "some words <b>A_word</b>"
+    )
+    assert make_snippet("no  matches\there", ["A_word"], get_analyzer()) == "no matches here"
+
+
+def test_process_queries_with_snippets(tmpdir, tiny_dataset_fio, capsys):
+    index_fio = tmpdir.join("index.dump")
+    process_build(tiny_dataset_fio, index_fio, store_documents=True)
+    process_queries(index_fio, ["A_word", "B_word NOT here"], snippets=1)
+    assert capsys.readouterr().out == (
+        "37,123\n37\tall words such as <b>A_word</b> and B_word are here\n"
+        "2\n2\tsome word <b>B_word</b> in this dataset\n"
+    )
+    with pytest.raises(ValueError):
+        process_queries(index_fio, ["A_word"], batch=True, snippets=1)
+    process_build(tiny_dataset_fio, index_fio)
+    assert not tmpdir.join(f"index.dump{DOCUMENT_STORE_FILE_SUFFIX}").exists()
+    with pytest.raises(ValueError):
+        process_queries(index_fio, ["A_word"], snippets=1)
+
+
+def test_query_rejects_negative_snippets(capsys):
+    parser = ArgumentParser()
+    setup_parser(parser)
+    assert parser.parse_args(["query", "--query", "A_word", "--snippets", "0"]).snippets == 0
+    with pytest.raises(SystemExit):
+        parser.parse_args(["query", "--query", "A_word", "--snippets", "-1"])
+    assert "not a non-negative integer" in capsys.readouterr().err
+
+
+def test_run_files_round_trip(tmpdir):
+    run_filepath = tmpdir.join("0.run")
+    items = [("a", [1, 70_000]), ("b", [4]), ("ü", [0, 2])]
+    write_run(items, run_filepath)
+    assert list(read_run(run_filepath)) == items
+
+
+@pytest.mark.parametrize("memory_budget", [1, 2_000, 10 ** 9])
+def test_build_runs_flushes_when_memory_budget_is_hit(memory_budget, tmpdir):
+    run_filepaths, max_doc_id = build_runs(DATASET_SMALL_FPATH, memory_budget, tmpdir)
+    assert max_doc_id == max(load_documents(DATASET_SMALL_FPATH))
+    if memory_budget == 1:
+        assert len(run_filepaths) == len(load_documents(DATASET_SMALL_FPATH))
+    elif memory_budget == 10 ** 9:
+        assert len(run_filepaths) == 1
+
+
+@pytest.mark.parametrize("storage_policy", ALL_STORAGE_POLICIES)
+def test_streaming_build_equals_in_memory_build(storage_policy, tmpdir, monkeypatch,
+                                                small_wikipedia_inverted_index):
+    monkeypatch.setattr(inverted_index, "MAX_MERGE_FAN_IN", 3)
+    index_fio = tmpdir.join("index.dump")
+    process_build(DATASET_SMALL_FPATH, index_fio, storage_policy=storage_policy,
+                  memory_budget=0)
+    assert small_wikipedia_inverted_index == InvertedIndex.load(index_fio)
+    assert tmpdir.listdir() == [index_fio], "temporary runs should be removed"
+
+
+@pytest.fixture()
+def default_index_fio(tmpdir):
+    index_fio = tmpdir.join(DEFAULT_INVERTED_INDEX_SAVE_PATH)
+    process_build(DATASET_SMALL_FPATH, index_fio)
+    return index_fio
+
+
+def test_process_queries_can_process_queries_from_provided_file(default_index_fio, capsys):
     with open("queries-utf8.txt") as queries_fin:
         process_queries(
-            inverted_index_filepath=DEFAULT_INVERTED_INDEX_SAVE_PATH,
+            inverted_index_filepath=default_index_fio,
             query_file=queries_fin,
         )
         captured = capsys.readouterr()
@@ -217,10 +1510,137 @@ def test_process_queries_can_process_queries_from_provided_file(capsys):
         assert "two words" not in captured.err
 
 
-def test_callback_query_can_process_queries_from_provided_file():
+def test_callback_query_can_process_queries_from_provided_file(default_index_fio):
     with open("queries-utf8.txt") as queries_fin:
         query_arguments = Namespace(
-            inverted_index_filepath=DEFAULT_INVERTED_INDEX_SAVE_PATH,
+            inverted_index_filepath=default_index_fio,
             query_file=queries_fin,
         )
         callback_query(query_arguments)
+
+
+def test_generate_corpus_is_reproducible_and_skewed():
+    corpus = generate_corpus(200, vocabulary_size=1000, zipf_exponent=1.2,
+                             document_length=50, seed=7)
+    assert corpus == generate_corpus(200, vocabulary_size=1000, zipf_exponent=1.2,
+                                     document_length=50, seed=7)
+    assert corpus != generate_corpus(200, vocabulary_size=1000, zipf_exponent=1.2,
+                                     document_length=50, seed=8)
+    word_counts = Counter(word for document in corpus.values() for word in document.split())
+    assert len(corpus) == 200 and len(word_counts) <= 1000
+    assert word_counts.most_common(1)[0][0] == "a"
+    assert word_counts["a"] > 50 * word_counts["aa"] / 27
+
+
+def test_run_benchmark_measures_stages_and_flags_regressions():
+    results = run_benchmark(documents_count=100, vocabulary_size=500, document_length=20,
+                            queries_count=50, storage_formats=["struct", "array"], repeat=1)
+    measurements = {
+        (measurement["stage"], measurement["format"]): measurement
+        for measurement in json.loads(json.dumps(results))["measurements"]
+    }
+    assert set(measurements) == {
+        ("build", None), ("dump", "array"), ("dump", "struct"),
+        ("load", "array"), ("load", "struct"), ("query", "array"), ("query", "struct"),
+    }
+    assert measurements[("build", None)]["items"] == 100
+    assert measurements[("query", "array")]["items"] == 50
+    assert all(
+        measurement["items_per_second"] > 0 and measurement["peak_rss_bytes"] > 0
+        for measurement in measurements.values()
+    )
+    assert not any(row[-1] for row in compare_results(results, results))
+    slower = json.loads(json.dumps(results))
+    for measurement in slower["measurements"]:
+        if measurement["stage"] == "query":
+            measurement["items_per_second"] /= 2
+    regressions = [row[:3] for row in compare_results(results, slower) if row[-1]]
+    assert regressions == [("query", "array", "items_per_second"),
+                           ("query", "struct", "items_per_second")]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_sharded_index_answers_like_single_index(tmpdir, workers):
+    index_fio = tmpdir.join("index.dump")
+    shards_dir = tmpdir.join("shards")
+    process_build(DATASET_SMALL_FPATH, index_fio, ranked=True, analyzer="english")
+    process_build(DATASET_SMALL_FPATH, shards_dir, ranked=True, analyzer="english",
+                  shards=3, workers=workers)
+    assert sorted(os.listdir(shards_dir))[-1] == SHARDS_MANIFEST_FILENAME
+    single_index = InvertedIndex.load(index_fio)
+    with ShardedIndex(shards_dir) as sharded_index:
+        assert len(sharded_index) == 3 and sharded_index.analyzer is get_analyzer("english")
+        for query in ["anarchist", "anarchist OR Anarchism", "war AND NOT anarchist", "the"]:
+            assert sharded_index.search(query) == single_index.search(query)
+        assert sharded_index.query(["Anarchists", "the"]) == single_index.query(
+            ["Anarchists", "the"]
+        )
+        assert sharded_index.query(["anarchyst"], max_edits=1) == single_index.query(
+            ["anarchyst"], max_edits=1
+        )
+        for words in [["anarchist", "war"], ["the"], ["no_such_word"]]:
+            expected = single_index.rank(words, 5)
+            ranked = sharded_index.rank(words, 5)
+            assert [doc_id for doc_id, _ in ranked] == [doc_id for doc_id, _ in expected]
+            assert [score for _, score in ranked] == pytest.approx(
+                [score for _, score in expected]
+            )
+    with pytest.raises(ValueError, match="closed"):
+        sharded_index.query(["anarchist"])
+
+
+def test_process_queries_against_sharded_index(tmpdir, tiny_dataset_fio, capsys):
+    shards_dir = tmpdir.join("shards")
+    process_build(tiny_dataset_fio, shards_dir, shards=6)
+    assert len(os.listdir(shards_dir)) == 7
+    process_queries(shards_dir, ["A_word", "A_word B_word", "word OR famous_phrases"])
+    assert capsys.readouterr().out == "37,123\n37\n2,5\n"
+    process_build(tiny_dataset_fio, shards_dir, shards=2)
+    assert sorted(name for name in os.listdir(shards_dir) if name.endswith(".index")) == [
+        "shard-0000.index", "shard-0001.index",
+    ]
+    process_queries(shards_dir, ["A_word"])
+    assert capsys.readouterr().out == "37,123\n"
+    with pytest.raises(ValueError, match="Batch mode"):
+        process_queries(shards_dir, ["A_word"], batch=True)
+
+
+@pytest.mark.parametrize("options, message", [
+    (["--shards", "0"], "not a positive integer"),
+    (["--workers", "-1"], "not a positive integer"),
+    (["--shards", "2", "--segment-size", "10"], "Shards are built in memory"),
+    (["--shards", "2", "--memory-budget", "10"], "Shards are built in memory"),
+    (["--segment-size", "10", "--workers", "2"], "not allowed with"),
+    (["--positional", "--workers", "2"], "only supported by the in-memory build"),
+])
+def test_build_reports_conflicting_options_as_usage_errors(tmpdir, monkeypatch, capsys,
+                                                           options, message):
+    index_fio = tmpdir.join("index.dump")
+    monkeypatch.setattr(sys, "argv", [
+        "inverted-index", "build", "-d", DATASET_TINY_FPATH, "-o", str(index_fio),
+        "--store-documents", *options,
+    ])
+    with pytest.raises(SystemExit) as exit_info:
+        inverted_index.main()
+    assert exit_info.value.code == 2
+    assert message in capsys.readouterr().err
+    assert tmpdir.listdir() == []
+
+
+def test_index_holder_closes_replaced_sharded_index_after_last_request(tmpdir,
+                                                                       tiny_dataset_fio):
+    shards_dir = tmpdir.join("shards")
+    process_build(tiny_dataset_fio, shards_dir, shards=2)
+    index_holder = IndexHolder(shards_dir)
+    query_server = QueryServer(index_holder)
+    with index_holder.acquire() as running_index:
+        assert index_holder.reload()
+        assert index_holder.inverted_index is not running_index
+        assert running_index.search("A_word") == [37, 123]
+        assert query_server.answer("A_word B_word") == [37]
+    with pytest.raises(ValueError, match="closed"):
+        running_index.search("A_word")
+    assert query_server.answer("A_word") == [37, 123]
+    assert index_holder.reload()
+    index_holder.inverted_index.close()
+